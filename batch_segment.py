@@ -0,0 +1,165 @@
+'''
+Headless batch floodfill
+
+Runs floodfill for every job of a manifest, without the GUI, and saves the results as segments. A manifest is a JSON
+list (or a JSON lines file) of jobs like
+    {"data_file_name": "data/scene.ply", "picked_points_id": [120, 4512, 3000], "segment_name": "north wall",
+     "type_class": ["Wall", 1], "batch_size": 10, "angle_error_tolerance": 0.4, "boundary_thickness": 0.1}
+where the floodfill parameters are optional.
+
+Jobs are grouped by file and fanned out over a process pool. The neighbor graph of every file is built once, in
+parallel across files, and then memory-mapped by every worker that runs jobs of that file.
+
+Sample usage:
+    python batch_segment.py manifest.json --store segments.store
+    python batch_segment.py manifest.json --output segments.json --workers 8
+'''
+import argparse
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from custom_util import floodfill
+from models import Segment
+from neighbor_graph import DEFAULT_K, load_neighbor_graph
+from ply_reader import read_point_cloud
+from segment_store import SegmentStore, write_segments_json
+
+FLOODFILL_PARAMETERS = ("batch_size", "angle_error_tolerance", "boundary_thickness")
+
+# cloud and neighbor graph of the file the jobs of this worker process last ran on
+_loaded_file = {"data_file_name": None, "pcd": None, "graph": None}
+
+
+def read_manifest(manifest_file_name):
+    with open(manifest_file_name) as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def graph_k(jobs):
+    return max([DEFAULT_K] + [job.get("batch_size", DEFAULT_K) for job in jobs])
+
+
+def prepare_file(data_file_name, k):
+    '''
+    Build the neighbor graph sidecar of a file so the workers only have to memory-map it
+    '''
+    load_neighbor_graph(data_file_name, read_point_cloud(data_file_name), k)
+    return data_file_name
+
+
+def load_file(data_file_name, k):
+    if _loaded_file["data_file_name"] != data_file_name:
+        pcd = read_point_cloud(data_file_name)
+        _loaded_file.update(data_file_name=data_file_name, pcd=pcd, graph=load_neighbor_graph(data_file_name, pcd, k))
+    return _loaded_file["pcd"], _loaded_file["graph"]
+
+
+def run_jobs(data_file_name, k, jobs):
+    '''
+    Run floodfill jobs on one file, in a worker process
+    :param jobs: list of (job number, job)
+    :return: list of (job number, indices, None) or (job number, None, error message)
+    '''
+    pcd, graph = load_file(data_file_name, k)
+    results = []
+    for job_number, job in jobs:
+        try:
+            parameters = {name: job[name] for name in FLOODFILL_PARAMETERS if name in job}
+            indices = floodfill(job["picked_points_id"], pcd, graph=graph, **parameters)
+            if len(indices) == 0:
+                results.append((job_number, None, "ERR: floodfill found no points, nothing to save"))
+                continue
+            results.append((job_number, indices, None))
+        except Exception as e:
+            results.append((job_number, None, str(e)))
+    return results
+
+
+def split_jobs(jobs_by_file, workers):
+    '''
+    Split every file's jobs into chunks so a file with many jobs is spread over all workers
+    :return: list of (data file name, k, list of (job number, job))
+    '''
+    tasks = []
+    for data_file_name, jobs in jobs_by_file.items():
+        chunk_size = max(1, -(-len(jobs) // workers))
+        k = graph_k([job for _, job in jobs])
+        for start in range(0, len(jobs), chunk_size):
+            tasks.append((data_file_name, k, jobs[start:start + chunk_size]))
+    return tasks
+
+
+def run_manifest(manifest, workers=None, first_id=0):
+    '''
+    :param manifest: list of jobs
+    :param workers: number of worker processes, defaults to the number of cores
+    :param first_id: id of the first segment, the others follow in manifest order
+    :return: generator of (job number, Segment or None, error message or None) in completion order
+    '''
+    workers = workers or os.cpu_count() or 1
+    jobs_by_file = OrderedDict()
+    for job_number, job in enumerate(manifest):
+        data_file_name = os.path.abspath(job["data_file_name"])
+        if not os.path.isfile(data_file_name):
+            # fail before any worker reads it, Open3D would return an empty cloud and a sidecar would be built for it
+            yield job_number, None, "ERR: no such file {}".format(job["data_file_name"])
+            continue
+        jobs_by_file.setdefault(data_file_name, []).append((job_number, job))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(prepare_file, jobs_by_file.keys(),
+                      [graph_k([job for _, job in jobs]) for jobs in jobs_by_file.values()]))
+        futures = [pool.submit(run_jobs, *task) for task in split_jobs(jobs_by_file, workers)]
+        for future in as_completed(futures):
+            for job_number, indices, error in future.result():
+                if error is not None:
+                    yield job_number, None, error
+                    continue
+                job = manifest[job_number]
+                segment = Segment(id=first_id + job_number,
+                                  data_file_name=job["data_file_name"],
+                                  segment_name=job.get("segment_name", "batch {}".format(job_number)),
+                                  indices=indices,
+                                  type_class=tuple(job["type_class"]) if "type_class" in job else None)
+                yield job_number, segment, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run floodfill for every job of a manifest and save the segments")
+    parser.add_argument("manifest", help="JSON list or JSON lines file of floodfill jobs")
+    parser.add_argument("--store", help="segment store directory to append the segments to")
+    parser.add_argument("--output", help="segments.json file to write the segments to")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args(argv)
+    if not args.store and not args.output:
+        parser.error("at least one of --store and --output is required")
+
+    manifest = read_manifest(args.manifest)
+    segment_store = SegmentStore(args.store) if args.store else None
+    first_id = segment_store.next_id() if segment_store is not None else 0
+    segments = {}
+    failed = 0
+    for job_number, segment, error in run_manifest(manifest, args.workers, first_id):
+        if error is not None:
+            failed += 1
+            print("Job {} failed: {}".format(job_number, error))
+            continue
+        print("Job {}: {} points".format(job_number, len(segment.indices)))
+        if segment_store is not None:
+            segment.id = segment_store.put_new(segment.dict(exclude={"indices"}), segment.indices)
+        if args.output:
+            segments[job_number] = segment
+    if args.output:
+        write_segments_json(args.output, (segments[job_number].dict() for job_number in sorted(segments)))
+    print("{} of {} jobs done".format(len(manifest) - failed, len(manifest)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+'''
+Benchmarks of the hot paths: neighbor graph build, floodfill, crop, PLY load, segment save and (with --gl) picking
+
+Every case runs on data/scene.ply and on synthetic clouds (plane, box, room) of every requested size. Wall time is
+the best of --repeat runs; peak memory is the maximum resident set size of a fresh subprocess that loads the cloud and
+runs the case once, so Open3D and cKDTree allocations count too (Unix only, it needs resource and a fork server).
+Results can be saved as a baseline and later runs compared against it.
+
+Sample usage:
+    python benchmark.py --sizes 10000,100000 --save-baseline
+    python benchmark.py --sizes 10000,100000 --threshold 0.2
+'''
+import argparse
+import json
+import multiprocessing
+import multiprocessing.forkserver
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from custom_util import crop_remove, crop_reserve, floodfill, Scene
+from models import Segment
+from neighbor_graph import load_neighbor_graph
+from ply_reader import PointCloudData, read_ply
+from segment_store import SegmentStore
+
+DEFAULT_SIZES = [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+SHAPES = ["plane", "box", "room"]
+# bounding line across data/scene.ply at y = 2.5 and a seed on the floor in front of it, fills about 11k points
+SCENE_PICKED = [5064, 68023, 33155]
+
+
+def make_plane(n, rng):
+    points = np.c_[rng.rand(n, 2) * 10, rng.normal(0, 0.002, n)]
+    return points, [5, 5, 0], [0, 10, 0], [10, 10, 0]
+
+
+def make_box(n, rng):
+    # n points on the 6 faces of a 4 x 3 x 2 box, seeded on the bottom face
+    size = np.array([4.0, 3.0, 2.0])
+    points = rng.rand(n, 3) * size
+    axis = rng.randint(0, 3, n)
+    points[np.arange(n), axis] = rng.randint(0, 2, n) * size[axis]
+    return points, [2, 1.5, 0], [0, 3, 0], [4, 3, 0]
+
+
+def make_room(n, rng):
+    # floor, ceiling and four walls of a 10 x 8 x 3 room, face areas decide how many points each gets, seeded on the
+    # floor with the bounding line along the middle of the floor
+    size = np.array([10.0, 8.0, 3.0])
+    points, _, _, _ = make_box(n, rng)
+    points = points / np.array([4.0, 3.0, 2.0]) * size
+    return points, [5, 2, 0], [0, 4, 0], [10, 4, 0]
+
+
+def make_cloud(shape, n, seed=0):
+    '''
+    :return: (PointCloudData, picked point ids) where the picks are the two bounding line points and the seed
+    '''
+    rng = np.random.RandomState(seed)
+    points, seed_point, line_start, line_end = {"plane": make_plane, "box": make_box, "room": make_room}[shape](n, rng)
+    colors = (rng.rand(n, 3) * 255).astype(np.uint8)
+    picked = [int(np.argmin(np.linalg.norm(points - p, axis=1))) for p in (line_start, line_end, seed_point)]
+    return PointCloudData(points.astype(np.float32), colors), picked
+
+
+def write_ply(data_file_name, pcd):
+    records = np.empty(len(pcd.points), dtype=[("x", "<f4"), ("y", "<f4"), ("z", "<f4"),
+                                               ("red", "u1"), ("green", "u1"), ("blue", "u1"), ("alpha", "u1")])
+    records["x"], records["y"], records["z"] = np.asarray(pcd.points).T
+    records["red"], records["green"], records["blue"] = pcd.colors_u8.T
+    records["alpha"] = 255
+    with open(data_file_name, "wb") as f:
+        f.write("ply\nformat binary_little_endian 1.0\nelement vertex {}\n"
+                "property float x\nproperty float y\nproperty float z\n"
+                "property uchar red\nproperty uchar green\nproperty uchar blue\nproperty uchar alpha\n"
+                "end_header\n".format(len(records)).encode("ascii"))
+        f.write(records.tobytes())
+
+
+def cloud_cases(name, data_file_name, pcd, picked, workdir, gl):
+    '''
+    :return: dict of case name -> (setup, run), setup is the untimed preparation whose result run is called with
+    '''
+    n = len(pcd.points)
+    rng = np.random.RandomState(1)
+    some_points = np.sort(rng.choice(n, n // 4, replace=False))
+
+    def fresh_graph():
+        shutil.rmtree(data_file_name + ".atlas", ignore_errors=True)
+        return None
+
+    def fresh_store():
+        store_dir = os.path.join(workdir, "store")
+        shutil.rmtree(store_dir, ignore_errors=True)
+        segment = Segment(id=0, data_file_name=data_file_name, segment_name=name, indices=some_points.tolist())
+        return SegmentStore(store_dir), segment
+
+    cases = {
+        "graph_build": (fresh_graph, lambda _: load_neighbor_graph(data_file_name, pcd)),
+        "graph_load": (lambda: None, lambda _: load_neighbor_graph(data_file_name, pcd)),
+        "floodfill": (lambda: load_neighbor_graph(data_file_name, pcd),
+                      lambda graph: floodfill(picked, pcd, graph=graph)),
+        "crop_reserve": (lambda: None, lambda _: crop_reserve(pcd, some_points)),
+        "crop_remove": (lambda: None, lambda _: crop_remove(pcd, some_points)),
+        "ply_load": (lambda: None, lambda _: np.asarray(read_ply(data_file_name).colors)),
+        "save": (fresh_store, lambda store_segment: store_segment[0].put(store_segment[1])),
+    }
+    if gl:
+        scenes = []  # one rendered scene per process, picking does not change it
+
+        def rendered_scene():
+            if not scenes:
+                import vispy.scene
+                scene = Scene(canvas=vispy.scene.SceneCanvas(size=(800, 600), show=True))
+                scene.render(pcd)
+                scene.canvas.render()
+                scenes.append(scene)
+            return scenes[0]
+
+        cases["pick"] = (rendered_scene, lambda scene: scene.pick((400, 300)))
+    return cases
+
+
+def peak_rss(name, data_file_name, picked, workdir, gl, case):
+    '''
+    Runs one case once in this process, meant to be called in a fresh subprocess
+
+    :return: maximum resident set size of the process in bytes
+    '''
+    pcd = read_ply(data_file_name)
+    setup, run = cloud_cases(name, data_file_name, pcd, picked, workdir, gl)[case]
+    run(setup())
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024  # kilobytes everywhere but on macOS
+
+
+def measure(run, setup, repeat):
+    '''
+    :param run: function of setup()'s result that is timed
+    :param setup: untimed preparation run before every call of run
+    :return: best wall time in seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_cloud(name, data_file_name, pcd, picked, repeat, workdir, gl):
+    '''
+    :return: dict of case name -> {"time": seconds, "peak_memory": bytes}
+    '''
+    results = {}
+    context = multiprocessing.get_context("forkserver")
+    for case, (setup, run) in cloud_cases(name, data_file_name, pcd, picked, workdir, gl).items():
+        with context.Pool(1) as pool:
+            peak = pool.apply(peak_rss, (name, data_file_name, picked, workdir, gl, case))
+        results[case] = {"time": measure(run, setup, repeat), "peak_memory": peak}
+    return results
+
+
+def run_benchmarks(sizes, shapes, repeat, gl, scene_file_name="data/scene.ply"):
+    '''
+    :return: dict of "case/cloud" -> {"time": seconds, "peak_memory": bytes}
+    '''
+    results = {}
+    # the peak memory subprocesses fork from a server started while this process is still small, a child forked or
+    # spawned from here would report this process' peak as its own
+    multiprocessing.set_forkserver_preload(["benchmark"])
+    multiprocessing.forkserver.ensure_running()
+    workdir = tempfile.mkdtemp(prefix="atlas_benchmark_")
+    try:
+        clouds = []
+        if os.path.isfile(scene_file_name):
+            data_file_name = os.path.join(workdir, "scene.ply")
+            shutil.copy(scene_file_name, data_file_name)
+            pcd = read_ply(data_file_name)
+            clouds.append(("scene", data_file_name, pcd, SCENE_PICKED))
+        for shape in shapes:
+            for n in sizes:
+                pcd, picked = make_cloud(shape, n)
+                data_file_name = os.path.join(workdir, "{}_{}.ply".format(shape, n))
+                write_ply(data_file_name, pcd)
+                clouds.append(("{}_{}".format(shape, n), data_file_name, read_ply(data_file_name), picked))
+        for name, data_file_name, pcd, picked in clouds:
+            for case, result in benchmark_cloud(name, data_file_name, pcd, picked, repeat, workdir, gl).items():
+                key = "{}/{}".format(case, name)
+                results[key] = result
+                print("{:<32} {:>10.4f} s {:>10.1f} MB".format(key, result["time"], result["peak_memory"] / 2 ** 20))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    :return: list of regression messages, a case regresses if its time or peak memory grew by more than threshold
+    '''
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ("time", "peak_memory"):
+            before = baseline[key][metric]
+            if before > 0 and result[metric] > before * (1 + threshold):
+                regressions.append("{} {}: {:.4g} -> {:.4g} (+{:.0%})".format(
+                    key, metric, before, result[metric], result[metric] / before - 1))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the floodfill, crop, load, save and picking hot paths")
+    parser.add_argument("--sizes", default=",".join(str(n) for n in DEFAULT_SIZES),
+                        help="comma separated point counts of the synthetic clouds")
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="comma separated synthetic cloud shapes")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the best is kept")
+    parser.add_argument("--gl", action="store_true", help="also benchmark picking, needs a display")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative slowdown before failing")
+    parser.add_argument("--output", help="file to write the results to")
+    args = parser.parse_args(argv)
+
+    sizes = [int(float(size)) for size in args.sizes.split(",") if size]
+    shapes = [shape for shape in args.shapes.split(",") if shape]
+    results = run_benchmarks(sizes, shapes, args.repeat, args.gl)
+    if args.output:
+        with open(args.output, mode='w') as f:
+            f.write(json.dumps(results, indent=2))
+    if args.save_baseline:
+        with open(args.baseline, mode='w') as f:
+            f.write(json.dumps(results, indent=2))
+        print("Baseline saved to {}".format(args.baseline))
+        return 0
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+'''
+Process wide cache of loaded point clouds
+
+Entries are keyed by the file's path, mtime and size, so a file that changed on disk is read again. An entry holds the
+cloud and the structures derived from it (neighbor graph, spatial index, display sample, ...), and the least recently
+used entries are evicted once their total size exceeds the byte budget. Arrays memory-mapped from a file are not
+counted, the OS can drop their pages at any time.
+
+Sample usage:
+    from cloud_cache import cloud_cache
+    entry = cloud_cache.get("data/scene.ply")
+    graph = entry.derived.get("neighbor_graph")
+    cloud_cache.put_derived("data/scene.ply", "neighbor_graph", graph)
+
+The byte budget can be set with the ATLAS_CLOUD_CACHE_BYTES environment variable.
+'''
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from instrumentation import tracer
+from ply_reader import read_point_cloud
+from sidecar import file_signature
+
+DEFAULT_BYTE_BUDGET = 4 << 30
+
+
+def is_memory_mapped(array):
+    base = array
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return True
+        base = getattr(base, "base", None)
+    return False
+
+
+def estimate_nbytes(value, seen=None):
+    '''
+    :return: bytes of memory held by the numpy arrays reachable from value, each buffer counted once
+    '''
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        if is_memory_mapped(value):
+            return 0
+        owner = value
+        while isinstance(owner.base, np.ndarray):
+            owner = owner.base
+        if owner is not value and id(owner) in seen:
+            return 0
+        seen.add(id(owner))
+        return owner.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(item, seen) for item in value)
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(item, seen) for item in value.values())
+    if hasattr(value, "has_points") and hasattr(value, "has_colors"):
+        # Open3D pcd, its buffers are not numpy arrays
+        vectors = 1 + value.has_colors() + value.has_normals()
+        return len(value.points) * 3 * 8 * vectors
+    if hasattr(value, "__dict__"):
+        return sum(estimate_nbytes(item, seen) for item in vars(value).values())
+    return 0
+
+
+class CloudEntry:
+    def __init__(self, key, data_file_name, pcd):
+        self.key = key  # (path, mtime_ns, size)
+        self.data_file_name = data_file_name
+        self.pcd = pcd
+        self.derived = {}  # name -> structure derived from pcd
+        self.nbytes = estimate_nbytes(pcd)
+
+
+class CloudCache:
+    def __init__(self, byte_budget=DEFAULT_BYTE_BUDGET):
+        '''
+        :param byte_budget: total size of the entries above which the least recently used ones are evicted
+        '''
+        self.byte_budget = byte_budget
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()  # (path, mtime_ns, size) -> CloudEntry, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, data_file_name):
+        signature = file_signature(data_file_name)
+        return os.path.abspath(str(data_file_name)), signature["mtime_ns"], signature["size"]
+
+    def get(self, data_file_name, loader=read_point_cloud):
+        '''
+        :param loader: reads the cloud on a miss, called without holding the cache's lock
+        :return: CloudEntry of the file, read with loader on a miss
+        '''
+        key = self.key(data_file_name)
+        entry = self.peek(data_file_name, key)
+        if entry is not None:
+            return entry
+        with self.lock:
+            self.misses += 1
+        tracer.count("cloud_cache.misses")
+        entry = CloudEntry(key, data_file_name, loader(data_file_name))
+        with self.lock:
+            entry = self.entries.setdefault(key, entry)
+            self.entries.move_to_end(key)
+            self.evict(keep=key)
+        return entry
+
+    def peek(self, data_file_name, key=None):
+        '''
+        :return: CloudEntry of the file if it is cached, None otherwise, counted as a hit if it is
+        '''
+        try:
+            key = self.key(data_file_name) if key is None else key
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        tracer.count("cloud_cache.hits")
+        return entry
+
+    def put_derived(self, data_file_name, name, value):
+        '''
+        Attach a structure derived from a cached cloud to its entry, ignored if the cloud is not cached
+        '''
+        try:
+            key = self.key(data_file_name)
+        except OSError:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry.derived[name] = value
+            self.resize(entry)
+
+    def resize(self, entry):
+        '''
+        Recount the size of an entry after its derived structures changed, evicting others if needed
+        '''
+        with self.lock:
+            entry.nbytes = estimate_nbytes([entry.pcd, entry.derived])
+            self.evict(keep=entry.key)
+
+    def evict(self, keep=None):
+        '''
+        Evict least recently used entries until the budget is met, the entry keep is never evicted
+        '''
+        with self.lock:
+            for key in list(self.entries):
+                if self.nbytes() <= self.byte_budget:
+                    break
+                if key != keep:
+                    del self.entries[key]
+                    self.evictions += 1
+                    tracer.count("cloud_cache.evictions")
+
+    def nbytes(self):
+        with self.lock:
+            return sum(entry.nbytes for entry in self.entries.values())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return OrderedDict([("entries", len(self.entries)), ("nbytes", self.nbytes()),
+                                ("byte_budget", self.byte_budget), ("hits", self.hits), ("misses", self.misses),
+                                ("evictions", self.evictions)])
+
+
+cloud_cache = CloudCache(int(os.environ.get("ATLAS_CLOUD_CACHE_BYTES", DEFAULT_BYTE_BUDGET)))
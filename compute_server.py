@@ -0,0 +1,486 @@
+'''
+Local compute server shared by the annotation tools running on a machine
+
+The server keeps clouds and what is derived from them (neighbor graph, planar patches, grid index) resident once in
+its cloud cache, and owns the segment store, so every annotator connected to it floodfills, crops and saves against
+the same structures instead of building its own. Requests are pickled over a local socket with
+multiprocessing.connection, every connection is served by its own thread and the work is queued on a pool of worker
+threads, so at most `workers` requests compute at once and the rest wait their turn.
+
+Floodfill states stay on the server so results can be refined like local ones, the least recently used states are
+dropped past MAX_FLOODFILL_STATES.
+
+Sample usage:
+    python compute_server.py --store segments.store --workers 4
+    ATLAS_COMPUTE_SERVER=127.0.0.1:6010 python main.py
+
+    client = ComputeClient(("127.0.0.1", 6010))
+    indices = client.call("crop_box", "data/scene.ply", box_min, box_max, True)
+
+Requests are unpickled, so the server only listens on loopback addresses or a unix socket and connections are
+authenticated with a key: ATLAS_COMPUTE_AUTHKEY if it is set, otherwise the one in the key file (ATLAS_COMPUTE_KEY_FILE,
+~/.atlas_compute_key by default), which the server creates with a random key readable by its owner only.
+'''
+import argparse
+import ipaddress
+import os
+import secrets
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from cloud_cache import cloud_cache
+from custom_util import FloodfillError, FloodfillState
+from grid_index import complement, load_grid_index
+from instrumentation import tracer
+from neighbor_graph import load_neighbor_graph
+from patches import load_patch_graph
+from segment_store import SegmentStore
+
+DEFAULT_ADDRESS = "127.0.0.1:6010"
+DEFAULT_KEY_FILE = os.path.join(os.path.expanduser("~"), ".atlas_compute_key")
+MAX_FLOODFILL_STATES = 32
+
+# methods of ComputeServer clients can call, answered from the worker pool unless listed in INLINE_METHODS
+RPC_METHODS = ("load", "floodfill", "floodfill_refine", "cancel", "crop_box", "next_id", "put_raw", "put_new",
+               "delete",
+               "entries", "metadata", "read_indices", "update_metadata", "indices_version", "import_json", "stats")
+INLINE_METHODS = ("cancel", "stats")
+FLOODFILL_METHODS = ("floodfill", "floodfill_refine")  # methods whose first argument is a token cancel can stop
+
+
+class ComputeServerError(Exception):
+    pass
+
+
+def parse_address(address):
+    '''
+    :param address: "host:port" or the path of a unix socket
+    :return: address as taken by multiprocessing.connection
+    '''
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def check_loopback(address):
+    '''
+    :param address: address as taken by multiprocessing.connection, see parse_address
+    :raise ComputeServerError: if it is a host other than this machine
+    '''
+    if not isinstance(address, tuple):
+        return  # unix socket
+    host = address[0]
+    try:
+        loopback = host == "localhost" or ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback:
+        raise ComputeServerError("ERR: compute server only listens on loopback addresses, not {}".format(host or "*"))
+
+
+def authkey_from_environment(create=False):
+    '''
+    :param create: write a random key to the key file if there is none, done by the server
+    :return: ATLAS_COMPUTE_AUTHKEY, or the key in the key file
+    :raise ComputeServerError: if there is no key, or the key file can be read by other users
+    '''
+    if os.environ.get("ATLAS_COMPUTE_AUTHKEY"):
+        return os.environ["ATLAS_COMPUTE_AUTHKEY"].encode()
+    key_file = os.environ.get("ATLAS_COMPUTE_KEY_FILE", DEFAULT_KEY_FILE)
+    if create and not os.path.exists(key_file):
+        try:
+            fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+        except FileExistsError:
+            pass  # another server created it first
+    try:
+        if os.stat(key_file).st_mode & 0o077:
+            raise ComputeServerError("ERR: compute server key file {} can be read by other users".format(key_file))
+        with open(key_file) as f:
+            return f.read().strip().encode()
+    except OSError as e:
+        raise ComputeServerError("ERR: no compute server key, set ATLAS_COMPUTE_AUTHKEY or start the server to create "
+                                 "{}: {}".format(key_file, e))
+
+
+class ComputeServer:
+    def __init__(self, store_path, workers=None):
+        '''
+        :param store_path: segment store directory the server saves to and queries
+        :param workers: number of requests computed at once
+        '''
+        self.segment_store = SegmentStore(store_path)
+        self.store_lock = threading.Lock()  # the store is not thread safe
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self.build_locks = {}  # (cache key, name) -> lock held while that derived structure is built
+        self.lock = threading.Lock()  # guards build_locks, floodfill_states, cancelled, floodfills and queued
+        self.floodfill_states = OrderedDict()  # token -> FloodfillState, least recently used first
+        self.cancelled = set()  # tokens of floodfills to stop at their next expansion
+        self.floodfills = set()  # tokens of the floodfills queued or running, only those can be cancelled
+        self.queued = 0
+
+    def serve(self, address, authkey):
+        '''
+        Accept connections until interrupted
+        :raise ComputeServerError: if the address is not a loopback address or a unix socket
+        '''
+        check_loopback(address)
+        with Listener(address, backlog=64, authkey=authkey) as listener:
+            print("Compute server listening on {}".format(listener.address))
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    continue  # a client that failed authentication or hung up during the handshake
+                threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def serve_connection(self, connection):
+        '''
+        Answer the requests of one connection in order, each request is (method, args, kwargs) and each answer
+        ("ok", result) or ("error", message)
+        '''
+        with connection:
+            while True:
+                try:
+                    method, args, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if method not in RPC_METHODS:
+                        raise ComputeServerError("ERR: unknown compute server method {}".format(method))
+                    if method in INLINE_METHODS:
+                        answer = ("ok", getattr(self, method)(*args, **kwargs))
+                    else:
+                        token = args[0] if method in FLOODFILL_METHODS and args else None
+                        with self.lock:
+                            self.queued += 1
+                            if token is not None:
+                                self.floodfills.add(token)
+                        future = self.pool.submit(getattr(self, method), *args, **kwargs)
+                        try:
+                            answer = ("ok", future.result())
+                        finally:
+                            with self.lock:
+                                self.queued -= 1
+                                if token is not None:
+                                    self.floodfills.discard(token)
+                                    self.cancelled.discard(token)  # cancelled after its last expansion
+                except Exception as e:
+                    answer = ("error", str(e))
+                try:
+                    connection.send(answer)
+                except (EOFError, OSError):
+                    return
+
+    ####### CLOUDS #######
+
+    def derived(self, data_file_name, name, build):
+        '''
+        :param build: function of the CloudEntry building the structure when it is not cached yet
+        :return: (CloudEntry, structure), the structure is built once however many requests ask for it at once
+        '''
+        entry = cloud_cache.get(data_file_name)
+        with self.lock:
+            lock = self.build_locks.setdefault((entry.key, name), threading.Lock())
+        with lock:
+            if name not in entry.derived:
+                value = build(entry)
+                entry.derived[name] = value
+                cloud_cache.resize(entry)
+            return entry, entry.derived[name]
+
+    def load(self, data_file_name):
+        '''
+        Read a cloud into the cache ahead of the requests using it
+        :return: number of points
+        '''
+        if not os.path.isfile(data_file_name):
+            raise IOError("ERR: Data file at {} cannot be found".format(data_file_name))
+        return len(cloud_cache.get(data_file_name).pcd.points)
+
+    def crop_box(self, data_file_name, box_min, box_max, keep_inside=True):
+        '''
+        :return: ids of the points inside the box, or outside of it
+        '''
+        _, grid_index = self.derived(data_file_name, "grid_index",
+                                     lambda entry: load_grid_index(data_file_name, entry.pcd))
+        indices = grid_index.query_box(box_min, box_max)
+        return indices if keep_inside else complement(indices, len(grid_index))
+
+    ####### FLOODFILL #######
+
+    def floodfill(self, token, data_file_name, picked_points_id, use_patches=False, **floodfill_kwargs):
+        '''
+        Start a floodfill kept on the server as token
+        :param floodfill_kwargs: batch_size, angle_error_tolerance, boundary_thickness, allowed
+        :return: (point ids of the surface, seeds)
+        '''
+        if len(picked_points_id) != 3:
+            raise FloodfillError("ERROR: {} points is chosen, only 3 point floodfill is implemented".format(
+                len(picked_points_id)))
+        entry, graph = self.derived(data_file_name, "neighbor_graph",
+                                    lambda entry: load_neighbor_graph(data_file_name, entry.pcd))
+        patches = None
+        if use_patches:
+            _, patches = self.derived(data_file_name, "patches",
+                                      lambda entry: load_patch_graph(data_file_name, entry.pcd, graph))
+        state = FloodfillState(entry.pcd, graph, picked_points_id, patches=patches, **floodfill_kwargs)
+        return self.run_floodfill(token, state, state.start())
+
+    def floodfill_refine(self, token, name, args):
+        '''
+        Refine a floodfill kept on the server with a FloodfillState operation, e.g. ("add_seed", (id,))
+        :return: (point ids of the surface, seeds)
+        '''
+        if name not in ("add_seed", "set_angle_error_tolerance", "remove_seed"):
+            raise FloodfillError("ERR: unknown floodfill operation {}".format(name))
+        with self.lock:
+            state = self.floodfill_states.get(token)
+        if state is None:
+            raise FloodfillError("ERR: the floodfill result is no longer kept by the compute server, start over")
+        return self.run_floodfill(token, state, getattr(state, name)(*args))
+
+    def run_floodfill(self, token, state, steps):
+        with tracer.span("floodfill"):
+            for _ in steps:
+                if token in self.cancelled:
+                    with self.lock:
+                        self.cancelled.discard(token)
+                        self.floodfill_states.pop(token, None)
+                    raise FloodfillError("Floodfill cancelled")
+        with self.lock:
+            self.floodfill_states[token] = state
+            self.floodfill_states.move_to_end(token)
+            while len(self.floodfill_states) > MAX_FLOODFILL_STATES:
+                self.floodfill_states.popitem(last=False)
+        return np.asarray(state.points(), dtype=np.int64), state.seeds()
+
+    def cancel(self, token):
+        '''
+        Stop the floodfill started or refined as token at its next expansion, its state is dropped
+        '''
+        with self.lock:
+            if token in self.floodfills:
+                self.cancelled.add(token)
+            self.floodfill_states.pop(token, None)
+
+    ####### SEGMENT STORE #######
+
+    def next_id(self):
+        with self.store_lock:
+            return self.segment_store.next_id()
+
+    def put_raw(self, metadata, indices):
+        with self.store_lock:
+            self.segment_store.put_raw(metadata, indices)
+
+    def put_new(self, metadata, indices):
+        with self.store_lock:
+            return self.segment_store.put_new(metadata, indices)
+
+    def delete(self, segment_id):
+        with self.store_lock:
+            self.segment_store.delete(segment_id)
+
+    def entries(self):
+        with self.store_lock:
+            return self.segment_store.entries()
+
+    def metadata(self, segment_id):
+        with self.store_lock:
+            return self.segment_store.metadata(segment_id)
+
+    def read_indices(self, segment_id):
+        with self.store_lock:
+            return self.segment_store.read_indices(segment_id)
+
+    def update_metadata(self, segment_id, **fields):
+        with self.store_lock:
+            self.segment_store.update_metadata(segment_id, **fields)
+
+    def indices_version(self, segment_id):
+        with self.store_lock:
+            return self.segment_store.indices_version(segment_id)
+
+    def import_json(self, json_file_name):
+        with self.store_lock:
+            if len(self.segment_store) != 0:
+                return 0  # another client imported it first
+            return self.segment_store.import_json(json_file_name)
+
+    def stats(self):
+        '''
+        :return: dict of the cloud cache's stats, the number of requests waiting for or running on a worker and the
+                 number of floodfill states kept
+        '''
+        stats = cloud_cache.stats()
+        stats.update(queued=self.queued, floodfill_states=len(self.floodfill_states))
+        return stats
+
+
+class ComputeClient:
+    '''
+    Calls ComputeServer methods, safe to use from several threads: a thread takes an idle connection or opens a new one
+    '''
+
+    def __init__(self, address, authkey=None):
+        '''
+        :param address: address as taken by multiprocessing.connection, see parse_address
+        '''
+        self.address = address
+        self.authkey = authkey  # read from the environment on the first call, when None
+        self.lock = threading.Lock()
+        self.idle = []  # connections not used by any thread
+
+    def call(self, method, *args, **kwargs):
+        '''
+        :return: what the server method returned
+        :raise ComputeServerError: with the message of the error the method raised, or if the server is unreachable
+        '''
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        try:
+            if connection is None:
+                if self.authkey is None:
+                    self.authkey = authkey_from_environment()
+                connection = Client(self.address, authkey=self.authkey)
+            connection.send((method, args, kwargs))
+            status, result = connection.recv()
+        except AuthenticationError as e:
+            if connection is not None:
+                connection.close()
+            raise ComputeServerError("ERR: compute server at {} rejected the key: {}".format(self.address, e))
+        except (OSError, EOFError) as e:
+            if connection is not None:
+                connection.close()
+            raise ComputeServerError("ERR: compute server at {} is unreachable: {}".format(self.address, e))
+        with self.lock:
+            self.idle.append(connection)
+        if status == "error":
+            raise ComputeServerError(result)
+        return result
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+
+class RemoteFloodfillState:
+    '''
+    FloodfillState kept on the compute server, refined through the same operations as a local one
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.token = uuid.uuid4().hex  # names the state on the server, known before the floodfill is sent
+        self.surface = np.zeros(0, dtype=np.int64)
+        self.seed_ids = []
+
+    def points(self):
+        return self.surface
+
+    def seeds(self):
+        return self.seed_ids
+
+    def start(self, data_file_name, picked_points_id, use_patches=False, **floodfill_kwargs):
+        self.surface, self.seed_ids = self.client.call("floodfill", self.token, os.path.abspath(data_file_name),
+                                                       list(picked_points_id), use_patches, **floodfill_kwargs)
+
+    def refine(self, name, args):
+        '''
+        :param name: FloodfillState method, e.g. "add_seed"
+        '''
+        self.surface, self.seed_ids = self.client.call("floodfill_refine", self.token, name, args)
+
+    def cancel(self):
+        self.client.call("cancel", self.token)
+
+
+class RemoteSegmentStore:
+    '''
+    The compute server's segment store, with the methods of SegmentStore the annotation tool uses
+    '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def __len__(self):
+        return len(self.entries())
+
+    def next_id(self):
+        return self.client.call("next_id")
+
+    def put_raw(self, metadata, indices):
+        self.client.call("put_raw", metadata, np.asarray(indices))
+
+    def put_new(self, metadata, indices):
+        return self.client.call("put_new", metadata, np.asarray(indices))
+
+    def delete(self, segment_id):
+        self.client.call("delete", segment_id)
+
+    def entries(self):
+        return self.client.call("entries")
+
+    def metadata(self, segment_id):
+        return self.client.call("metadata", segment_id)
+
+    def read_indices(self, segment_id):
+        return self.client.call("read_indices", segment_id)
+
+    def update_metadata(self, segment_id, **fields):
+        self.client.call("update_metadata", segment_id, **fields)
+
+    def indices_version(self, segment_id):
+        return self.client.call("indices_version", segment_id)
+
+    def import_json(self, json_file_name):
+        return self.client.call("import_json", os.path.abspath(json_file_name))
+
+
+def client_from_environment():
+    '''
+    :return: ComputeClient of the server named by ATLAS_COMPUTE_SERVER, None if it is not set
+    '''
+    address = os.environ.get("ATLAS_COMPUTE_SERVER")
+    return ComputeClient(parse_address(address)) if address else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve floodfill, crop and segment store requests to annotators")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="host:port on loopback, or a unix socket path")
+    parser.add_argument("--store", default="segments.store", help="segment store directory")
+    parser.add_argument("--workers", type=int, default=None, help="number of requests computed at once")
+    parser.add_argument("--preload", nargs="*", default=[], help="point cloud files to read before serving")
+    args = parser.parse_args(argv)
+
+    address = parse_address(args.address)
+    try:
+        check_loopback(address)  # before preloading, which can take minutes
+        authkey = authkey_from_environment(create=True)
+    except ComputeServerError as e:
+        print(e)
+        return 1
+    server = ComputeServer(args.store, args.workers)
+    for data_file_name in args.preload:
+        print("Loaded {} points from {}".format(server.load(os.path.abspath(data_file_name)), data_file_name))
+    try:
+        server.serve(address, authkey)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
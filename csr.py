@@ -0,0 +1,17 @@
+'''
+Helpers for arrays in compressed sparse row form: one flat array of values and the offsets where every row starts
+'''
+import numpy as np
+
+
+def row_offsets(starts, lengths):
+    '''
+    Offsets of every value of many rows at once, without a Python loop over the rows
+    :param starts: offset of the first value of every row
+    :param lengths: number of values of every row
+    :return: flat array of offsets, the rows one after the other in the given order
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    # every value's position in the output, shifted by how far its row's start moves from the output to the values
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
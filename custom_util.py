@@ -1,7 +1,12 @@
 import numpy as np
 import open3d as o3d
+import vispy.app
 from vispy.scene import visuals
 from PyQt5.QtWidgets import *
+from instrumentation import tracer
+from neighbor_graph import NeighborGraph
+from ply_reader import point_colors
+from screen_selection import select_polygon
 # Print iterations progress
 def printProgressBar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█'):
     """
@@ -37,28 +42,32 @@ def findNearestNeighbor(pcd, pcd_tree, current_point_id, batch_size):
 
 
 def crop_remove(pcd, points_to_delete):
-    points = np.asarray(pcd.points)
-    colors = np.asarray(pcd.colors)
+    tracer.count("crop.points_removed", len(points_to_delete))
+    with tracer.span("crop_remove"):
+        points = np.asarray(pcd.points)
+        colors = np.asarray(pcd.colors)
 
-    updated_points = np.delete(points, points_to_delete, axis=0)
-    updated_color = np.delete(colors, points_to_delete, axis=0)
-    pcd_updated = o3d.geometry.PointCloud()
-    pcd_updated.points = o3d.utility.Vector3dVector(updated_points)
-    pcd_updated.colors = o3d.utility.Vector3dVector(updated_color)
-    return pcd_updated
+        updated_points = np.delete(points, points_to_delete, axis=0)
+        updated_color = np.delete(colors, points_to_delete, axis=0)
+        pcd_updated = o3d.geometry.PointCloud()
+        pcd_updated.points = o3d.utility.Vector3dVector(np.asarray(updated_points, dtype=np.float64))
+        pcd_updated.colors = o3d.utility.Vector3dVector(np.asarray(updated_color, dtype=np.float64))
+        return pcd_updated
 
 
 def crop_reserve(pcd, points_to_reserve):
-    points = np.asarray(pcd.points)
-    colors = np.asarray(pcd.colors)
+    tracer.count("crop.points_reserved", len(points_to_reserve))
+    with tracer.span("crop_reserve"):
+        points = np.asarray(pcd.points)
+        colors = np.asarray(pcd.colors)
 
-    updated_points = np.take(points, points_to_reserve, axis=0)
-    updated_color = np.take(colors, points_to_reserve, axis=0)
+        updated_points = np.take(points, points_to_reserve, axis=0)
+        updated_color = np.take(colors, points_to_reserve, axis=0)
 
-    pcd_updated = o3d.geometry.PointCloud()
-    pcd_updated.points = o3d.utility.Vector3dVector(updated_points)
-    pcd_updated.colors = o3d.utility.Vector3dVector(updated_color)
-    return pcd_updated
+        pcd_updated = o3d.geometry.PointCloud()
+        pcd_updated.points = o3d.utility.Vector3dVector(np.asarray(updated_points, dtype=np.float64))
+        pcd_updated.colors = o3d.utility.Vector3dVector(np.asarray(updated_color, dtype=np.float64))
+        return pcd_updated
 
 
 def generate_line_points(p1, p2, num_points=10000):
@@ -125,50 +134,320 @@ class FloodfillError(Exception):
     pass
 
 
-def floodfill(picked_points_id, pcd, batch_size=10, angle_error_tolerance=0.4, boundary_thickness=0.1):
+def check_angle_condition_batch(normals, seed_id, candidates, angle_error_tolerance):
+    '''
+    Vectorized check_angle_condition over an array of candidate point ids
+    :return: boolean mask, True where the candidate's normal is within tolerance of the seed's normal
+    '''
+    dots = normals[candidates].dot(normals[seed_id])
+    return np.arccos(np.clip(dots, -1, 1)) < angle_error_tolerance
+
+
+def check_distance_batch(bounding_line, coordinates, candidates, threshold=0.1):
+    '''
+    Vectorized check_distance over an array of candidate point ids
+    :return: boolean mask, True where the candidate is further than threshold away from the bounding line
+    '''
+    return distance_to_line(bounding_line, coordinates[candidates]) > threshold
+
+
+def distance_to_line(bounding_line, points):
+    '''
+    algorithm from wolfram alpha: http://mathworld.wolfram.com/Point-LineDistance3-Dimensional.html
+    :param points: (n, 3) positions
+    :return: (n,) distances of the points to the bounding line
+    '''
+    x1 = np.asarray(bounding_line.line_start)
+    x2 = np.asarray(bounding_line.line_end)
+    return np.linalg.norm(np.cross(points - x1, points - x2), axis=1) / np.linalg.norm(x2 - x1)
+
+
+def check_neighbor_condition_batch(normals, coordinates, seed_id, candidates, bounding_line, angle_error_tolerance,
+                                   boundary_thickness=0.1):
+    return check_angle_condition_batch(normals, seed_id, candidates, angle_error_tolerance) \
+           & check_distance_batch(bounding_line, coordinates, candidates, boundary_thickness)
+
+
+def floodfill(picked_points_id, pcd, batch_size=10, angle_error_tolerance=0.4, boundary_thickness=0.1, graph=None,
+              patches=None, allowed=None):
     '''
     Floodfill until a given line is hit
+
+    The whole frontier is expanded at once: one gather from the neighbor graph for all frontier points, then the angle
+    and boundary tests are evaluated as numpy masks over every candidate. Since both tests only depend on the candidate
+    itself, the region is the same as expanding one point at a time.
     :param picked_points_id: list of points that user picked
     :param pcd: the Open3D pcd file
     :param batch_size: at one time, how many points do we consider
     :param angle_error_tolerance: the err tolerance for how different the normal vector between the two points that we consider them to be on the same plane
     :param boundary_thickness: how close to the boundary do we consider a point to hit the boundary
+    :param graph: precomputed NeighborGraph of pcd, built on the fly if missing or if its k is less than batch_size
+    :param patches: PatchGraph of pcd, if given the region grows over whole patches, see FloodfillState
+    :param allowed: bool mask of the points the region may contain, e.g. LabelIndex.unlabeled_mask(), None for all
     :return: resulting surface are within the floodfilling reach of the current boudning line and seed point
     '''
+    with tracer.span("floodfill"):
+        steps = list(floodfill_steps(picked_points_id, pcd, batch_size, angle_error_tolerance, boundary_thickness,
+                                     graph, patches, allowed))
+        return np.sort(np.concatenate(steps)).tolist()
+
+
+def floodfill_steps(picked_points_id, pcd, batch_size=10, angle_error_tolerance=0.4, boundary_thickness=0.1,
+                    graph=None, patches=None, allowed=None):
+    '''
+    Same as floodfill, but yields the points added by every frontier expansion as they are found, so that callers can
+    report progress, show partial results or stop early
+    :return: generator of arrays of point ids, one per expansion, no id is yielded twice
+    '''
     if len(picked_points_id) != 3:
         raise FloodfillError(
             "ERROR: {} points is chosen, only 3 point floodfill is implemented".format(len(picked_points_id)))
     # set up
-    pcd_tree = o3d.geometry.KDTreeFlann(pcd)
-    pcd.estimate_normals()
-    normals = np.asarray(pcd.normals)
-    coordinates = np.asarray(pcd.points)
-
-    bounding_line = BoundingLine(coordinates[picked_points_id[0]], coordinates[picked_points_id[1]])
-    seed_id = picked_points_id[2]
-    points_to_check = {seed_id}
-
-    surface = set()
-
-    counter = 0
-    while len(points_to_check) != 0:
-        current_point_id = points_to_check.pop()
-        # find neighbors
-        [k, idx, _] = findNearestNeighbor(pcd, pcd_tree, current_point_id,
-                                          batch_size)
-        neighbors = set(idx[1:])
-        # parse the neighbors so that it does not contain points that are already in surface
-        neighbors = neighbors.difference(surface)
-
-        for current_neighbor in neighbors:
-            # if angle_between(normals[seed_id], normals[n]) < angle_error_tolerance:
-            if check_neighbor_condition(normals, coordinates, seed_id, current_neighbor, bounding_line,
-                                        angle_error_tolerance):
-                points_to_check.add(current_neighbor)
-                surface.add(current_neighbor)
-        counter += 1
-
-    return list(surface)
+    if graph is None or graph.k < batch_size:
+        graph = NeighborGraph.from_pcd(pcd, batch_size)
+    state = FloodfillState(pcd, graph, picked_points_id, batch_size, angle_error_tolerance, boundary_thickness,
+                           patches, allowed)
+    for accepted in state.start():
+        yield accepted
+
+
+class FloodfillState:
+    '''
+    A floodfill result that keeps what is needed to refine it without starting over: the points tested so far, the
+    points on the surface, the seed normal and the bounding line.
+
+    Refinements are operations: adding a seed expands only from that seed, relaxing the angle tolerance retests only
+    the points that were rejected so far. Each point records the operation that tested it and the operation that
+    added it to the surface, so undoing operations resets the records of the later ones without recomputing anything.
+
+    Sample usage:
+        state = FloodfillState(pcd, graph, picked_points_id)
+        list(state.start())
+        list(state.add_seed(extra_seed_id))
+        list(state.set_angle_error_tolerance(0.5))
+        surface = state.points()
+    '''
+
+    def __init__(self, pcd, graph, picked_points_id, batch_size=10, angle_error_tolerance=0.4, boundary_thickness=0.1,
+                 patches=None, allowed=None):
+        '''
+        :param picked_points_id: the bounding line's two points and the first seed, whose normal every point is
+                                 compared against, also for later seeds
+        :param patches: PatchGraph the first seed grows over, also when replayed, other refinements work point by point
+        :param allowed: bool mask of the points the surface may contain, None for all
+        '''
+        self.coordinates = np.asarray(pcd.points)
+        self.graph = graph
+        self.patches = patches
+        self.batch_size = batch_size
+        self.angle_error_tolerance = angle_error_tolerance
+        self.boundary_thickness = boundary_thickness
+        self.allowed = allowed
+        self.bounding_line = BoundingLine(self.coordinates[picked_points_id[0]],
+                                          self.coordinates[picked_points_id[1]])
+        self.seed_id = picked_points_id[2]
+        self.checked_by = np.zeros(len(self.coordinates), dtype=np.int32) # operation number that tested a point
+        self.added_by = np.zeros(len(self.coordinates), dtype=np.int32) # operation number that added a point
+        self.operations = [] # (kind, value, angle_error_tolerance before), operation number is index + 1
+
+    def points(self):
+        return np.flatnonzero(self.added_by).tolist()
+
+    def seeds(self):
+        return [value for kind, value, _ in self.operations if kind == "seed"]
+
+    def start(self):
+        '''
+        Floodfill from the first seed
+        :return: generator of arrays of added point ids, see floodfill_steps
+        '''
+        return self.add_seed(self.seed_id)
+
+    def add_seed(self, seed_id):
+        '''
+        Grow the surface from another seed, only points that were never tested are tested
+        '''
+        return self.apply("seed", seed_id)
+
+    def set_angle_error_tolerance(self, angle_error_tolerance):
+        '''
+        Relaxing the tolerance retests the rejected points and expands from the ones that pass now, they all touch the
+        surface since they were reached from it. Tightening it can remove points from anywhere, so the operations are
+        rolled back and replayed with the new tolerance. A floodfill over patches is always replayed: whole patches
+        were rejected by their bounds, so the points along the surface were not all tested and cannot be retested.
+        '''
+        if angle_error_tolerance >= self.angle_error_tolerance and self.patches is None:
+            return self.apply("angle_error_tolerance", angle_error_tolerance)
+        return self.replay_from(0, angle_error_tolerance=angle_error_tolerance)
+
+    def remove_seed(self, seed_id):
+        '''
+        Undo the operation that added a seed, the operations after it are replayed, expanding only their own area
+        '''
+        kinds = [(kind, value) for kind, value, _ in self.operations]
+        return self.replay_from(kinds.index(("seed", seed_id)), skip_first=True)
+
+    def undo(self):
+        '''
+        Undo the last operation
+        '''
+        self.rollback(len(self.operations) - 1)
+
+    def rollback(self, operation_index):
+        '''
+        Undo every operation from operation_index on
+        '''
+        if operation_index < 0 or operation_index >= len(self.operations):
+            return
+        self.angle_error_tolerance = self.operations[operation_index][2]
+        self.checked_by[self.checked_by > operation_index] = 0
+        self.added_by[self.added_by > operation_index] = 0
+        del self.operations[operation_index:]
+
+    def replay_from(self, operation_index, skip_first=False, angle_error_tolerance=None):
+        '''
+        Roll back to operation_index right away, then apply the rolled back operations again
+        :param skip_first: drop the operation at operation_index instead of applying it again
+        :param angle_error_tolerance: tolerance to replay with instead of the one the operations had
+        :return: generator of arrays of added point ids, the operations are applied as it is iterated
+        '''
+        replayed = self.operations[operation_index + 1 if skip_first else operation_index:]
+        self.rollback(operation_index)
+        if angle_error_tolerance is not None:
+            self.angle_error_tolerance = angle_error_tolerance
+            replayed = [operation for operation in replayed if operation[0] != "angle_error_tolerance"]
+        return self.replay(replayed)
+
+    def replay(self, operations):
+        for kind, value, _ in operations:
+            for accepted in self.apply(kind, value):
+                yield accepted
+
+    def apply(self, kind, value):
+        '''
+        Record an operation right away
+        :return: generator of arrays of added point ids, the surface grows as it is iterated
+        '''
+        self.operations.append((kind, value, self.angle_error_tolerance))
+        stamp = len(self.operations)
+        if kind == "seed" and self.patches is not None and stamp == 1:
+            return self.added(self.expand_over_patches(value, stamp), stamp)
+        if kind == "seed":
+            return self.added(self.expand(np.array([value], dtype=np.int64), stamp), stamp)
+        self.angle_error_tolerance = value
+        rejected = np.flatnonzero((self.checked_by != 0) & (self.added_by == 0))
+        accepted = rejected[self.test(rejected)]
+        self.added_by[accepted] = stamp
+        return self.added(self.expand(accepted, stamp, first=accepted), stamp)
+
+    def added(self, steps, stamp):
+        for accepted in steps:
+            self.added_by[accepted] = stamp
+            yield accepted
+
+    def expand_over_patches(self, seed_id, stamp):
+        '''
+        Floodfill over the PatchGraph: patches whose points all pass the tests are added whole and grown over the
+        patch adjacency, points are only tested one by one inside patches where the bounds are inconclusive, typically
+        the few patches along the bounding line or around edges and corners. Patches added whole are not checked for
+        being connected inside, so the region can differ from the point by point floodfill by such pieces.
+        '''
+        patches = self.patches
+        checked_by = self.checked_by
+        patch_state = classify_patches(patches, self.graph.normals[self.seed_id], self.bounding_line,
+                                 self.angle_error_tolerance, self.boundary_thickness)
+        if self.allowed is not None:
+            # patches with points the surface may not contain are tested point by point
+            has_excluded = np.bincount(patches.patch_of[~self.allowed], minlength=len(patches)) > 0
+            patch_state[(patch_state == PATCH_ACCEPT) & has_excluded] = PATCH_REFINE
+        in_region = np.zeros(len(patches), dtype=bool)
+        patch_frontier = np.array([patches.patch_of[seed_id]], dtype=np.int64)
+        if patch_state[patch_frontier[0]] == PATCH_ACCEPT:
+            point_frontier = np.zeros(0, dtype=np.int64)
+        else:
+            patch_frontier = patch_frontier[:0]
+            point_frontier = np.array([seed_id], dtype=np.int64)
+
+        while len(patch_frontier) != 0 or len(point_frontier) != 0:
+            # grow over whole patches as far as they go
+            added_patches = []
+            while len(patch_frontier) != 0:
+                patch_frontier = np.unique(patch_frontier)
+                patch_frontier = patch_frontier[~in_region[patch_frontier]]
+                in_region[patch_frontier] = True
+                added_patches.append(patch_frontier)
+                tracer.count("floodfill.patches_visited", len(patch_frontier))
+                next_patches = np.unique(patches.neighbors(patch_frontier))
+                patch_frontier = next_patches[(patch_state[next_patches] == PATCH_ACCEPT) & ~in_region[next_patches]]
+            if added_patches:
+                added_patches = np.concatenate(added_patches)
+                added_points = patches.points_of(added_patches)
+                checked_by[added_points] = stamp
+                yield added_points
+                # only the points of added patches that touch a patch to refine can reach new points
+                adjacency_lengths = np.diff(patches.adjacency_indptr)[added_patches]
+                touches_refine = np.zeros(len(added_patches), dtype=bool)
+                neighbor_state = patch_state[patches.neighbors(added_patches)]
+                np.logical_or.at(touches_refine, np.repeat(np.arange(len(added_patches)), adjacency_lengths),
+                                 neighbor_state == PATCH_REFINE)
+                point_frontier = np.concatenate([point_frontier, patches.points_of(added_patches[touches_refine])])
+
+            # test the points of patches to refine one by one
+            if len(point_frontier) != 0:
+                candidates = np.unique(self.graph.neighbors(point_frontier, self.batch_size - 1))
+                candidates = candidates[checked_by[candidates] == 0]
+                candidate_state = patch_state[patches.patch_of[candidates]]
+                # reaching a point of a patch that is accepted whole adds that patch
+                patch_frontier = np.unique(patches.patch_of[candidates[candidate_state == PATCH_ACCEPT]])
+                checked_by[candidates[candidate_state == PATCH_REJECT]] = stamp  # rejected by their patch's bounds
+                candidates = candidates[candidate_state == PATCH_REFINE]
+                checked_by[candidates] = stamp
+                accepted = candidates[self.test(candidates)]
+                tracer.count("floodfill.knn_queries", len(point_frontier))
+                tracer.count("floodfill.points_visited", len(candidates))
+                point_frontier = accepted
+                yield accepted
+
+    def test(self, candidates):
+        passed = check_neighbor_condition_batch(self.graph.normals, self.coordinates, self.seed_id, candidates,
+                                                self.bounding_line, self.angle_error_tolerance, self.boundary_thickness)
+        return passed if self.allowed is None else passed & self.allowed[candidates]
+
+    def expand(self, frontier, stamp, first=None):
+        '''
+        Point by point expansion, every frontier point's neighbors that were never tested are tested
+        :param first: points to yield before expanding
+        '''
+        if first is not None:
+            yield first
+        while len(frontier) != 0:
+            candidates = np.unique(self.graph.neighbors(frontier, self.batch_size - 1))
+            candidates = candidates[self.checked_by[candidates] == 0]
+            self.checked_by[candidates] = stamp
+            accepted = candidates[self.test(candidates)]
+            tracer.count("floodfill.knn_queries", len(frontier))
+            tracer.count("floodfill.points_visited", len(candidates))
+            frontier = accepted
+            yield accepted
+
+
+PATCH_REJECT = 0 # no point of the patch can pass the floodfill tests
+PATCH_ACCEPT = 1 # every point of the patch passes the floodfill tests
+PATCH_REFINE = 2 # the patch has to be tested point by point
+
+
+def classify_patches(patches, seed_normal, bounding_line, angle_error_tolerance, boundary_thickness):
+    '''
+    Bound the floodfill tests of every point of every patch by the patch's normal spread and radius
+    :return: (p,) array of PATCH_REJECT, PATCH_ACCEPT or PATCH_REFINE
+    '''
+    angle = np.arccos(np.clip(np.asarray(patches.normal).dot(seed_normal), -1, 1))
+    distance = distance_to_line(bounding_line, np.asarray(patches.centroid))
+    all_pass = (angle + patches.normal_spread < angle_error_tolerance) \
+               & (distance - patches.radius > boundary_thickness)
+    none_pass = (angle - patches.normal_spread >= angle_error_tolerance) \
+                | (distance + patches.radius <= boundary_thickness)
+    return np.where(all_pass, PATCH_ACCEPT, np.where(none_pass, PATCH_REJECT, PATCH_REFINE))
 
 
 class Scene:
@@ -181,6 +460,21 @@ class Scene:
         self.marker = marker # the markers(points) of the current view
         self.pcd = pcd # the Open3D representation of the markers
         self.point_size = point_size # desired point size to be rendered
+        self.picking_marker = None # hidden copy of marker colored by point id, only drawn while picking
+        self.selection_marker = None # overlay of the points picked by the user
+        self.displayed_count = 0 # number of points in marker
+        self.display_indices = None # pcd point id of every point in marker, None if marker holds all of pcd in order
+        self.octree = None # lod.Octree the displayed points are streamed from, None if all points are drawn
+        self.point_budget = 0 # maximum number of points drawn from the octree
+        self.lod_timer = None # delays reloading octree nodes until the camera stops moving
+        self.lod_camera_state = None # camera state the displayed octree nodes were selected for
+        self.marker_size = point_size # point size marker was last drawn with
+        self.point_colors = None # colors of the points in marker before highlighting
+        self.highlights = [] # (pcd point ids, color) pairs drawn over the colors of pcd, kept across LOD updates
+        self.display_order = None # argsort of display_indices, built when needed
+        self.display_sorted_ids = None # display_indices in ascending order, searched to find the rows of point ids
+        self.highlighted_rows = np.zeros(0, dtype=np.int64) # positions in marker recolored by the highlights
+        self.outline = None # line drawn in canvas pixels along a rectangle or lasso being dragged
 
     def clear(self):
         '''
@@ -188,43 +482,286 @@ class Scene:
         :return: True if the scene sucessfully cleared, raise error otherwise
         '''
         try:
+            if self.octree is not None:
+                self.canvas.events.draw.disconnect(self.on_draw_lod)
+                self.lod_timer.stop()
             if self.view:
                 self.canvas.central_widget.remove_widget(self.view)
+            if self.outline is not None:
+                self.outline.parent = None
+            self.outline = None
             self.marker = None
+            self.picking_marker = None
+            self.selection_marker = None
+            self.displayed_count = 0
+            self.display_indices = None
+            self.point_colors = None
+            self.highlights = []
+            self.display_order = None
+            self.display_sorted_ids = None
+            self.highlighted_rows = np.zeros(0, dtype=np.int64)
+            self.octree = None
+            self.lod_timer = None
+            self.lod_camera_state = None
             self.pcd = None
             self.view = None
             return True
         except:
             raise Scene.SceneError("Unable to clear")
 
-    def render(self, pcd=None, camera_mode='turntable', point_size=0, auto_clear=True):
+    def render(self, pcd=None, camera_mode='turntable', point_size=0, auto_clear=True, indices=None):
         '''
         Render the new pcd
         :param pcd: the new Open3D pcd data
         :param camera_mode: camera's mode
         :param point_size: each point's point size
         :param auto_clear: True if clear the scene before rendering, false otherwise
+        :param indices: ids of the points of pcd to draw, None to draw all of them. The scene keeps referring to pcd,
+                        so picking and selection use pcd's point ids and pcd is never copied
         :return:
         '''
         if auto_clear:
             self.clear()
         point_size = self.point_size if point_size == 0 else point_size
+        try:
+            with tracer.span("scene.render"):
+                self.pcd = pcd
+                self.add_view(camera_mode)
+                if indices is None:
+                    self.set_points(np.asarray(pcd.points), np.asarray(pcd.colors), point_size)
+                else:
+                    indices = np.asarray(indices, dtype=np.int64)
+                    self.set_points(np.asarray(pcd.points)[indices], point_colors(pcd, indices), point_size, indices)
+            return True
+        except:
+            raise Scene.SceneError("Unable to render")
+
+    def render_lod(self, pcd, octree, point_budget=2000000, camera_mode='turntable', point_size=0, auto_clear=True):
+        '''
+        Render the pcd by streaming octree nodes, only the nodes that are large on screen for the current camera are
+        drawn, up to point_budget points. The nodes are reselected whenever the camera stops moving.
+        :param pcd: the pcd the octree was built from, picking and selection still refer to its point ids
+        :param octree: lod.Octree of pcd
+        :param point_budget: maximum number of points drawn at once
+        '''
+        if auto_clear:
+            self.clear()
+        point_size = self.point_size if point_size == 0 else point_size
         try:
             self.pcd = pcd
-            self.view = self.canvas.central_widget.add_view()
-            self.view.parent = self.canvas.scene
-            self.view.camera = camera_mode
-            points = np.asarray(pcd.points)
-            colors = np.asarray(pcd.colors)
-
-            self.marker = visuals.Markers()
-            self.marker.set_gl_state('translucent', blend=True, depth_test=True)
-            self.marker.set_data(points, edge_color=colors, face_color=colors, size=point_size)
-            self.view.add(self.marker)
+            self.add_view(camera_mode)
+            self.octree = octree
+            self.point_budget = point_budget
+            # start from the root nodes so the camera can fit the whole cloud
+            positions, colors, indices = octree.gather(octree.roots)
+            self.set_points(positions, colors, point_size, indices)
+            self.view.camera.set_range()
+            self.lod_timer = vispy.app.Timer(0.2, connect=self.update_lod, iterations=1)
+            self.canvas.events.draw.connect(self.on_draw_lod)
             return True
         except:
             raise Scene.SceneError("Unable to render")
 
+    def on_draw_lod(self, event):
+        if self.lod_camera_state != self.view.camera.get_state():
+            self.lod_timer.start()
+
+    def update_lod(self, event=None):
+        '''
+        Reselect the octree nodes for the current camera and upload their points
+        '''
+        with tracer.span("scene.update_lod"):
+            self.lod_camera_state = self.view.camera.get_state()
+            transform = self.marker.get_transform('visual', 'canvas')
+            nodes = self.octree.select_nodes(transform, self.canvas.size, self.point_budget)
+            positions, colors, indices = self.octree.gather(nodes)
+            self.set_points(positions, colors, self.marker_size, indices)
+
+    def add_view(self, camera_mode):
+        '''
+        Create the view with an empty marker, picking marker and selection overlay
+        '''
+        self.view = self.canvas.central_widget.add_view()
+        self.view.parent = self.canvas.scene
+        self.view.camera = camera_mode
+
+        self.marker = visuals.Markers()
+        self.marker.set_gl_state('translucent', blend=True, depth_test=True)
+        self.view.add(self.marker)
+
+        # uploaded once per set_points, picking then only toggles visibility and reads back a few pixels
+        self.picking_marker = visuals.Markers()
+        self.picking_marker.set_gl_state(blend=False, depth_test=True)
+        self.picking_marker.antialias = 0
+        self.picking_marker.visible = False
+        self.view.add(self.picking_marker)
+
+        self.selection_marker = visuals.Markers()
+        self.selection_marker.set_gl_state('translucent', depth_test=False)
+        self.selection_marker.visible = False
+        self.view.add(self.selection_marker)
+
+    def set_points(self, points, colors, point_size, display_indices=None):
+        '''
+        Upload the points to draw
+        :param display_indices: pcd point id of every point, None if points are all of pcd in order
+        '''
+        self.marker.set_data(points, edge_color=colors, face_color=colors, size=point_size)
+        ids = Scene.point_ids_to_colors(np.arange(len(points)))
+        self.picking_marker.set_data(points, edge_color=ids, face_color=ids, size=point_size)
+        # positions and colors of both markers, vispy uploads them as float32
+        tracer.count("scene.gpu_bytes_uploaded", 2 * len(points) * (3 + 4 + 4) * 4)
+        self.marker_size = point_size
+        self.displayed_count = len(points)
+        self.display_indices = display_indices
+        self.point_colors = colors
+        self.display_order = None
+        self.display_sorted_ids = None
+        self.highlighted_rows = np.zeros(0, dtype=np.int64)
+        if self.highlights:
+            self.apply_highlights()
+
+    def highlight(self, highlights):
+        '''
+        Color points of pcd, replacing the previous highlights. Only the colors of the existing marker change, and only
+        the rows between the first and last changed point are uploaded again.
+        :param highlights: list of (pcd point ids, color) pairs, later pairs are drawn over earlier ones, empty to clear
+        '''
+        self.highlights = list(highlights)
+        if self.marker is not None:
+            self.apply_highlights()
+
+    def apply_highlights(self):
+        # vispy 0.5 Markers keep their interleaved vertex data in _data and upload it through _vbo, there is no public
+        # way to change the colors without setting the positions again
+        data = self.marker._data
+        if data is None:
+            return
+        restored = self.highlighted_rows
+        point_colors = np.asarray(self.point_colors)[restored].astype(np.float32)  # only the restored rows
+        colors = np.ones((len(restored), 4), dtype=np.float32)
+        colors[:, :point_colors.shape[1]] = point_colors
+        data['a_fg_color'][restored] = colors
+        data['a_bg_color'][restored] = colors
+        rows = []
+        for point_ids, color in self.highlights:
+            highlighted = self.display_rows(point_ids)
+            data['a_fg_color'][highlighted] = color
+            data['a_bg_color'][highlighted] = color
+            rows.append(highlighted)
+        self.highlighted_rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        changed = np.concatenate([restored, self.highlighted_rows])
+        if len(changed) != 0:
+            first, last = int(changed.min()), int(changed.max()) + 1
+            self.marker._vbo.set_subdata(data[first:last], offset=first)
+            tracer.count("scene.gpu_bytes_uploaded", data[first:last].nbytes)
+            self.marker.update()
+
+    def display_rows(self, point_ids):
+        '''
+        :return: positions in marker of the given pcd points, points that are not drawn are left out
+        '''
+        point_ids = np.asarray(point_ids, dtype=np.int64)
+        if self.display_indices is None:
+            return point_ids[point_ids < self.displayed_count]
+        if len(self.display_indices) == 0:
+            return np.zeros(0, dtype=np.int64)
+        # sized by the drawn points, a lookup over all of pcd would be rebuilt for every LOD update of a huge cloud
+        if self.display_order is None:
+            self.display_order = np.argsort(self.display_indices, kind='mergesort')
+            self.display_sorted_ids = np.asarray(self.display_indices, dtype=np.int64)[self.display_order]
+        positions = np.minimum(np.searchsorted(self.display_sorted_ids, point_ids), len(self.display_sorted_ids) - 1)
+        return self.display_order[positions[self.display_sorted_ids[positions] == point_ids]]
+
+    def pick(self, pos, radius=10):
+        '''
+        Find the point under a position on the canvas
+        :param pos: canvas position, e.g. the pos of a mouse event
+        :param radius: half size in pixels of the square around pos that is searched if no point is right under pos
+        :return: id of the picked point, None if there is no point around pos
+        '''
+        if self.picking_marker is None:
+            return None
+        x, y = self.canvas.transforms.canvas_transform.map(pos)[:2]
+        selection_visible = self.selection_marker.visible
+        try:
+            self.marker.visible = False
+            self.selection_marker.visible = False
+            self.picking_marker.visible = True
+            with tracer.span("scene.pick"):
+                img = self.canvas.render((int(x) - radius, int(y) - radius, 2 * radius + 1, 2 * radius + 1),
+                                         bgcolor=(0, 0, 0, 0))
+        finally:
+            self.picking_marker.visible = False
+            self.selection_marker.visible = selection_visible
+            self.marker.visible = True
+        # We pick the pixel directly under the click, unless it is
+        # zero, in which case we look for the most common nonzero
+        # pixel value in the square region centered on the click.
+        idxs = np.ascontiguousarray(img).ravel().view(np.uint32)
+        idx = idxs[len(idxs) // 2]
+        if idx == 0:
+            idxs = idxs[idxs != 0]
+            if len(idxs) == 0:
+                return None
+            values, counts = np.unique(idxs, return_counts=True)
+            idx = values[np.argmax(counts)]
+        if idx > self.displayed_count:
+            return None
+        idx = int(idx) - 1
+        return idx if self.display_indices is None else int(self.display_indices[idx])
+
+    def select_polygon(self, polygon, depth_cull=False):
+        '''
+        Find the points of pcd inside a polygon on the canvas, including the ones the octree or voxel sample left out
+        :param polygon: (m, 2) vertices in canvas pixels, e.g. the trail of a mouse drag
+        :param depth_cull: leave out the points hidden behind other selected points
+        :return: sorted ids of the selected points
+        '''
+        if self.marker is None:
+            return np.zeros(0, dtype=np.int64)
+        transform = self.marker.get_transform('visual', 'canvas')
+        return select_polygon(np.asarray(self.pcd.points), transform, polygon, depth_cull, self.marker_size)
+
+    def show_outline(self, polygon, color=(1, 1, 0, 1)):
+        '''
+        Draw a closed line on top of the scene
+        :param polygon: (m, 2) vertices in canvas pixels, empty to hide the line
+        '''
+        if len(polygon) < 2:
+            if self.outline is not None:
+                self.outline.visible = False
+            return
+        polygon = np.asarray(polygon, dtype=np.float32)
+        if self.outline is None:
+            self.outline = visuals.Line(parent=self.canvas.scene, method='gl')
+        self.outline.set_data(np.concatenate([polygon, polygon[:1]]), color=color)
+        self.outline.visible = True
+
+    def show_selection(self, point_ids, color=(1, 0, 0, 1), size_scale=2):
+        '''
+        Draw the given points on top of the scene, only the selected points are uploaded
+        :param point_ids: ids of the points to highlight, empty to hide the overlay
+        '''
+        if self.selection_marker is None:
+            return
+        if len(point_ids) == 0:
+            self.selection_marker.visible = False
+            return
+        points = np.asarray(self.pcd.points)[np.asarray(point_ids)]
+        tracer.count("scene.gpu_bytes_uploaded", len(points) * (3 + 4 + 4) * 4)
+        self.selection_marker.set_data(points, edge_color=color, face_color=color,
+                                       size=self.point_size * size_scale)
+        self.selection_marker.visible = True
+
+    @staticmethod
+    def point_ids_to_colors(point_ids):
+        '''
+        Encode point ids as RGBA colors, the id + 1 is written so that 0 stays free for the background
+        '''
+        ids = (np.asarray(point_ids, dtype=np.uint32) + 1).view(np.uint8).reshape(-1, 4)
+        return np.divide(ids, 255, dtype=np.float32)
+
     class SceneError(Exception):
         pass
 
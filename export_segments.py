@@ -0,0 +1,233 @@
+'''
+Bulk export of the segments of a store as per point labels
+
+For every cloud the segments were made on, one of:
+    ply      -- <cloud>.labeled.ply, the cloud's vertices with two int properties added: label, the index of the
+                segment's type class in classes.json, and instance, the segment's id
+    npy      -- <cloud>.labels.npy and <cloud>.instances.npy, int32 arrays of the same values, one per point
+    segments -- <cloud>/<segment id>.ply, the vertices of every segment on its own
+Points no segment contains are labeled -1, a point in several segments is labeled with the one saved last. Outputs
+are written under the output directory at the cloud's path relative to the common directory of all clouds.
+
+Clouds are fanned out over a process pool, largest first. A worker holds the label and instance arrays of its cloud,
+8 bytes per point, and streams the vertices through in chunks: the records of a binary PLY are copied as raw bytes
+from the memory-mapped file with the label columns appended, so memory stays bounded by the chunk size and the work
+is copying and disk I/O. Clouds in other formats are read whole through Open3D and written with positions and colors.
+
+Sample usage:
+    python export_segments.py segments.store export
+    python export_segments.py segments.store export --format npy --workers 8 --classes Wall Floor Ceiling Door
+'''
+import argparse
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from label_index import UNLABELED
+from ply_reader import PlyFormatError, map_ply_vertices, ply_header, read_point_cloud
+from segment_store import SegmentStore
+
+DEFAULT_CLASSES = ("Wall", "Floor", "Ceiling")  # in the order of the saving dialog
+DEFAULT_CHUNK_SIZE = 1 << 20
+EXPORT_FORMATS = ("ply", "npy", "segments")
+
+# segment store this worker process last read indices from
+_loaded_store = {"path": None, "store": None}
+
+
+def open_store(store_path):
+    if _loaded_store["path"] != store_path:
+        _loaded_store.update(path=store_path, store=SegmentStore(store_path))
+    return _loaded_store["store"]
+
+
+def vertex_records(data_file_name):
+    '''
+    :return: (structured array of the vertex records, (n, record size) uint8 view of their bytes), memory-mapped for
+             binary PLYs, built from the positions and colors otherwise
+    '''
+    try:
+        records, _, _ = map_ply_vertices(data_file_name)
+    except PlyFormatError:
+        pcd = read_point_cloud(data_file_name)
+        points = np.asarray(pcd.points)
+        fields = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+        if pcd.has_colors():
+            fields += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+        records = np.empty(len(points), dtype=fields)
+        for axis, name in enumerate("xyz"):
+            records[name] = points[:, axis]
+        if pcd.has_colors():
+            colors = np.round(np.asarray(pcd.colors) * 255).astype(np.uint8)
+            for channel, name in enumerate(("red", "green", "blue")):
+                records[name] = colors[:, channel]
+    return records, records.view(np.uint8).reshape(len(records), records.dtype.itemsize)
+
+
+def label_arrays(store, segments, count):
+    '''
+    :param segments: list of (segment id, class label) in the order they were saved
+    :param count: number of points of the cloud
+    :return: (labels, instances) int32 arrays, one entry per point
+    '''
+    labels = np.full(count, UNLABELED, dtype=np.int32)
+    instances = np.full(count, UNLABELED, dtype=np.int32)
+    for segment_id, label in segments:
+        indices = store.read_indices(segment_id)
+        if len(indices) and int(indices.max()) >= count:
+            raise ValueError("ERR: segment {} has points past the end of its cloud".format(segment_id))
+        labels[indices] = label
+        instances[indices] = segment_id
+    return labels, instances
+
+
+def write_labeled_ply(file_name, records, raw, labels, instances, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Write the vertex records with label and instance properties appended, chunk_size records at a time
+    '''
+    byte_order = records.dtype.fields["x"][0].str[0]
+    int32 = np.dtype(byte_order + "i4")
+    dtype = np.dtype(records.dtype.descr + [("label", int32.str), ("instance", int32.str)])
+    size = records.dtype.itemsize
+    with open(file_name, "wb") as f:
+        f.write(ply_header(len(records), dtype, ["label: index into classes.json, instance: segment id"]))
+        for start in range(0, len(records), chunk_size):
+            end = min(start + chunk_size, len(records))
+            chunk = np.empty((end - start, dtype.itemsize), dtype=np.uint8)
+            chunk[:, :size] = raw[start:end]
+            chunk[:, size:size + 4] = labels[start:end].astype(int32).view(np.uint8).reshape(-1, 4)
+            chunk[:, size + 4:] = instances[start:end].astype(int32).view(np.uint8).reshape(-1, 4)
+            chunk.tofile(f)
+
+
+def write_segment_ply(file_name, records, raw, indices, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Write the vertex records of the given points, chunk_size records at a time
+    '''
+    indices = np.unique(indices)
+    with open(file_name, "wb") as f:
+        f.write(ply_header(len(indices), records.dtype))
+        for start in range(0, len(indices), chunk_size):
+            raw[indices[start:start + chunk_size]].tofile(f)
+
+
+def export_file(store_path, data_file_name, segments, output_base, export_format, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Export the segments of one cloud, in a worker process
+    :param segments: list of (segment id, class label) in the order they were saved
+    :param output_base: output path without extension
+    :return: (list of written files, None) or (None, error message)
+    '''
+    try:
+        store = open_store(store_path)
+        records, raw = vertex_records(data_file_name)
+        os.makedirs(os.path.dirname(output_base), exist_ok=True)
+        if export_format == "segments":
+            os.makedirs(output_base, exist_ok=True)
+            written = []
+            for segment_id, _ in segments:
+                written.append(os.path.join(output_base, "{}.ply".format(segment_id)))
+                write_segment_ply(written[-1], records, raw, store.read_indices(segment_id), chunk_size)
+            return written, None
+        labels, instances = label_arrays(store, segments, len(records))
+        if export_format == "npy":
+            written = [output_base + ".labels.npy", output_base + ".instances.npy"]
+            np.save(written[0], labels)
+            np.save(written[1], instances)
+            return written, None
+        written = [output_base + ".labeled.ply"]
+        if os.path.abspath(written[0]) == os.path.abspath(data_file_name):
+            raise ValueError("ERR: export would overwrite {}".format(data_file_name))
+        write_labeled_ply(written[0], records, raw, labels, instances, chunk_size)
+        return written, None
+    except Exception as e:
+        return None, str(e)
+
+
+def class_labels(entries, classes=DEFAULT_CLASSES):
+    '''
+    :return: list of class names, the given ones first and then the other type classes of the entries as they come
+    '''
+    classes = list(classes)
+    for metadata in entries:
+        if metadata.get("type_class") is not None and metadata["type_class"][0] not in classes:
+            classes.append(metadata["type_class"][0])
+    return classes
+
+
+def export_store(segment_store, output_dir, export_format="ply", classes=DEFAULT_CLASSES, workers=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Export the segments of a store grouped by cloud, and the class names to output_dir/classes.json
+    :return: generator of (data file name, list of written files or None, error message or None) in completion order
+    '''
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("ERR: unknown export format {}".format(export_format))
+    workers = workers or os.cpu_count() or 1
+    entries = segment_store.entries()
+    classes = class_labels(entries, classes)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "classes.json"), "w") as f:
+        json.dump(classes, f)
+
+    segments_by_file = OrderedDict()
+    for metadata in entries:
+        if metadata.get("data_file_name") is None:
+            yield None, None, "ERR: segment {} has no data file".format(metadata["id"])
+            continue
+        label = classes.index(metadata["type_class"][0]) if metadata.get("type_class") is not None else UNLABELED
+        segments_by_file.setdefault(os.path.abspath(str(metadata["data_file_name"])), []).append(
+            (metadata["id"], label))
+    if not segments_by_file:
+        return
+
+    common = os.path.commonpath([os.path.dirname(data_file_name) for data_file_name in segments_by_file])
+    missing = [data_file_name for data_file_name in segments_by_file if not os.path.isfile(data_file_name)]
+    for data_file_name in missing:
+        yield data_file_name, None, "ERR: Data file at {} cannot be found".format(data_file_name)
+        del segments_by_file[data_file_name]
+    # largest first, so a big cloud does not start last and keep one worker busy alone
+    data_file_names = sorted(segments_by_file, key=os.path.getsize, reverse=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for data_file_name in data_file_names:
+            output_base = os.path.join(output_dir, os.path.splitext(os.path.relpath(data_file_name, common))[0])
+            futures[pool.submit(export_file, segment_store.path, data_file_name, segments_by_file[data_file_name],
+                                output_base, export_format, chunk_size)] = data_file_name
+        for future in as_completed(futures):
+            written, error = future.result()
+            yield futures[future], written, error
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the segments of a store as per point labeled clouds")
+    parser.add_argument("store", help="segment store directory")
+    parser.add_argument("output", help="directory to write the exported files to")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ply",
+                        help="labeled PLY per cloud, label arrays per cloud, or one PLY per segment")
+    parser.add_argument("--classes", nargs="+", default=list(DEFAULT_CLASSES),
+                        help="class names whose order gives the labels, other type classes are numbered after them")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="number of points written at once")
+    args = parser.parse_args(argv)
+
+    exported = failed = 0
+    for data_file_name, written, error in export_store(SegmentStore(args.store), args.output, args.format,
+                                                       args.classes, args.workers, args.chunk_size):
+        if error is not None:
+            failed += 1
+            print("{} failed: {}".format(data_file_name, error))
+        else:
+            exported += 1
+            print("{}: {} files written".format(data_file_name, len(written)))
+    print("{} clouds exported, {} failed".format(exported, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
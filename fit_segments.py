@@ -0,0 +1,190 @@
+'''
+Plane and boundary fitting of saved segments
+
+Fills in the plane_equation and vertices of every segment of a segment store. The plane is found by RANSAC, with all
+hypotheses scored at once against a random sample of the segment's points, and then refit by least squares on its
+inliers. The boundary is the convex hull of the inliers projected onto the plane.
+
+Segments are grouped by file and fanned out over a process pool, every worker reads a file's cloud once for all the
+segments of that file it gets. Results are written back to the store as they come in. The version of the indices a
+segment was fitted on is stored with it, so segments whose indices did not change since are skipped on the next run.
+
+Sample usage:
+    python fit_segments.py segments.store
+    python fit_segments.py segments.store --workers 8 --threshold 0.02 --force
+'''
+import argparse
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from scipy.spatial import ConvexHull
+
+from ply_reader import read_point_cloud
+from segment_store import SegmentStore
+
+DEFAULT_ITERATIONS = 256
+DEFAULT_THRESHOLD = 0.05
+DEFAULT_SAMPLE_SIZE = 4096
+
+# points of the file the segments of this worker process last came from
+_loaded_file = {"data_file_name": None, "points": None}
+
+
+def fit_plane(points, iterations=DEFAULT_ITERATIONS, threshold=DEFAULT_THRESHOLD, sample_size=DEFAULT_SAMPLE_SIZE,
+              seed=0):
+    '''
+    RANSAC plane fit, refined by least squares on the inliers
+    :param points: (n, 3) positions, n >= 3
+    :param iterations: number of plane hypotheses, all scored in one go
+    :param threshold: largest distance to the plane of an inlier
+    :param sample_size: number of random points the hypotheses are scored against
+    :return: (unit normal, offset, inlier mask) of the plane normal . x + offset = 0, the normal's largest component is
+             positive
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    random_state = np.random.RandomState(seed)
+    sample = points[random_state.choice(len(points), min(sample_size, len(points)), replace=False)]
+    triplets = sample[random_state.randint(len(sample), size=(iterations, 3))]
+    normals = np.cross(triplets[:, 1] - triplets[:, 0], triplets[:, 2] - triplets[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    valid = lengths > 1e-12
+    if not valid.any():
+        raise ValueError("ERR: segment points are collinear")
+    normals = normals[valid] / lengths[valid, None]
+    offsets = -np.einsum('ij,ij->i', normals, triplets[valid, 0])
+    scores = np.count_nonzero(np.abs(sample.dot(normals.T) + offsets) < threshold, axis=0)
+    best = np.argmax(scores)
+    inliers = np.abs(points.dot(normals[best]) + offsets[best]) < threshold
+
+    # least squares refit: the normal is the direction of least variance of the inliers
+    centroid = points[inliers].mean(axis=0)
+    centered = points[inliers] - centroid
+    _, eigenvectors = np.linalg.eigh(centered.T.dot(centered))
+    normal = eigenvectors[:, 0]
+    if normal[np.argmax(np.abs(normal))] < 0:
+        normal = -normal
+    offset = -float(normal.dot(centroid))
+    return normal, offset, np.abs(points.dot(normal) + offset) < threshold
+
+
+def boundary_polygon(points, normal, offset):
+    '''
+    :param points: (n, 3) positions near the plane
+    :return: (m, 3) corners of the convex hull of the points projected onto the plane, in order around it
+    '''
+    # orthonormal basis of the plane, u is the axis least aligned with the normal crossed with the normal
+    u = np.cross(normal, np.eye(3)[np.argmin(np.abs(normal))])
+    u /= np.linalg.norm(u)
+    v = np.cross(normal, u)
+    origin = -offset * normal
+    planar = np.stack([(points - origin).dot(u), (points - origin).dot(v)], axis=1)
+    hull = ConvexHull(planar)
+    corners = planar[hull.vertices]  # counterclockwise for 2D hulls
+    return origin + corners[:, :1] * u + corners[:, 1:] * v
+
+
+def fit_segment(points, iterations=DEFAULT_ITERATIONS, threshold=DEFAULT_THRESHOLD):
+    '''
+    :return: (plane_equation, vertices) in the Segment schema
+    '''
+    normal, offset, inliers = fit_plane(points, iterations, threshold)
+    vertices = boundary_polygon(np.asarray(points)[inliers], normal, offset)
+    return (normal.tolist(), offset), vertices.tolist()
+
+
+def load_points(data_file_name):
+    if _loaded_file["data_file_name"] != data_file_name:
+        _loaded_file.update(data_file_name=data_file_name, points=np.asarray(read_point_cloud(data_file_name).points))
+    return _loaded_file["points"]
+
+
+def run_fits(data_file_name, segments, iterations, threshold):
+    '''
+    Fit segments of one file, in a worker process
+    :param segments: list of (segment id, indices version, indices)
+    :return: list of (segment id, indices version, (plane_equation, vertices), None) or (segment id, None, None,
+             error message)
+    '''
+    points = load_points(data_file_name)
+    results = []
+    for segment_id, version, indices in segments:
+        if len(indices) < 3:
+            results.append((segment_id, None, None, "ERR: a plane needs at least 3 points, the segment has {}".format(
+                len(indices))))
+            continue
+        try:
+            results.append((segment_id, version, fit_segment(points[indices], iterations, threshold), None))
+        except Exception as e:
+            results.append((segment_id, None, None, str(e)))
+    return results
+
+
+def stale_segments(segment_store, force=False):
+    '''
+    :return: metadata of the segments that were never fitted or whose indices changed since, all of them if force
+    '''
+    return [metadata for metadata in segment_store.entries()
+            if force or metadata.get("fitted_indices_version") != segment_store.indices_version(metadata["id"])]
+
+
+def fit_store(segment_store, workers=None, force=False, iterations=DEFAULT_ITERATIONS, threshold=DEFAULT_THRESHOLD):
+    '''
+    Fit the stale segments of a store and write the results back as they come in
+    :return: generator of (segment id, error message or None) in completion order
+    '''
+    workers = workers or os.cpu_count() or 1
+    segments_by_file = OrderedDict()
+    for metadata in stale_segments(segment_store, force):
+        if metadata.get("data_file_name") is None:
+            yield metadata["id"], "ERR: segment has no data file"
+            continue
+        segments_by_file.setdefault(os.path.abspath(str(metadata["data_file_name"])), []).append(
+            (metadata["id"], segment_store.indices_version(metadata["id"]),
+             np.asarray(segment_store.read_indices(metadata["id"]), dtype=np.int64)))
+
+    tasks = []
+    for data_file_name, segments in segments_by_file.items():
+        chunk_size = max(1, -(-len(segments) // workers))
+        for start in range(0, len(segments), chunk_size):
+            tasks.append((data_file_name, segments[start:start + chunk_size], iterations, threshold))
+    if not tasks:
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_fits, *task) for task in tasks]
+        for future in as_completed(futures):
+            for segment_id, version, fit, error in future.result():
+                if error is None:
+                    plane_equation, vertices = fit
+                    segment_store.update_metadata(segment_id, plane_equation=plane_equation, vertices=vertices,
+                                                  fitted_indices_version=version)
+                yield segment_id, error
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit a plane and a boundary polygon to every segment of a store")
+    parser.add_argument("store", help="segment store directory")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--force", action="store_true", help="refit segments whose indices did not change")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS, help="number of RANSAC hypotheses")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="largest distance to the plane of an inlier")
+    args = parser.parse_args(argv)
+
+    segment_store = SegmentStore(args.store)
+    fitted = failed = 0
+    for segment_id, error in fit_store(segment_store, args.workers, args.force, args.iterations, args.threshold):
+        if error is not None:
+            failed += 1
+            print("Segment {} failed: {}".format(segment_id, error))
+        else:
+            fitted += 1
+    print("{} segments fitted, {} failed, {} up to date".format(fitted, failed, len(segment_store) - fitted - failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
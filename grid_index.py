@@ -0,0 +1,168 @@
+'''
+Uniform grid over a point cloud for axis aligned box queries
+
+Points are sorted by grid cell, so a cell is a contiguous slice of the sorted arrays. A box query only reads the
+cells the box overlaps: cells that lie inside the box are taken whole, only the points of the cells on the box's
+border are compared against the box. Queries return point ids into the parent cloud, nothing is copied until the
+caller gathers or saves them.
+
+The sorted arrays are written to the cloud's sidecar (see sidecar.py) and memory-mapped on load.
+'''
+import numpy as np
+
+from csr import row_offsets
+from instrumentation import tracer
+from sidecar import load_arrays, save_arrays
+
+DEFAULT_POINTS_PER_CELL = 64
+
+
+def grid_cell_size(extent, count, points_per_cell=DEFAULT_POINTS_PER_CELL):
+    '''
+    Size of cubic cells that holds about points_per_cell points per cell, as if the points filled the bounding box
+    Axes thinner than a cell, e.g. the normal of a wall, do not count towards the volume
+    :param extent: (3,) size of the bounding box
+    :param count: number of points
+    '''
+    cells_wanted = max(count / float(points_per_cell), 1.0)
+    axes = [axis for axis in range(3) if extent[axis] > 0]
+    cell_size = float(max(extent.max(), 1e-9))
+    while axes:
+        cell_size = (np.prod(extent[axes]) / cells_wanted) ** (1.0 / len(axes))
+        thick = [axis for axis in axes if extent[axis] >= cell_size]
+        if len(thick) == len(axes):
+            break
+        axes = thick
+    return cell_size
+
+
+def build_grid_arrays(points, points_per_cell=DEFAULT_POINTS_PER_CELL):
+    '''
+    :param points: (n, 3) positions
+    :param points_per_cell: average number of points per occupied cell to aim for
+    :return: dict of arrays, the input of GridIndex
+    '''
+    points = np.asarray(points)
+    if len(points) == 0:
+        low, high = np.zeros(3), np.zeros(3)
+    else:
+        low = points.min(axis=0).astype(np.float64)
+        high = points.max(axis=0).astype(np.float64)
+    extent = high - low
+    cell_size = grid_cell_size(extent, len(points), points_per_cell)
+    dims = np.maximum(np.ceil(extent / cell_size).astype(np.int64), 1)
+    cell = np.clip(((points - low) / cell_size).astype(np.int64), 0, dims - 1)
+    keys = (cell[:, 0] * dims[1] + cell[:, 1]) * dims[2] + cell[:, 2]
+    order = np.argsort(keys, kind='mergesort')
+    cell_start = np.zeros(int(np.prod(dims)) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=len(cell_start) - 1), out=cell_start[1:])
+    return {"low": low,
+            "high": high,
+            "cell_size": np.array([cell_size]),
+            "dims": dims,
+            "cell_start": cell_start,
+            "point_indices": order.astype(np.int64),
+            "positions": points[order].astype(np.float32)}
+
+
+class GridIndex:
+    '''
+    Cell table and cell sorted points of a cloud, see build_grid_arrays
+    '''
+
+    def __init__(self, arrays):
+        self.low = np.asarray(arrays["low"])  # (3,) bounding box of the points
+        self.high = np.asarray(arrays["high"])
+        self.cell_size = float(arrays["cell_size"][0])
+        self.dims = np.asarray(arrays["dims"])
+        self.cell_start = arrays["cell_start"]  # (cells + 1,) offset of every cell's first point
+        self.point_indices = arrays["point_indices"]  # global point id of every sorted point
+        self.positions = arrays["positions"]
+
+    def __len__(self):
+        return len(self.point_indices)
+
+    def query_box(self, box_min, box_max):
+        '''
+        Find the points inside a box, borders included
+        :param box_min: (3,) lower corner
+        :param box_max: (3,) upper corner
+        :return: array of point ids, ordered by cell
+        '''
+        box_min = np.asarray(box_min, dtype=np.float64)
+        box_max = np.asarray(box_max, dtype=np.float64)
+        empty = np.zeros(0, dtype=np.int64)
+        if len(self) == 0 or np.any(box_min > box_max) or np.any(box_max < self.low) or np.any(box_min > self.high):
+            return empty
+
+        # cells the box overlaps along every axis, and which of them lie inside the box on that axis, the outermost
+        # cells also do when the box reaches past the points
+        first = np.clip(np.floor((box_min - self.low) / self.cell_size).astype(np.int64), 0, self.dims - 1)
+        last = np.clip(np.floor((box_max - self.low) / self.cell_size).astype(np.int64), 0, self.dims - 1)
+        cells, inside = [], []
+        margin = self.cell_size * 1e-6  # points on a cell border can be binned on either side of it
+        for axis in range(3):
+            c = np.arange(first[axis], last[axis] + 1)
+            cell_low = self.low[axis] + c * self.cell_size
+            cells.append(c)
+            above_min = (cell_low - margin >= box_min[axis]) | ((c == 0) & (box_min[axis] <= self.low[axis]))
+            below_max = (cell_low + self.cell_size + margin <= box_max[axis]) \
+                        | ((c == self.dims[axis] - 1) & (box_max[axis] >= self.high[axis]))
+            inside.append(above_min & below_max)
+        keys = (cells[0][:, None, None] * self.dims[1] + cells[1][None, :, None]) * self.dims[2] + cells[2]
+        inside = inside[0][:, None, None] & inside[1][None, :, None] & inside[2]
+        keys, inside = keys.ravel(), inside.ravel()
+
+        with tracer.span("grid_index.query_box"):
+            whole = self.cell_runs(keys[inside])
+            border = self.cell_offsets(keys[~inside])
+            positions = self.positions[border]
+            in_box = np.all((positions >= box_min) & (positions <= box_max), axis=1)
+            tracer.count("grid_index.points_tested", len(border))
+            return np.concatenate([whole, self.point_indices[border[in_box]]])
+
+    def cell_runs(self, keys):
+        '''
+        :param keys: increasing cell keys
+        :return: point ids of the given cells, neighboring cells are copied as one slice
+        '''
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+        breaks = np.flatnonzero(np.diff(keys) != 1) + 1
+        run_first = keys[np.concatenate([[0], breaks])]
+        run_last = keys[np.concatenate([breaks - 1, [len(keys) - 1]])]
+        return np.concatenate([self.point_indices[start:end] for start, end in
+                               zip(self.cell_start[run_first].tolist(), self.cell_start[run_last + 1].tolist())])
+
+    def cell_offsets(self, keys):
+        '''
+        :return: offsets into the sorted arrays of every point of the given cells
+        '''
+        starts = self.cell_start[keys]
+        lengths = self.cell_start[keys + 1] - starts
+        return row_offsets(starts, lengths)
+
+
+def complement(indices, count):
+    '''
+    :return: sorted ids of the points of a count point cloud that are not in indices
+    '''
+    keep = np.ones(count, dtype=bool)
+    keep[np.asarray(indices, dtype=np.int64)] = False
+    return np.flatnonzero(keep)
+
+
+def load_grid_index(data_file_name, pcd, points_per_cell=DEFAULT_POINTS_PER_CELL):
+    '''
+    Load the grid index of a point cloud file from its sidecar, building and saving it if it is missing or stale
+    :param data_file_name: path of the file pcd was read from
+    :param pcd: the pcd read from data_file_name
+    :return: GridIndex, memory-mapped when it came from the sidecar
+    '''
+    params = {"points_per_cell": points_per_cell}
+    arrays = load_arrays(data_file_name, "grid", params)
+    if arrays is None or len(arrays["point_indices"]) != len(pcd.points):
+        with tracer.span("grid_index.build"):
+            arrays = build_grid_arrays(np.asarray(pcd.points), points_per_cell)
+        save_arrays(data_file_name, "grid", arrays, params)
+    return GridIndex(arrays)
@@ -0,0 +1,131 @@
+'''
+Timing spans and counters for the hot paths
+
+Sample usage:
+    from instrumentation import tracer
+    with tracer.span("floodfill"):
+        ...
+        tracer.count("points_visited", len(candidates))
+
+Recording is off by default and then span() returns a shared no-op context manager and count() returns right away,
+so instrumented code pays one attribute check. Set the ATLAS_TRACE environment variable to record from startup, to a
+file name to also export the session there on exit. Sessions export to the Chrome trace format, open them in
+chrome://tracing or https://ui.perfetto.dev.
+'''
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.add_span(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class Tracer:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = []  # (name, start, end, thread id, args)
+        self.counter_events = []  # (name, time, value after the increment, thread id)
+        self.counters = OrderedDict()  # name -> running total
+
+    def span(self, name, **args):
+        '''
+        :return: context manager that records how long its block took, if recording
+        '''
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def count(self, name, value=1):
+        '''
+        Add value to a named counter, if recording
+        '''
+        if not self.enabled:
+            return
+        with self.lock:
+            total = self.counters.get(name, 0) + value
+            self.counters[name] = total
+            self.counter_events.append((name, time.perf_counter(), total, threading.get_ident()))
+
+    def add_span(self, name, start, end, args):
+        with self.lock:
+            self.spans.append((name, start, end, threading.get_ident(), args))
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+            self.counter_events = []
+            self.counters = OrderedDict()
+
+    def mark(self):
+        '''
+        :return: marker of the current position, for summary()
+        '''
+        with self.lock:
+            return len(self.spans), dict(self.counters)
+
+    def summary(self, mark=None):
+        '''
+        :param mark: only include what was recorded after this mark() call
+        :return: one line with the total time per span name and the counter increments
+        '''
+        first_span, counters_before = mark if mark is not None else (0, {})
+        with self.lock:
+            spans = self.spans[first_span:]
+            counters = dict(self.counters)
+        totals = OrderedDict()
+        for name, start, end, _, _ in spans:
+            totals[name] = totals.get(name, 0) + end - start
+        parts = ["{} {:.3f}s".format(name, total) for name, total in totals.items()]
+        parts += ["{}={}".format(name, value - counters_before.get(name, 0)) for name, value in counters.items()
+                  if value != counters_before.get(name, 0)]
+        return " | ".join(parts) if parts else "nothing recorded"
+
+    def export_chrome_trace(self, file_name):
+        '''
+        Write every recorded span and counter to a Chrome trace JSON file
+        '''
+        pid = os.getpid()
+        with self.lock:
+            events = [{"name": name, "cat": name.split(".")[0], "ph": "X", "pid": pid, "tid": tid,
+                       "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6, "args": args}
+                      for name, start, end, tid, args in self.spans]
+            events += [{"name": name, "ph": "C", "pid": pid, "tid": tid, "ts": (t - self.origin) * 1e6,
+                        "args": {name: value}}
+                       for name, t, value, tid in self.counter_events]
+        with open(file_name, mode='w') as f:
+            f.write(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+
+tracer = Tracer(enabled=os.environ.get("ATLAS_TRACE", "") not in ("", "0"))
+
+if os.environ.get("ATLAS_TRACE", "") not in ("", "0", "1"):
+    atexit.register(tracer.export_chrome_trace, os.environ["ATLAS_TRACE"])
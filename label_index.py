@@ -0,0 +1,163 @@
+'''
+Reverse index from the points of a cloud to the segments containing them
+
+Most points belong to at most one segment, so every point has a label: the id of its segment, UNLABELED, or OVERLAP
+when several segments contain it. Only the overlap points are tracked per segment, as one bitmap per segment over the
+sorted overlap points, so the index stays one int32 per point as long as segments mostly partition the cloud.
+
+Sample usage:
+    index = LabelIndex.from_store(store, "data/scene.ply", len(pcd.points))
+    index.add(segment.id, segment.indices)
+    index.segments_at(point_id)
+    index.remove(segment.id, segment.indices)
+'''
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+UNLABELED = -1
+OVERLAP = -2
+
+
+class LabelIndex:
+    def __init__(self, count):
+        '''
+        :param count: number of points of the cloud
+        '''
+        self.labels = np.full(count, UNLABELED, dtype=np.int32)  # segment id, UNLABELED or OVERLAP of every point
+        self.overlap_points = np.zeros(0, dtype=np.int64)  # sorted ids of the points labeled OVERLAP
+        self.overlap_bits = OrderedDict()  # segment id -> packed bitmap over overlap_points, for segments having any
+
+    def __len__(self):
+        return len(self.labels)
+
+    def membership(self, segment_id):
+        '''
+        :return: bool array over overlap_points, True where the segment contains the point
+        '''
+        if segment_id not in self.overlap_bits:
+            return np.zeros(len(self.overlap_points), dtype=bool)
+        return np.unpackbits(self.overlap_bits[segment_id])[:len(self.overlap_points)].astype(bool)
+
+    def set_membership(self, segment_id, membership):
+        if membership.any():
+            self.overlap_bits[segment_id] = np.packbits(membership)
+        else:
+            self.overlap_bits.pop(segment_id, None)
+
+    def set_overlap_points(self, overlap_points):
+        '''
+        Move every bitmap over to new overlap points, points that are no longer overlap points are dropped
+        '''
+        for segment_id in list(self.overlap_bits):
+            old = self.overlap_points[self.membership(segment_id)]
+            membership = np.zeros(len(overlap_points), dtype=bool)
+            old = old[np.isin(old, overlap_points, assume_unique=True)]
+            membership[np.searchsorted(overlap_points, old)] = True
+            self.set_membership(segment_id, membership)
+        self.overlap_points = overlap_points
+
+    def add(self, segment_id, indices):
+        '''
+        Record a segment, it must not be recorded already
+        '''
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        labels = self.labels[indices]
+        self.labels[indices[labels == UNLABELED]] = segment_id
+
+        # points of one other segment become overlap points, that segment keeps them through its bitmap
+        exclusive = labels >= 0
+        if exclusive.any():
+            new_points, owners = indices[exclusive], labels[exclusive]
+            self.set_overlap_points(np.union1d(self.overlap_points, new_points))
+            self.labels[new_points] = OVERLAP
+            positions = np.searchsorted(self.overlap_points, new_points)
+            for owner in np.unique(owners).tolist():
+                membership = self.membership(owner)
+                membership[positions[owners == owner]] = True
+                self.set_membership(owner, membership)
+
+        shared = indices[labels != UNLABELED]
+        if len(shared):
+            membership = np.zeros(len(self.overlap_points), dtype=bool)
+            membership[np.searchsorted(self.overlap_points, shared)] = True
+            self.set_membership(segment_id, membership)
+
+    def remove(self, segment_id, indices):
+        '''
+        Forget a segment, indices must be the ones it was added with
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        self.labels[indices[self.labels[indices] == segment_id]] = UNLABELED
+        if segment_id not in self.overlap_bits:
+            return
+
+        # overlap points left with a single segment are labeled with it again
+        positions = np.flatnonzero(self.membership(segment_id))
+        del self.overlap_bits[segment_id]
+        counts = np.zeros(len(positions), dtype=np.int64)
+        last = np.full(len(positions), UNLABELED, dtype=np.int32)
+        for other in self.overlap_bits:
+            contains = self.membership(other)[positions]
+            counts += contains
+            last[contains] = other
+        single = counts <= 1
+        self.labels[self.overlap_points[positions[single]]] = last[single]
+        keep = np.ones(len(self.overlap_points), dtype=bool)
+        keep[positions[single]] = False
+        self.set_overlap_points(self.overlap_points[keep])
+
+    def segments_at(self, point_id):
+        '''
+        :return: ids of the segments containing the point
+        '''
+        label = int(self.labels[point_id])
+        if label != OVERLAP:
+            return [] if label == UNLABELED else [label]
+        position = int(np.searchsorted(self.overlap_points, point_id))
+        return [segment_id for segment_id, bits in self.overlap_bits.items()
+                if (bits[position >> 3] >> (7 - (position & 7))) & 1]
+
+    def overlaps(self, segment_id):
+        '''
+        :return: dict of the ids of the other segments sharing points with the segment -> number of shared points
+        '''
+        if segment_id not in self.overlap_bits:
+            return {}
+        membership = self.membership(segment_id)
+        counts = OrderedDict()
+        for other in self.overlap_bits:
+            if other != segment_id:
+                shared = int(np.count_nonzero(membership & self.membership(other)))
+                if shared:
+                    counts[other] = shared
+        return counts
+
+    def unlabeled_mask(self):
+        '''
+        :return: bool array, True for the points no segment contains
+        '''
+        return self.labels == UNLABELED
+
+    @staticmethod
+    def from_store(store, data_file_name, count=None):
+        '''
+        :param store: SegmentStore
+        :param data_file_name: cloud whose segments are indexed
+        :param count: number of points of the cloud, by default one past the largest index of its segments
+        '''
+        segment_ids = [metadata["id"] for metadata in store.entries()
+                       if same_file(metadata["data_file_name"], data_file_name)]
+        segment_indices = [store.read_indices(segment_id) for segment_id in segment_ids]
+        if count is None:
+            count = max([int(indices.max()) + 1 for indices in segment_indices if len(indices)] + [0])
+        index = LabelIndex(count)
+        for segment_id, indices in zip(segment_ids, segment_indices):
+            index.add(segment_id, indices)
+        return index
+
+
+def same_file(file_name, other_file_name):
+    return file_name is not None and other_file_name is not None \
+           and os.path.abspath(str(file_name)) == os.path.abspath(str(other_file_name))
@@ -0,0 +1,370 @@
+'''
+Octree level of detail for point clouds too large to draw at once
+
+Every point is stored in exactly one octree node. The root holds a random sample of the whole cloud, each child holds
+a random sample of the points in its octant that no ancestor took, and so on until a node has few enough points to
+take all of them. Drawing any set of nodes that contains the parents of its nodes is therefore a uniform subsample
+of the cloud that gets denser where deeper nodes are added.
+
+Node data is written to the cloud's sidecar (see sidecar.py) sorted by node, so a node is a contiguous slice of the
+memory-mapped arrays and only the nodes that are drawn are ever read from disk. The tree is built a level at a time
+over the points in morton order, a chunk of whole nodes at a time, writing straight into the sidecar's files: the
+random sample of a node is its points of lowest pseudo random rank, so no permutation of the whole cloud is kept.
+
+Clouds that fit in memory but not in the point budget are drawn as a voxel sample instead: one random point per voxel
+of the finest voxel grid whose occupied voxels fit in the budget.
+'''
+import heapq
+from functools import partial
+
+import numpy as np
+
+from sidecar import finish_entry, load_arrays, new_array, save_arrays, start_entry
+
+DEFAULT_MAX_POINTS_PER_NODE = 50000
+DEFAULT_MAX_DEPTH = 16
+DEFAULT_POINT_BUDGET = 2000000
+DEFAULT_CHUNK_SIZE = 1 << 20
+VOXEL_LEVELS = 16  # the finest voxel grid has 2 ** VOXEL_LEVELS voxels along the cloud's longest side
+
+
+def point_ranks(ids, seed=0):
+    '''
+    :return: pseudo random uint64 rank of every point id, the same for the same id and seed, so any set of points can
+             be put in random order without a permutation of the whole cloud
+    '''
+    x = np.asarray(ids).astype(np.uint64) + np.uint64((seed * 0x9e3779b97f4a7c15) % (1 << 64))
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def build_octree_arrays(points, colors, max_points_per_node=DEFAULT_MAX_POINTS_PER_NODE, max_depth=DEFAULT_MAX_DEPTH,
+                        seed=0, allocate=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    :param points: (n, 3) positions
+    :param colors: (n, 3) uint8 colors or colors in [0, 1], None if the cloud has none
+    :param max_points_per_node: number of points a node takes before the rest goes to its children
+    :param max_depth: depth at which nodes take all their remaining points, at most 21
+    :param seed: seed of the random sampling, so rebuilding gives the same tree
+    :param allocate: function (name, shape, dtype) -> array the per point outputs are written into, e.g. partial of
+                     sidecar.new_array, None to build them in memory
+    :param chunk_size: number of points handled at once
+    :return: dict of arrays, the input of Octree
+    '''
+    if allocate is None:
+        allocate = lambda name, shape, dtype: np.empty(shape, dtype=dtype)
+    count = len(points)
+    chunks = [slice(start, start + chunk_size) for start in range(0, count, chunk_size)]
+    low = np.min([points[chunk].min(axis=0) for chunk in chunks], axis=0).astype(np.float64)
+    high = np.max([points[chunk].max(axis=0) for chunk in chunks], axis=0).astype(np.float64)
+    extent = max(float((high - low).max()), 1e-9)
+    cells = 1 << max_depth
+
+    def grid(positions):
+        return np.clip(((positions - low) * (cells / extent)).astype(np.int64), 0, cells - 1)
+
+    # points in morton order of their finest cell, so the points of a node at any depth are a contiguous run, kept
+    # as 16 bytes per point while the per point outputs are written chunk by chunk
+    codes = np.empty(count, dtype=np.uint64)
+    for chunk in chunks:
+        codes[chunk] = morton_codes(grid(points[chunk]))
+    remaining = np.argsort(codes, kind='stable')
+    codes.sort()  # in place, the same as codes[remaining] without a second copy
+
+    point_indices = allocate("point_indices", (count,), np.int64)
+    positions = allocate("positions", (count, 3), np.float32)
+    colors_u8 = allocate("colors", (count, 3), np.uint8)
+    node_depth, node_key, node_count = [], [], []
+    written = 0
+
+    def take(depth, ids, node_sizes):
+        '''
+        Append nodes of one depth, ids holds the points of every node one node after the other
+        '''
+        nonlocal written
+        first = np.concatenate([[0], np.cumsum(node_sizes)[:-1]]).astype(np.int64)
+        cell = grid(points[ids[first]]) >> (max_depth - depth)
+        node_depth.append(np.full(len(node_sizes), depth, dtype=np.int64))
+        node_key.append((cell[:, 0] << (2 * depth)) | (cell[:, 1] << depth) | cell[:, 2])
+        node_count.append(np.asarray(node_sizes, dtype=np.int64))
+        for start in range(0, len(ids), chunk_size):
+            chunk_ids = ids[start:start + chunk_size]
+            end = written + len(chunk_ids)
+            point_indices[written:end] = chunk_ids
+            positions[written:end] = points[chunk_ids]
+            if colors is None or len(colors) == 0:
+                colors_u8[written:end] = 255
+            else:
+                chunk_colors = np.asarray(colors[chunk_ids])
+                colors_u8[written:end] = chunk_colors if chunk_colors.dtype == np.uint8 \
+                    else np.round(chunk_colors * 255).astype(np.uint8)
+            written = end
+
+    left = count  # remaining[:left] and codes[:left] are the points no node took yet, in morton order
+    for depth in range(max_depth + 1):
+        if left == 0:
+            break
+        shift = np.uint64(3 * (max_depth - depth))
+        limit = max_points_per_node if depth < max_depth else left
+        kept = 0  # the points left for deeper nodes are moved to the front of remaining as they are found
+        start = 0
+        while start < left:
+            end = min(start + chunk_size, left)
+            if end < left:
+                # end the run at a node boundary, or at the end of the node if one node is larger than a chunk
+                cut = np.searchsorted(codes[start:end], (codes[end] >> shift) << shift)
+                end = start + cut if cut > 0 else \
+                    start + np.searchsorted(codes[start:left], ((codes[start] >> shift) + np.uint64(1)) << shift)
+            ids, run_codes = remaining[start:end], codes[start:end]
+            if end - start <= chunk_size:
+                # a random sample of limit points per node, by lowest rank
+                keys = run_codes >> shift
+                order = np.lexsort((point_ranks(ids, seed), keys))
+                node_starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+                sizes = np.diff(np.append(node_starts, len(keys)))
+                taken = order[np.arange(len(keys)) - np.repeat(node_starts, sizes) < limit]
+                take(depth, ids[taken], np.minimum(sizes, limit))
+            else:
+                # one node larger than a chunk, its limit lowest ranks are found a chunk at a time
+                best_ranks, taken = np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+                for chunk_start in range(0, end - start, chunk_size):
+                    chunk_end = min(chunk_start + chunk_size, end - start)
+                    best_ranks = np.concatenate([best_ranks, point_ranks(ids[chunk_start:chunk_end], seed)])
+                    taken = np.concatenate([taken, np.arange(chunk_start, chunk_end)])
+                    if len(best_ranks) > limit:
+                        best = np.argpartition(best_ranks, limit - 1)[:limit]
+                        best_ranks, taken = best_ranks[best], taken[best]
+                taken = taken[np.argsort(best_ranks)]
+                take(depth, ids[taken], [len(taken)])
+            left_over = np.ones(end - start, dtype=bool)
+            left_over[taken] = False
+            ids, run_codes = ids[left_over], run_codes[left_over]  # copies, kept <= start
+            remaining[kept:kept + len(ids)] = ids
+            codes[kept:kept + len(ids)] = run_codes
+            kept += len(ids)
+            start = end
+        left = kept
+
+    node_count = np.concatenate(node_count)
+    node_start = np.zeros(len(node_count), dtype=np.int64)
+    np.cumsum(node_count[:-1], out=node_start[1:])
+    return {"bounds": np.array([low[0], low[1], low[2], extent]),
+            "node_depth": np.concatenate(node_depth),
+            "node_key": np.concatenate(node_key),
+            "node_start": node_start,
+            "node_count": node_count,
+            "point_indices": point_indices,
+            "positions": positions,
+            "colors": colors_u8}
+
+
+class Octree:
+    '''
+    Node table and per node point data of a cloud, see build_octree_arrays
+    '''
+
+    def __init__(self, arrays):
+        self.bounds = arrays["bounds"]
+        self.node_depth = np.asarray(arrays["node_depth"])
+        self.node_key = np.asarray(arrays["node_key"])
+        self.node_start = np.asarray(arrays["node_start"])
+        self.node_count = np.asarray(arrays["node_count"])
+        self.point_indices = arrays["point_indices"]  # global point id of every stored point
+        self.positions = arrays["positions"]
+        self.colors = arrays["colors"]
+
+        # cell coordinates and bounding box of every node
+        depth = self.node_depth
+        mask = (np.int64(1) << depth) - 1
+        cell = np.stack([self.node_key >> (2 * depth), (self.node_key >> depth) & mask, self.node_key & mask], axis=1)
+        size = self.bounds[3] / (np.int64(1) << depth)
+        self.node_min = self.bounds[:3] + cell * size[:, None]
+        self.node_max = self.node_min + size[:, None]
+
+        # children of every node, found through the parent's cell
+        node_of = {(d, k): i for i, (d, k) in enumerate(zip(depth.tolist(), self.node_key.tolist()))}
+        self.children = [[] for _ in range(len(depth))]
+        self.roots = []
+        for i, (d, (x, y, z)) in enumerate(zip(depth.tolist(), cell.tolist())):
+            if d == 0:
+                self.roots.append(i)
+                continue
+            parent_key = ((x >> 1) << (2 * (d - 1))) | ((y >> 1) << (d - 1)) | (z >> 1)
+            self.children[node_of[(d - 1, parent_key)]].append(i)
+
+    def __len__(self):
+        return len(self.node_count)
+
+    def node_slice(self, node):
+        return slice(self.node_start[node], self.node_start[node] + self.node_count[node])
+
+    def node_screen_sizes(self, transform, viewport_size):
+        '''
+        Project the bounding box of every node to the screen
+        :param transform: vispy transform from cloud coordinates to canvas pixels
+        :param viewport_size: (width, height) of the canvas in pixels
+        :return: (visible mask, size on screen in pixels) per node, nodes that reach behind the camera get an
+                 infinite size
+        '''
+        corners = np.stack([np.where([[(c >> axis) & 1 for axis in range(3)]], self.node_max, self.node_min)
+                            for c in range(8)], axis=1).reshape(-1, 3)
+        mapped = np.asarray(transform.map(corners)).reshape(len(self), 8, -1)
+        w = mapped[:, :, 3] if mapped.shape[2] == 4 else np.ones(mapped.shape[:2])
+        in_front = w > 0
+        xy = mapped[:, :, :2] / np.where(in_front, w, 1)[:, :, None]
+        xy_low = np.where(in_front[:, :, None], xy, np.inf).min(axis=1)
+        xy_high = np.where(in_front[:, :, None], xy, -np.inf).max(axis=1)
+        on_screen = np.all(xy_high >= 0, axis=1) & (xy_low[:, 0] <= viewport_size[0]) \
+                    & (xy_low[:, 1] <= viewport_size[1])
+        crosses_camera = in_front.any(axis=1) & ~in_front.all(axis=1)
+        visible = on_screen | crosses_camera
+        sizes = np.where(crosses_camera, np.inf, np.linalg.norm(xy_high - xy_low, axis=1))
+        return visible, sizes
+
+    def select_nodes(self, transform, viewport_size, point_budget=DEFAULT_POINT_BUDGET, min_node_size=100):
+        '''
+        Pick the nodes to draw for the current camera, largest on screen first, until the point budget is spent
+        :param min_node_size: children of nodes smaller than this many pixels on screen are not drawn
+        :return: list of node ids, every node's parent is in the list too
+        '''
+        visible, sizes = self.node_screen_sizes(transform, viewport_size)
+        heap = [(-sizes[node], node) for node in self.roots if visible[node]]
+        heapq.heapify(heap)
+        selected = []
+        total = 0
+        while heap:
+            negative_size, node = heapq.heappop(heap)
+            if total + self.node_count[node] > point_budget:
+                continue
+            selected.append(node)
+            total += self.node_count[node]
+            if -negative_size >= min_node_size:
+                for child in self.children[node]:
+                    if visible[child]:
+                        heapq.heappush(heap, (-sizes[child], child))
+        return selected
+
+    def gather(self, nodes):
+        '''
+        :return: positions, colors in [0, 1] and global point ids of the points of the given nodes
+        '''
+        slices = [self.node_slice(node) for node in nodes]
+        if not slices:
+            return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.float32), np.zeros(0, np.int64)
+        positions = np.concatenate([self.positions[s] for s in slices])
+        colors = np.concatenate([self.colors[s] for s in slices]).astype(np.float32) / 255
+        indices = np.concatenate([self.point_indices[s] for s in slices])
+        return positions, colors, indices
+
+
+def load_octree(data_file_name, pcd, max_points_per_node=DEFAULT_MAX_POINTS_PER_NODE, max_depth=DEFAULT_MAX_DEPTH):
+    '''
+    Load the octree of a point cloud file from its sidecar, building and saving it if it is missing or stale
+    :param data_file_name: path of the file pcd was read from
+    :param pcd: the pcd read from data_file_name
+    :return: Octree, memory-mapped when it came from the sidecar
+    '''
+    params = {"max_points_per_node": max_points_per_node, "max_depth": max_depth}
+    arrays = load_arrays(data_file_name, "octree", params)
+    if arrays is None or len(arrays["point_indices"]) != len(pcd.points):
+        # uint8 colors of a PointCloudData as they are, its float colors are never converted for the whole cloud
+        colors = getattr(pcd, "colors_u8", None)
+        if colors is None and pcd.has_colors():
+            colors = np.asarray(pcd.colors)
+        # per point data goes straight into the sidecar's files, in memory if the sidecar cannot be written
+        entry_dir = start_entry(data_file_name, "octree")
+        allocate = partial(new_array, entry_dir) if entry_dir is not None else None
+        arrays = build_octree_arrays(np.asarray(pcd.points), colors, max_points_per_node, max_depth, allocate=allocate)
+        if entry_dir is not None:
+            finish_entry(data_file_name, "octree", arrays, params)
+    return Octree(arrays)
+
+
+def morton_codes(cells):
+    '''
+    Interleave the bits of integer cell coordinates, so that the cells of a voxel of any coarser level share a prefix
+    :param cells: (n, 3) cell coordinates below 2 ** 21
+    :return: (n,) uint64 codes
+    '''
+    codes = np.zeros(len(cells), dtype=np.uint64)
+    for axis in range(3):
+        x = np.asarray(cells[:, axis], dtype=np.uint64) & np.uint64(0x1fffff)
+        x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+        x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+        x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+        x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+        x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+        codes |= x << np.uint64(2 - axis)
+    return codes
+
+
+def voxel_sample(points, point_budget=DEFAULT_POINT_BUDGET, seed=0):
+    '''
+    Pick one random point per voxel, using the finest voxel grid that has at most point_budget occupied voxels, then
+    fill the budget with random voxels of the next finer grid
+    :param points: (n, 3) positions
+    :param seed: seed of the random picks, so resampling gives the same points
+    :return: increasing ids of the picked points, all ids if there are at most point_budget points
+    '''
+    points = np.asarray(points)
+    if len(points) <= point_budget:
+        return np.arange(len(points))
+    low = points.min(axis=0).astype(np.float64)
+    extent = max(float((points.max(axis=0) - low).max()), 1e-9)
+    cells = 1 << VOXEL_LEVELS
+    grid = np.clip(((points - low) * (cells / extent)).astype(np.int64), 0, cells - 1)
+    # random order first, the stable sort keeps it, so the first point of every voxel is a random one
+    order = np.random.RandomState(seed).permutation(len(points))
+    codes = morton_codes(grid[order])
+    sort = np.argsort(codes, kind='mergesort')
+    order, codes = order[sort], codes[sort]
+
+    def voxel_starts(level):
+        voxels = codes >> np.uint64(3 * (VOXEL_LEVELS - level))
+        return np.concatenate([[0], np.flatnonzero(voxels[1:] != voxels[:-1]) + 1])
+
+    # occupied voxels only grow with the level, find the finest level that fits
+    low_level, high_level = 0, VOXEL_LEVELS
+    while low_level < high_level:
+        level = (low_level + high_level + 1) // 2
+        if len(voxel_starts(level)) <= point_budget:
+            low_level = level
+        else:
+            high_level = level - 1
+    picked = voxel_starts(low_level)
+    if low_level < VOXEL_LEVELS:
+        # spend the rest of the budget on random voxels of the next level, the picked points start voxels there too
+        finer = np.setdiff1d(voxel_starts(low_level + 1), picked, assume_unique=True)
+        extra = np.random.RandomState(seed).choice(len(finer), point_budget - len(picked), replace=False)
+        picked = np.concatenate([picked, finer[extra]])
+    return np.sort(order[picked])
+
+
+def load_voxel_sample(data_file_name, pcd, point_budget=DEFAULT_POINT_BUDGET):
+    '''
+    Load the voxel sample of a point cloud file from its sidecar, building and saving it if it is missing or stale
+    :param data_file_name: path of the file pcd was read from
+    :param pcd: the pcd read from data_file_name
+    :return: ids of the sampled points of pcd, see voxel_sample
+    '''
+    params = {"point_budget": point_budget, "levels": VOXEL_LEVELS}
+    arrays = load_arrays(data_file_name, "voxel_sample", params)
+    if arrays is None or arrays["count"][0] != len(pcd.points):
+        arrays = {"indices": voxel_sample(np.asarray(pcd.points), point_budget),
+                  "count": np.array([len(pcd.points)])}
+        save_arrays(data_file_name, "voxel_sample", arrays, params)
+    return arrays["indices"]
+
+
+def prepare_display(data_file_name, pcd, lod_threshold, point_budget=DEFAULT_POINT_BUDGET):
+    '''
+    Decide how a cloud is drawn and load what that needs: an octree above lod_threshold points, a voxel sample above
+    point_budget points, nothing otherwise
+    :return: (Octree or None, voxel sample ids or None)
+    '''
+    if len(pcd.points) > lod_threshold:
+        return load_octree(data_file_name, pcd), None
+    if len(pcd.points) > point_budget:
+        return None, load_voxel_sample(data_file_name, pcd, point_budget)
+    return None, None
@@ -4,11 +4,24 @@ from PyQt5.QtWidgets import *
 import sys
 from vispy import scene
 import vispy.scene
+from vispy.util import keys
+from cloud_cache import cloud_cache
+from compute_server import ComputeServerError, RemoteSegmentStore, client_from_environment
 from custom_util import prompt_saving, floodfill, crop_reserve, crop_remove, FloodfillError, Scene
+from grid_index import complement, load_grid_index
+from instrumentation import tracer
+from label_index import LabelIndex, same_file
+from lod import prepare_display, voxel_sample
 from models import Segment
+from screen_selection import rectangle_polygon
+from segment_store import SegmentStore
+from workers import FloodfillWorker, LoadWorker
 import os
 import open3d as o3d
 
+HIGHLIGHT_COLORS = [(0, 1, 0, 1), (0, 0.6, 1, 1), (1, 0.6, 0, 1), (1, 0, 1, 1), (1, 1, 0, 1), (0, 1, 1, 1),
+                    (0.6, 0.3, 1, 1), (1, 0.4, 0.4, 1)] # colors of highlighted segmentations, the first one is green
+
 
 class AtlasAnnotationTool(QWidget):
     def __init__(self, app):
@@ -19,15 +32,39 @@ class AtlasAnnotationTool(QWidget):
         self.base_form.setupUi(self.window)
 
         # bookkeeping variable
-        self.data_fname = "segments.json"
+        self.data_fname = "segments.json" # legacy segment file, imported into the segment store on first start
         self.point_size = 3.5
+        self.lod_threshold = 5000000 # clouds with more points than this are drawn through an octree
+        self.point_budget = 2000000 # maximum number of points drawn at once, smaller clouds are voxel sampled to it
         self.message = "> Program Started, UI Loaded"
+        # floodfill, box crops and the segment store go through the compute server named by ATLAS_COMPUTE_SERVER, when
+        # it is set and answers, so annotators of the same scans share its clouds and indices
+        self.compute_client = client_from_environment()
+        self.segment_store = SegmentStore("segments.store")
+        if self.compute_client is not None:
+            try:
+                self.compute_client.call("stats")
+                self.segment_store = RemoteSegmentStore(self.compute_client)
+                self.message = "{} \n> Using the compute server at {}".format(self.message, self.compute_client.address)
+            except ComputeServerError as e:
+                self.compute_client = None
+                self.message = "{} \n> {}, computing in process".format(self.message, e)
         self.selected_points_id = []
         self.largest_seg_id = -1
-        self.segmentations = [] # list of segmentations of type Segmentation
+        self.segmentations = {} # segment id -> metadata of the segment, indices are read from segment_store on demand
 
         self.current_data_file_name = None
         self.current_result_point_indices = []
+        self.current_neighbor_graph = None # NeighborGraph of the cloud in the upper scene, loaded on first floodfill
+        self.current_patches = None # PatchGraph of the cloud in the upper scene, loaded on first floodfill using it
+        self.current_grid_index = None # GridIndex of the cloud in the upper scene, loaded on first box crop
+        self.current_label_index = None # LabelIndex of the cloud in the upper scene, built from the store on first use
+        self.floodfill_worker = None # FloodfillWorker that is currently running, None if there is none
+        self.floodfill_trace_mark = None # tracer mark taken when the running floodfill started
+        self.floodfill_state = None # FloodfillState of the result in the lower scene, refined by later operations
+        self.load_worker = None # LoadWorker that is currently running, picking and floodfill wait for it to finish
+        self.load_trace_mark = None # tracer mark taken when the running load started
+        self.highlighted_segment_ids = [] # segmentations highlighted in the upper scene, reapplied once it is loaded
 
         # scene variables -- common
         self.upperScene = Scene()
@@ -42,6 +79,21 @@ class AtlasAnnotationTool(QWidget):
         self.btn_floodfill_done = None
         self.btn_floodfill_cancel = None
 
+        # scene variable -- your function tab
+        self.box_min_spinboxes = None # X, Y, Z lower corner of the box crop
+        self.box_max_spinboxes = None # X, Y, Z upper corner of the box crop
+        self.btn_keep_box = None
+        self.btn_remove_box = None
+        self.combobox_selection_mode = None # what dragging over the upper scene does: rotate, rectangle or lasso select
+        self.checkbox_visible_only = None
+        self.checkbox_patches = None
+        self.checkbox_skip_labeled = None
+        self.spinbox_angle_error_tolerance = None
+        self.btn_apply_tolerance = None
+        self.btn_remove_seed = None
+        self.checkbox_trace = None
+        self.btn_export_trace = None
+
         # setup
         self.setUpDisplay()
         self.wireWidgets()
@@ -60,10 +112,18 @@ class AtlasAnnotationTool(QWidget):
         self.btn_floodfill_done.clicked.connect(self.btn_floodfill_done_clicked)
         self.btn_floodfill_cancel.clicked.connect(self.btn_floodfill_cancel_clicked)
         self.upperScene.canvas.events.mouse_release.connect(self.topCanvasClicked)
+        self.upperScene.canvas.events.mouse_move.connect(self.topCanvasDragged)
         self.btn_common_load.clicked.connect(self.btn_common_load_clicked)
         self.btn_common_save.clicked.connect(self.btn_save_clicked)
         self.btn_common_delete.clicked.connect(self.btn_delete_clicked)
         self.segmentation_list.itemDoubleClicked.connect(self.segmentation_list_item_double_clicked)
+        self.btn_keep_box.clicked.connect(self.btn_keep_box_clicked)
+        self.btn_remove_box.clicked.connect(self.btn_remove_box_clicked)
+        self.combobox_selection_mode.currentIndexChanged.connect(self.combobox_selection_mode_changed)
+        self.btn_apply_tolerance.clicked.connect(self.btn_apply_tolerance_clicked)
+        self.btn_remove_seed.clicked.connect(self.btn_remove_seed_clicked)
+        self.checkbox_trace.toggled.connect(self.checkbox_trace_toggled)
+        self.btn_export_trace.clicked.connect(self.btn_export_trace_clicked)
 
 
     def wireWidgets(self):
@@ -76,6 +136,7 @@ class AtlasAnnotationTool(QWidget):
 
         # segmentation list wiring
         self.segmentation_list = self.base_form.segmentation_layout.itemAt(0).widget()
+        self.segmentation_list.setSelectionMode(QAbstractItemView.ExtendedSelection)
         # scene button wiring
         self.btn_common_save = self.base_form.common_buttons_layout.itemAt(0).widget()
         self.btn_common_load = self.base_form.common_buttons_layout.itemAt(1).widget()
@@ -86,6 +147,24 @@ class AtlasAnnotationTool(QWidget):
         self.btn_floodfill_done = tab_floodfill.widget(0).children()[1]
         self.btn_floodfill_cancel = tab_floodfill.widget(0).children()[2]
 
+        # Your function wiring
+        self.box_min_spinboxes = [self.base_form.spinbox_x_min, self.base_form.spinbox_y_min,
+                                  self.base_form.spinbox_z_min]
+        self.box_max_spinboxes = [self.base_form.spinbox_x_max, self.base_form.spinbox_y_max,
+                                  self.base_form.spinbox_z_max]
+        self.btn_keep_box = self.base_form.btn_keep_box
+        self.btn_remove_box = self.base_form.btn_remove_box
+        self.combobox_selection_mode = self.base_form.combobox_selection_mode
+        self.checkbox_visible_only = self.base_form.checkbox_visible_only
+        self.checkbox_patches = self.base_form.checkbox_patches
+        self.checkbox_skip_labeled = self.base_form.checkbox_skip_labeled
+        self.spinbox_angle_error_tolerance = self.base_form.spinbox_angle_error_tolerance
+        self.btn_apply_tolerance = self.base_form.btn_apply_tolerance
+        self.btn_remove_seed = self.base_form.btn_remove_seed
+        self.checkbox_trace = self.base_form.checkbox_trace
+        self.checkbox_trace.setChecked(tracer.enabled)
+        self.btn_export_trace = self.base_form.btn_export_trace
+
 
     def setUpDisplay(self):
         self.upperScene.canvas = vispy.scene.SceneCanvas(keys='interactive', show=True)
@@ -94,30 +173,30 @@ class AtlasAnnotationTool(QWidget):
     ####### ON CLICK FUNCTIONS #######
     def segmentation_list_item_double_clicked(self):
         '''
-        When an item is double clicked, read that file and render it onto the upper scene
+        When an item is double clicked, highlight it in the upper scene together with the other selected segmentations
+        of the same cloud, each in its own color. The cloud is only loaded if it is not the one shown already.
         '''
         current_item_text = self.segmentation_list.currentItem().text()
         try:
-            current_item_index = int(current_item_text.split(" | ")[0])
-            current_segmentation = self.segmentations[current_item_index]
-            index_to_highlight = current_segmentation.indices
-            fname = str(current_segmentation.data_file_name)
-
-            pcd = o3d.io.read_point_cloud(fname)
-            class DataPCDIsEmptyException(Exception):
-                pass
-            if pcd.is_empty():
-                raise DataPCDIsEmptyException("ERR: Data file at {} is cannot be found or is empty".format(fname))
-
-            color = np.asarray(pcd.colors)
-            for i in index_to_highlight:
-                color[i] = (0, 1, 0)
-            pcd.colors = o3d.utility.Vector3dVector(color)
-
-            self.upperScene.render(pcd)
+            segment_ids = [int(current_item_text.split(" | ")[0])]
         except ValueError as e:
             self.writeMessage("ERR: Index is not an int --> {}".format(current_item_text.split(" | ")[0]))
-
+            return
+        fname = str(self.segmentations[segment_ids[0]]["data_file_name"])
+        for item in self.segmentation_list.selectedItems():
+            try:
+                segment_id = int(item.text().split(" | ")[0])
+            except ValueError:
+                continue
+            if segment_id not in segment_ids and same_file(self.segmentations[segment_id]["data_file_name"], fname):
+                segment_ids.append(segment_id)
+
+        self.highlighted_segment_ids = segment_ids
+        if same_file(fname, self.current_data_file_name) and self.upperScene.pcd is not None \
+                and self.load_worker is None:
+            self.showHighlights()
+        else:
+            self.loadFile(fname)
 
     def btn_common_load_clicked(self):
         '''
@@ -126,41 +205,127 @@ class AtlasAnnotationTool(QWidget):
         filename = self.openFileNamesDialog()
         # do filetype checking here
         if filename:
-            self.current_data_file_name = filename
-            self.writeMessage("Opening file <{}>".format(filename))
-            self.upperScene.render(o3d.io.read_point_cloud(filename))
+            self.highlighted_segment_ids = []
+            self.loadFile(filename)
 
     def btn_floodfill_done_clicked(self):
         '''
         When the floodfill button is clicked
-        1. get the selected points
-        2. get the surface that needs to be cropped
-        3. render the result in the lower scene
+        1. get the selected points, 3 points start a new surface, 1 point grows the current surface from it as a seed
+        2. get the surface that needs to be cropped, in a background worker
+        3. render the partial results and then the result in the lower scene as the worker reports them
         '''
-        try:
-            surface_to_crop = floodfill(self.selected_points_id, self.upperScene.pcd)
-            self.current_result_point_indices = surface_to_crop
-            new_pcd = crop_reserve(self.upperScene.pcd, surface_to_crop)
-            self.lowerScene.render(new_pcd)
-
-        except Exception as e:
-            self.writeMessage(str(e))
+        if self.floodfill_worker is not None:
+            self.writeMessage("Floodfill is still running, click Cancel to stop it")
+            return
+        if self.upperScene.pcd is None:
+            self.writeMessage("No point cloud is loaded")
+            return
+        if self.floodfill_state is not None and len(self.selected_points_id) == 1:
+            self.startFloodfillWorker(("add_seed", (self.selected_points_id[0],)))
+        else:
+            self.floodfill_state = None
+            self.startFloodfillWorker()
         self.writeMessage("Selected Points is cleared")
         self.selected_points_id = []
+        self.upperScene.show_selection(self.selected_points_id)
 
     def btn_floodfill_cancel_clicked(self):
         '''
         When cancel is clicked
-        1. clear all selected points
-        2. clear the lower scene
+        1. stop the running floodfill
+        2. clear all selected points
+        3. clear the lower scene
         '''
+        self.stopFloodfillWorker()
         self.writeMessage("Selected Segmentation Cancelled".format(len(self.selected_points_id)))
         self.selected_points_id = []
+        self.upperScene.show_selection(self.selected_points_id)
         self.current_result_point_indices = []
         self.lowerScene.clear()
 
+    def btn_keep_box_clicked(self):
+        '''
+        Crop out the points inside the X, Y, Z box
+        '''
+        self.cropBox(keep_inside=True)
+
+    def btn_remove_box_clicked(self):
+        '''
+        Crop out the points outside the X, Y, Z box
+        '''
+        self.cropBox(keep_inside=False)
+
+    def combobox_selection_mode_changed(self, index):
+        '''
+        Switch dragging over the upper scene between rotating the camera and selecting points
+        '''
+        self.applySelectionMode()
+
+    def btn_apply_tolerance_clicked(self):
+        '''
+        Redo the current surface with the angle tolerance of the spin box, relaxing it only tests the points it rejected
+        '''
+        if self.floodfill_state is None:
+            self.writeMessage("There is no floodfill result to apply the tolerance to")
+            return
+        self.startFloodfillWorker(("set_angle_error_tolerance", (self.spinbox_angle_error_tolerance.value(),)))
+
+    def btn_remove_seed_clicked(self):
+        '''
+        Remove the area the last added seed grew, the first seed can only be removed by cancelling
+        '''
+        if self.floodfill_state is None or len(self.floodfill_state.seeds()) < 2:
+            self.writeMessage("There is no added seed to remove")
+            return
+        self.startFloodfillWorker(("remove_seed", (self.floodfill_state.seeds()[-1],)))
+
+    def checkbox_trace_toggled(self, checked):
+        '''
+        Start or stop recording timing spans and counters, summaries are written to the message center
+        '''
+        tracer.enabled = checked
+        self.writeMessage("Trace recording {}".format("started" if checked else "stopped"))
+
+    def btn_export_trace_clicked(self):
+        '''
+        Save everything recorded this session as a Chrome trace, open it in chrome://tracing
+        '''
+        file_name, _ = QFileDialog.getSaveFileName(self, "Export Trace", "trace.json", "JSON Files (*.json)",
+                                                   options=QFileDialog.DontUseNativeDialog)
+        if file_name:
+            tracer.export_chrome_trace(file_name)
+            self.writeMessage("Trace exported to <{}>".format(file_name))
+
     def btn_delete_clicked(self):
-        print("NOT IMPLEMENTED YET")
+        '''
+        When delete is clicked, delete the selected segmentation and update the intersections of the ones it overlapped
+        '''
+        item = self.segmentation_list.currentItem()
+        if item is None:
+            self.writeMessage("No segmentation is selected")
+            return
+        try:
+            segment_id = int(item.text().split(" | ")[0])
+        except ValueError:
+            self.writeMessage("ERR: Index is not an int --> {}".format(item.text().split(" | ")[0]))
+            return
+        try:
+            label_index = self.labelIndex(self.segmentations[segment_id]["data_file_name"])
+            overlapping = list(label_index.overlaps(segment_id))
+            indices = self.segment_store.read_indices(segment_id)
+            self.segment_store.delete(segment_id)
+        except ComputeServerError as e:
+            self.writeMessage(str(e))
+            return
+        label_index.remove(segment_id, indices)
+        self.updateIntersections(label_index, overlapping)
+        self.segmentation_list.takeItem(self.segmentation_list.row(item))
+        del self.segmentations[segment_id]
+        self.writeMessage("Deleted segmentation {}".format(segment_id))
+        if segment_id in self.highlighted_segment_ids and self.load_worker is None:
+            self.highlighted_segment_ids.remove(segment_id)
+            self.showHighlights()
 
     def btn_save_clicked(self):
         '''
@@ -173,36 +338,30 @@ class AtlasAnnotationTool(QWidget):
         if len(self.current_result_point_indices) == 0:
             self.writeMessage("There are no points to save")
         else:
-            import json
-            a = []
-            if not os.path.isfile(self.data_fname):
-                self.largest_seg_id = self.largest_seg_id + 1
-                segment = Segment(id=self.largest_seg_id,
-                                  data_file_name=self.current_data_file_name,
-                                  segment_name=data["seg_name"],
-                                  indices=self.current_result_point_indices,
-                                  type_class=(data["type_class"], 1)
-                                  )
-                self.addSegmentationItem(segment)
-                entry = segment.json()
-                a.append(entry)
-                with open(self.data_fname, mode='w') as f:
-                    f.write(json.dumps(a, indent=2))
-            else:
-                with open(self.data_fname) as feedsjson:
-                    feeds = json.load(feedsjson)
-                self.largest_seg_id = len(feeds)
-                segment = Segment(id=self.largest_seg_id,
-                                  data_file_name=self.current_data_file_name,
-                                  segment_name=data["seg_name"],
-                                  indices=self.current_result_point_indices,
-                                  type_class=(data["type_class"], 1)
-                                  )
-                self.addSegmentationItem(segment)
-                entry = segment.json()
-                feeds.append(entry)
-                with open(self.data_fname, mode='w') as f:
-                    f.write(json.dumps(feeds, indent=2))
+            # indices go to the store as an array, validating a crop of millions of points as a list is slow
+            # the id is given by the store, other annotators may be saving to it too
+            segment = Segment(id=-1,
+                              data_file_name=self.current_data_file_name,
+                              segment_name=data["seg_name"],
+                              indices=[],
+                              type_class=(data["type_class"], 1)
+                              )
+            indices = np.sort(np.asarray(self.current_result_point_indices, dtype=np.int64))
+            mark = tracer.mark()
+            try:
+                label_index = self.labelIndex(self.current_data_file_name)
+                with tracer.span("segment_store.put"):
+                    self.largest_seg_id = self.segment_store.put_new(segment.dict(exclude={"indices"}), indices)
+                segment.id = self.largest_seg_id
+                metadata = self.segment_store.metadata(segment.id)
+            except ComputeServerError as e:
+                self.writeMessage(str(e))
+                return
+            label_index.add(segment.id, indices)
+            self.addSegmentationItem(metadata)
+            self.updateIntersections(label_index, [segment.id] + list(label_index.overlaps(segment.id)))
+            self.writeTraceSummary(mark)
+            self.floodfill_state = None
             self.lowerScene.clear()
 
     def topCanvasClicked(self, event):
@@ -210,56 +369,106 @@ class AtlasAnnotationTool(QWidget):
         When the top canvas is clicked
         1. rotate the scene if necessary
         2. record the point clicked if necessary
-        3. show the points clicked (STILL NEED TO IMPLEMENT)
+        3. show the points clicked
         :param event: event that the top canvas is clicked.
         :return:
         '''
-        pcd = self.upperScene.pcd
-        points = np.asarray(pcd.points)
-        colors = np.asarray(pcd.colors)
-        # axis = scene.visuals.XYZAxis(parent=self.upper.scene)
-
-        # prepare list of unique colors needed for picking
-        ids = np.arange(1, len(points) + 1, dtype=np.uint32).view(np.uint8)
-        ids = ids.reshape(-1, 4)
-        ids = np.divide(ids, 255, dtype=np.float32)
-        # connect events
-        if event.button == 1 and self.distance_traveled(event.trail()) <= 2:
-            pos = self.upperScene.canvas.transforms.canvas_transform.map(event.pos)
-            try:
-                self.upperScene.marker.update_gl_state(blend=False)
-                self.upperScene.marker.antialias = 0
-                self.upperScene.marker.set_data(points, edge_color=ids, face_color=ids, size=self.point_size)
-                img = self.upperScene.canvas.render((pos[0] - 2,
-                                                     pos[1] - 2,
-                                                     2 * 10 + 1,
-                                                     2 * 10 + 1),
-                                                    bgcolor=vispy.color.ColorArray('red'))
-                self.upperScene.canvas.update()
-                # TODO make the dots appear
-            finally:
-                self.upperScene.marker.update_gl_state(blend=True)
-                self.upperScene.marker.antialias = 1
-                self.upperScene.marker.set_data(points, edge_color=colors, face_color=colors, size=self.point_size)
-            # We pick the pixel directly under the click, unless it is
-            # zero, in which case we look for the most common nonzero
-            # pixel value in a square region centered on the click.
-            idxs = img.ravel().view(np.uint32)
-            idx = idxs[len(idxs) // 2]
-
-            if idx == 0:
-                idxs, counts = np.unique(idxs, return_counts=True)
-                idxs = idxs[np.argsort(counts)]
-                idx = idxs[-1] or (len(idxs) > 1 and idxs[-2])
-            # call the callback function
-            if idx > 0:
+        self.upperScene.show_outline([])
+        if self.upperScene.pcd is None or self.load_worker is not None:
+            return
+        if self.isSelectionDrag(event) and self.distance_traveled(event.trail()) > 2:
+            self.selectPolygon(self.dragPolygon(event), event.modifiers)
+        elif event.button == 1 and self.distance_traveled(event.trail()) <= 2:
+            idx = self.upperScene.pick(event.pos)
+            if idx is not None:
+                self.selected_points_id.append(idx)
+                self.upperScene.show_selection(self.selected_points_id)
+                self.writeMessage("Selected Points {}".format(self.selected_points_id))
                 try:
-                    points[idx]
-                    self.selected_points_id.append(idx)  # TODO how to you not add a point if it is index out of range
-                    # p1.set_data(points, edge_color=colors, face_color=colors, size=2)
-                    self.writeMessage("Selected Points {}".format(self.selected_points_id))
-                except IndexError:
-                    self.writeMessage("The point {} is not in the point cloud".format(idx))
+                    segment_ids = self.labelIndex(self.current_data_file_name).segments_at(idx)
+                except ComputeServerError as e:
+                    self.writeMessage(str(e))
+                    return
+                if segment_ids:
+                    self.writeMessage("Point {} is in segmentations {}".format(idx, segment_ids))
+
+    def topCanvasDragged(self, event):
+        '''
+        Draw the rectangle or lasso being dragged over the top canvas
+        '''
+        if self.upperScene.pcd is not None and self.load_worker is None and self.isSelectionDrag(event):
+            self.upperScene.show_outline(self.dragPolygon(event))
+
+    ####### FLOODFILL WORKER SLOTS #######
+    # signals of a cancelled worker can still be queued, they are dropped by checking the sender
+
+    def floodfill_graph_loaded(self, data_file_name, graph):
+        cloud_cache.put_derived(data_file_name, "neighbor_graph", graph)
+        if data_file_name == self.current_data_file_name:
+            self.current_neighbor_graph = graph
+
+    def floodfill_patches_loaded(self, data_file_name, patches):
+        cloud_cache.put_derived(data_file_name, "patches", patches)
+        if data_file_name == self.current_data_file_name:
+            self.current_patches = patches
+
+    def floodfill_progress(self, message):
+        if self.sender() is self.floodfill_worker:
+            self.writeMessage(message)
+
+    def floodfill_partial_result(self, surface, pcd):
+        if self.sender() is self.floodfill_worker:
+            self.renderLowerScene(pcd)
+
+    def floodfill_result(self, surface, pcd, state):
+        if self.sender() is self.floodfill_worker:
+            self.floodfill_worker = None
+            self.floodfill_state = state
+            self.current_result_point_indices = surface
+            self.renderLowerScene(pcd)
+            self.writeMessage("Floodfill done, {} points".format(len(surface)))
+            self.writeTraceSummary(self.floodfill_trace_mark)
+
+    def floodfill_error(self, message):
+        if self.sender() is self.floodfill_worker:
+            self.floodfill_worker = None
+            self.floodfill_state = None
+            self.writeMessage(message)
+
+    ####### LOAD WORKER SLOTS #######
+
+    def load_progress(self, message):
+        if self.sender() is self.load_worker:
+            self.writeMessage(message)
+
+    def load_preview(self, pcd):
+        if self.sender() is self.load_worker:
+            self.upperScene.render(pcd)
+            self.applySelectionMode()
+
+    def load_result(self, entry):
+        if self.sender() is self.load_worker:
+            self.load_worker = None
+            self.btn_floodfill_done.setEnabled(True)
+            # structures derived from the cloud on an earlier visit are reused
+            self.current_neighbor_graph = entry.derived.get("neighbor_graph")
+            self.current_patches = entry.derived.get("patches")
+            self.current_grid_index = entry.derived.get("grid_index")
+            self.current_label_index = entry.derived.get("label_index")
+            self.renderUpperScene(entry.pcd, self.current_data_file_name, entry.derived["display"],
+                                  entry.derived["bounds"])
+            self.showHighlights()
+            stats = cloud_cache.stats()
+            self.writeMessage("Loaded {} points, cloud cache: {} hits, {} misses, {} of {} MB used".format(
+                len(entry.pcd.points), stats["hits"], stats["misses"], stats["nbytes"] >> 20,
+                stats["byte_budget"] >> 20))
+            self.writeTraceSummary(self.load_trace_mark)
+
+    def load_error(self, message):
+        if self.sender() is self.load_worker:
+            self.load_worker = None
+            self.btn_floodfill_done.setEnabled(True)
+            self.writeMessage(message)
 
     ####### UTILITIES FUNCTIONS #######
 
@@ -280,9 +489,263 @@ class AtlasAnnotationTool(QWidget):
         """
         return np.sum(np.abs(np.diff(positions, axis=0)))
 
-    def addSegmentationItem(self, segment):
-        self.segmentations.append(segment)
-        self.segmentation_list.addItem("{} | {} | {}".format(segment.id, segment.segment_name, segment.type_class))
+    def loadFile(self, filename):
+        '''
+        Load a file in a background worker and render it onto the upper scene, previews of growing size are rendered
+        while it loads, picking and floodfill are disabled until the full cloud is ready
+        '''
+        self.stopFloodfillWorker()
+        self.stopLoadWorker()
+        self.current_data_file_name = filename
+        self.current_neighbor_graph = None
+        self.current_patches = None
+        self.current_grid_index = None
+        self.current_label_index = None
+        self.selected_points_id = []
+        self.writeMessage("Opening file <{}>".format(filename))
+        worker = LoadWorker(filename, self.lod_threshold, self.point_budget, parent=self)
+        worker.progress.connect(self.load_progress)
+        worker.preview.connect(self.load_preview)
+        worker.result.connect(self.load_result)
+        worker.error.connect(self.load_error)
+        worker.finished.connect(worker.deleteLater)
+        self.load_worker = worker
+        self.load_trace_mark = tracer.mark()
+        self.btn_floodfill_done.setEnabled(False)
+        worker.start()
+
+    def showHighlights(self):
+        '''
+        Highlight highlighted_segment_ids in the upper scene, the first one in green
+        '''
+        segment_ids = [segment_id for segment_id in self.highlighted_segment_ids if segment_id in self.segmentations]
+        with tracer.span("highlight"):
+            try:
+                highlights = [(self.segment_store.read_indices(segment_id), HIGHLIGHT_COLORS[i % len(HIGHLIGHT_COLORS)])
+                              for i, segment_id in enumerate(segment_ids)]
+            except ComputeServerError as e:
+                self.writeMessage(str(e))
+                return
+            self.upperScene.highlight(highlights)
+        if segment_ids:
+            self.writeMessage("Highlighting segmentations {}".format(segment_ids))
+
+    def renderUpperScene(self, pcd, data_file_name, display=None, bounds=None):
+        '''
+        Render pcd in the upper scene, clouds larger than lod_threshold are streamed from their octree, clouds larger
+        than point_budget are drawn as a voxel sample. Either way the scene maps drawn points back to pcd's point ids.
+        :param display: (octree, voxel sample ids) as returned by lod.prepare_display, prepared here if None
+        :param bounds: (min, max) corners of pcd, computed here if None
+        '''
+        if display is None:
+            with tracer.span("prepare_display"):
+                display = prepare_display(data_file_name, pcd, self.lod_threshold, self.point_budget)
+        octree, indices = display
+        if octree is not None:
+            self.writeMessage("Large point cloud, drawing at most {} points at a time".format(self.point_budget))
+            self.upperScene.render_lod(pcd, octree, self.point_budget)
+        elif indices is not None:
+            self.writeMessage("Large point cloud, drawing {} of {} points".format(len(indices), len(pcd.points)))
+            self.upperScene.render(pcd, indices=indices)
+        else:
+            self.upperScene.render(pcd)
+        if bounds is None and len(pcd.points) != 0:
+            bounds = np.asarray(pcd.points).min(axis=0), np.asarray(pcd.points).max(axis=0)
+        if bounds is not None:
+            for spinbox, value in zip(self.box_min_spinboxes + self.box_max_spinboxes,
+                                      np.concatenate(bounds).tolist()):
+                spinbox.setValue(value)
+        self.applySelectionMode()
+
+    def renderLowerScene(self, pcd, indices=None):
+        '''
+        Render the points of pcd given by indices, or all of them, in the lower scene, voxel sampled to point_budget
+        '''
+        count = len(pcd.points) if indices is None else len(indices)
+        if count > self.point_budget:
+            with tracer.span("voxel_sample"):
+                points = np.asarray(pcd.points) if indices is None else np.asarray(pcd.points)[indices]
+                sample = voxel_sample(points, self.point_budget)
+            indices = sample if indices is None else np.asarray(indices)[sample]
+        self.lowerScene.render(pcd, indices=indices)
+
+    def cropBox(self, keep_inside):
+        '''
+        Crop the cloud in the upper scene by the X, Y, Z box and draw the result in the lower scene
+        The result is kept as point ids into the upper scene's cloud, points are only copied to be drawn
+        :param keep_inside: keep the points inside the box, or the ones outside of it
+        '''
+        if self.upperScene.pcd is None or self.load_worker is not None:
+            self.writeMessage("No point cloud is loaded")
+            return
+        box_min = [spinbox.value() for spinbox in self.box_min_spinboxes]
+        box_max = [spinbox.value() for spinbox in self.box_max_spinboxes]
+        for axis, low, high in zip("XYZ", box_min, box_max):
+            if low > high:
+                self.writeMessage("ERR: {} min {} is larger than {} max {}".format(axis, low, axis, high))
+                return
+        self.stopFloodfillWorker()
+        mark = tracer.mark()
+        with tracer.span("crop_box"):
+            if self.compute_client is not None:
+                try:
+                    indices = self.compute_client.call("crop_box", os.path.abspath(self.current_data_file_name),
+                                                       box_min, box_max, keep_inside)
+                except ComputeServerError as e:
+                    self.writeMessage(str(e))
+                    return
+            else:
+                if self.current_grid_index is None:
+                    self.current_grid_index = load_grid_index(self.current_data_file_name, self.upperScene.pcd)
+                    cloud_cache.put_derived(self.current_data_file_name, "grid_index", self.current_grid_index)
+                indices = self.current_grid_index.query_box(box_min, box_max)
+                if not keep_inside:
+                    indices = complement(indices, len(self.current_grid_index))
+        self.writeTraceSummary(mark)
+        if len(indices) == 0:
+            self.writeMessage("ERR: No points in the cropped region")
+            return
+        self.current_result_point_indices = indices
+        self.renderLowerScene(self.upperScene.pcd, indices)
+        self.writeMessage("Cropped {} points".format(len(indices)))
+
+    def applySelectionMode(self):
+        '''
+        The camera of the upper scene only follows the mouse while dragging does not select points
+        '''
+        if self.upperScene.view is not None:
+            self.upperScene.view.camera.interactive = self.combobox_selection_mode.currentIndex() == 0
+
+    def isSelectionDrag(self, event):
+        return self.combobox_selection_mode.currentIndex() != 0 and event.press_event is not None \
+               and event.press_event.button == 1
+
+    def dragPolygon(self, event):
+        '''
+        :return: (m, 2) canvas positions of the rectangle or lasso dragged so far
+        '''
+        if self.combobox_selection_mode.currentText() == "Rectangle":
+            return rectangle_polygon(event.press_event.pos, event.pos)
+        return np.asarray(event.trail(), dtype=np.float64)
+
+    def selectPolygon(self, polygon, modifiers=()):
+        '''
+        Select the points of the upper scene's cloud inside a rectangle or lasso and draw them in the lower scene
+        The selection replaces the current result, holding Shift adds to it and holding Control removes from it
+        :param polygon: (m, 2) canvas positions
+        :param modifiers: keys held while dragging
+        '''
+        mark = tracer.mark()
+        indices = self.upperScene.select_polygon(polygon, self.checkbox_visible_only.isChecked())
+        current = np.asarray(self.current_result_point_indices, dtype=np.int64)
+        if keys.SHIFT in modifiers:
+            indices = np.union1d(current, indices)
+        elif keys.CONTROL in modifiers:
+            indices = np.setdiff1d(current, indices)
+        self.writeTraceSummary(mark)
+        if len(indices) == 0:
+            self.writeMessage("ERR: No points in the selected region")
+            return
+        self.stopFloodfillWorker()
+        self.current_result_point_indices = indices
+        self.renderLowerScene(self.upperScene.pcd, indices)
+        self.writeMessage("Selected {} points".format(len(indices)))
+
+    def startFloodfillWorker(self, operation=None):
+        '''
+        Run a floodfill of the selected points, or an operation refining the current floodfill state, in the background
+        :param operation: (name, args) of the FloodfillState method to run, None to start a new floodfill
+        '''
+        if self.floodfill_worker is not None:
+            self.writeMessage("Floodfill is still running, click Cancel to stop it")
+            return
+        allowed = None
+        if self.checkbox_skip_labeled.isChecked() and self.floodfill_state is None:
+            try:
+                allowed = self.labelIndex(self.current_data_file_name).unlabeled_mask()
+            except ComputeServerError as e:
+                self.writeMessage(str(e))
+                return
+        worker = FloodfillWorker(self.selected_points_id, self.upperScene.pcd, self.current_data_file_name,
+                                 graph=self.current_neighbor_graph, patches=self.current_patches,
+                                 use_patches=self.checkbox_patches.isChecked(), client=self.compute_client,
+                                 state=self.floodfill_state, operation=operation, parent=self,
+                                 angle_error_tolerance=self.spinbox_angle_error_tolerance.value(), allowed=allowed)
+        worker.graph_loaded.connect(self.floodfill_graph_loaded)
+        worker.patches_loaded.connect(self.floodfill_patches_loaded)
+        worker.progress.connect(self.floodfill_progress)
+        worker.partial_result.connect(self.floodfill_partial_result)
+        worker.result.connect(self.floodfill_result)
+        worker.error.connect(self.floodfill_error)
+        worker.finished.connect(worker.deleteLater)
+        self.floodfill_worker = worker
+        self.floodfill_trace_mark = tracer.mark()
+        worker.start()
+
+    def stopFloodfillWorker(self):
+        '''
+        Cancel the running floodfill, if any, its remaining signals are ignored
+        The floodfill state is dropped too, a cancelled refinement leaves it half refined
+        '''
+        if self.floodfill_worker is not None:
+            self.floodfill_worker.cancel()
+            self.floodfill_worker = None
+        self.floodfill_state = None
+
+    def stopLoadWorker(self):
+        '''
+        Cancel the running load, if any, its remaining signals are ignored
+        '''
+        if self.load_worker is not None:
+            self.load_worker.cancel()
+            self.load_worker = None
+            self.btn_floodfill_done.setEnabled(True)
+
+    def labelIndex(self, data_file_name):
+        '''
+        :return: LabelIndex of a cloud, the one of the upper scene's cloud and the ones of cached clouds are kept and
+                 updated, others are built from the segment store for the call
+        :raise ComputeServerError: if it is built from the compute server's store and the server fails
+        '''
+        if same_file(data_file_name, self.current_data_file_name) and self.upperScene.pcd is not None \
+                and self.load_worker is None:
+            if self.current_label_index is None:
+                with tracer.span("label_index.build"):
+                    self.current_label_index = LabelIndex.from_store(self.segment_store, data_file_name,
+                                                                     len(self.upperScene.pcd.points))
+                cloud_cache.put_derived(data_file_name, "label_index", self.current_label_index)
+            return self.current_label_index
+        entry = cloud_cache.peek(data_file_name)
+        if entry is not None and "label_index" in entry.derived:
+            return entry.derived["label_index"]
+        with tracer.span("label_index.build"):
+            return LabelIndex.from_store(self.segment_store, data_file_name)
+
+    def updateIntersections(self, label_index, segment_ids):
+        '''
+        Store the number of other segmentations every given segmentation shares points with as its intersection
+        '''
+        try:
+            for segment_id in segment_ids:
+                self.segment_store.update_metadata(segment_id, intersection=len(label_index.overlaps(segment_id)))
+                self.segmentations[segment_id] = self.segment_store.metadata(segment_id)
+        except ComputeServerError as e:
+            self.writeMessage(str(e))
+
+    def addSegmentationItem(self, metadata):
+        '''
+        :param metadata: segment metadata as returned by SegmentStore.entries
+        '''
+        self.segmentations[metadata["id"]] = metadata
+        type_class = tuple(metadata["type_class"]) if metadata["type_class"] is not None else None
+        self.segmentation_list.addItem("{} | {} | {}".format(metadata["id"], metadata["segment_name"], type_class))
+
+    def writeTraceSummary(self, mark):
+        '''
+        Write what was recorded since mark to the message center, if recording
+        '''
+        if tracer.enabled and mark is not None:
+            self.writeMessage("Trace: {}".format(tracer.summary(mark)))
 
     def writeMessage(self, message):
         '''
@@ -297,17 +760,21 @@ class AtlasAnnotationTool(QWidget):
     def populateSegmentList(self):
         '''
         On start, populate a list of segmentations that user previously did
+        Only segment metadata is read here, indices are read when a segment is opened
+        A segments.json from before the segment store existed is imported into the store once
         '''
         try:
-            import json
-            with open(self.data_fname, 'r') as f:
-                segmentations = json.load(f)
-            for segment in segmentations:
-                segment_dict = json.loads(segment)
-                seg = Segment(**segment_dict)
-                self.addSegmentationItem(seg)
-        except FileNotFoundError as e:
+            if len(self.segment_store) == 0 and os.path.isfile(self.data_fname):
+                count = self.segment_store.import_json(self.data_fname)
+                self.writeMessage("Imported {} segmentations from {}".format(count, self.data_fname))
+            entries = self.segment_store.entries()
+        except ComputeServerError as e:
+            self.writeMessage(str(e))
+            return
+        if len(entries) == 0:
             self.writeMessage("No segmentations detected")
+        for metadata in entries:
+            self.addSegmentationItem(metadata)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -8,7 +8,7 @@ class Segment(BaseModel):
     indices: List[int]
     type: str = "Layout"
     type_class: Tuple[str, int] = None
-    intersection: int = 0
+    intersection: int = 0 # number of other segments sharing points with this one
     plane_equation: Tuple[List[float], float] = None
     vertices: List[List[float]] = None
 
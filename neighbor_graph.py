@@ -0,0 +1,102 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from csr import row_offsets
+from instrumentation import tracer
+from sidecar import load_arrays, save_arrays
+
+DEFAULT_K = 10  # matches floodfill's default batch_size
+QUERY_CHUNK_SIZE = 1 << 18  # points per KD-tree query, bounds the temporary (chunk, k) arrays
+
+
+class NeighborGraph:
+    '''
+    k nearest neighbor adjacency in CSR form plus per point normals
+
+    Row i of the adjacency holds the neighbors of point i ordered by distance, the point itself excluded. So the
+    first batch_size - 1 entries of a row are what a batch_size nearest neighbor search around the point returns.
+    '''
+
+    def __init__(self, indptr, indices, normals, k):
+        self.indptr = indptr  # (n + 1,) row offsets into indices
+        self.indices = indices  # (nnz,) neighbor ids
+        self.normals = normals  # (n, 3) unit normals
+        self.k = k  # size of the nearest neighbor search the rows came from, point itself included
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def neighbors(self, ids, limit=None):
+        '''
+        Gather the neighbor rows of many points at once
+        :param ids: array of point ids
+        :param limit: only take the first limit (closest) neighbors of each row
+        :return: flat array of neighbor ids, may contain duplicates
+        '''
+        ids = np.asarray(ids)
+        starts = self.indptr[ids]
+        ends = self.indptr[ids + 1]
+        if limit is not None:
+            ends = np.minimum(ends, starts + limit)
+        lengths = ends - starts
+        offsets = row_offsets(starts, lengths)
+        return self.indices[offsets]
+
+    @staticmethod
+    def build(coordinates, normals, k=DEFAULT_K):
+        '''
+        :param coordinates: (n, 3) point positions
+        :param normals: (n, 3) point normals
+        :param k: number of nearest neighbors to search, the point itself included
+        '''
+        coordinates = np.asarray(coordinates)
+        n = len(coordinates)
+        with tracer.span("neighbor_graph.kd_tree"):
+            kd_tree = cKDTree(coordinates)
+        rows = []
+        with tracer.span("neighbor_graph.knn_queries"):
+            for start in range(0, n, QUERY_CHUNK_SIZE):
+                _, idx = kd_tree.query(coordinates[start:start + QUERY_CHUNK_SIZE], k=k)
+                rows.append(np.asarray(idx, dtype=np.int64).reshape(-1, k)[:, 1:])
+        tracer.count("neighbor_graph.knn_queries", n)
+        rows = np.concatenate(rows) if rows else np.zeros((0, max(k - 1, 0)), dtype=np.int64)
+        # scipy pads missing neighbors with n when the cloud has fewer than k points
+        valid = rows < n
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(valid.sum(axis=1), out=indptr[1:])
+        return NeighborGraph(indptr, rows[valid].astype(np.int32), np.asarray(normals, dtype=np.float32), k)
+
+    @staticmethod
+    def from_pcd(pcd, k=DEFAULT_K):
+        return NeighborGraph.build(np.asarray(pcd.points), estimate_normals(pcd), k)
+
+
+def estimate_normals(pcd):
+    '''
+    :return: the normals of the Open3D pcd, estimated if it does not have them yet
+    '''
+    if not pcd.has_normals():
+        with tracer.span("estimate_normals"):
+            pcd.estimate_normals()
+    return np.asarray(pcd.normals)
+
+
+def load_neighbor_graph(data_file_name, pcd, k=DEFAULT_K):
+    '''
+    Load the neighbor graph of a point cloud file from its sidecar, building and saving it if it is missing or stale
+    :param data_file_name: path of the file pcd was read from
+    :param pcd: the Open3D pcd read from data_file_name
+    :param k: number of nearest neighbors to search, the point itself included
+    :return: NeighborGraph, memory-mapped when it came from the sidecar
+    '''
+    params = {"k": k}
+    with tracer.span("neighbor_graph.load"):
+        arrays = load_arrays(data_file_name, "neighbors", params)
+    if arrays is not None and len(arrays["indptr"]) == len(pcd.points) + 1:
+        return NeighborGraph(arrays["indptr"], arrays["indices"], arrays["normals"], k)
+    with tracer.span("neighbor_graph.build"):
+        graph = NeighborGraph.from_pcd(pcd, k)
+    with tracer.span("neighbor_graph.save"):
+        save_arrays(data_file_name, "neighbors",
+                    {"indptr": graph.indptr, "indices": graph.indices, "normals": graph.normals}, params)
+    return graph
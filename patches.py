@@ -0,0 +1,123 @@
+'''
+Over-segmentation of a point cloud into small voxel patches, for floodfill to grow over instead of raw points
+
+Every point belongs to the patch of the voxel it falls in. A patch stores its centroid, its radius (distance of its
+farthest point to the centroid), its mean point normal and the largest angle between a point normal and that mean.
+Those bound the floodfill tests of all of the patch's points at once, so a patch can be accepted or rejected as a
+whole and only patches where the bounds are inconclusive have to be tested point by point. Two patches are adjacent
+when a neighbor graph edge goes from a point of one to a point of the other.
+'''
+import numpy as np
+
+from csr import row_offsets
+from instrumentation import tracer
+from sidecar import load_arrays, save_arrays
+
+DEFAULT_VOXEL_SIZE = 0.15
+
+
+class PatchGraph:
+    def __init__(self, arrays, voxel_size, k):
+        self.patch_of = arrays["patch_of"]  # (n,) patch id of every point
+        self.order = arrays["order"]  # (n,) point ids sorted by patch
+        self.patch_start = arrays["patch_start"]  # (p + 1,) offsets of every patch's points into order
+        self.centroid = arrays["centroid"]  # (p, 3)
+        self.radius = arrays["radius"]  # (p,)
+        self.normal = arrays["normal"]  # (p, 3) unit mean point normal
+        self.normal_spread = arrays["normal_spread"]  # (p,) largest angle between a point normal and normal
+        self.adjacency_indptr = arrays["adjacency_indptr"]  # (p + 1,) CSR adjacency between patches
+        self.adjacency_indices = arrays["adjacency_indices"]
+        self.voxel_size = voxel_size
+        self.k = k  # size of the nearest neighbor search the adjacency came from
+
+    def __len__(self):
+        return len(self.patch_start) - 1
+
+    def arrays(self):
+        return {"patch_of": self.patch_of, "order": self.order, "patch_start": self.patch_start,
+                "centroid": self.centroid, "radius": self.radius, "normal": self.normal,
+                "normal_spread": self.normal_spread, "adjacency_indptr": self.adjacency_indptr,
+                "adjacency_indices": self.adjacency_indices}
+
+    def points_of(self, patch_ids):
+        '''
+        :return: flat array of the point ids of the given patches
+        '''
+        patch_ids = np.asarray(patch_ids)
+        starts = self.patch_start[patch_ids]
+        lengths = self.patch_start[patch_ids + 1] - starts
+        offsets = row_offsets(starts, lengths)
+        return self.order[offsets]
+
+    def neighbors(self, patch_ids):
+        '''
+        :return: flat array of the patches adjacent to the given patches, may contain duplicates
+        '''
+        patch_ids = np.asarray(patch_ids)
+        starts = self.adjacency_indptr[patch_ids]
+        lengths = self.adjacency_indptr[patch_ids + 1] - starts
+        offsets = row_offsets(starts, lengths)
+        return self.adjacency_indices[offsets]
+
+    @staticmethod
+    def build(coordinates, graph, voxel_size=DEFAULT_VOXEL_SIZE):
+        '''
+        :param coordinates: (n, 3) point positions
+        :param graph: NeighborGraph of the points, for normals and adjacency
+        :param voxel_size: edge length of the voxels the points are grouped by
+        '''
+        coordinates = np.asarray(coordinates, dtype=np.float64)
+        normals = np.asarray(graph.normals, dtype=np.float64)
+        n = len(coordinates)
+
+        voxel = np.floor((coordinates - coordinates.min(axis=0)) / voxel_size).astype(np.int64)
+        dims = voxel.max(axis=0) + 1
+        _, patch_of = np.unique((voxel[:, 0] * dims[1] + voxel[:, 1]) * dims[2] + voxel[:, 2], return_inverse=True)
+        patch_of = patch_of.reshape(-1).astype(np.int32)
+        order = np.argsort(patch_of, kind='mergesort').astype(np.int64)
+        counts = np.bincount(patch_of)
+        patch_start = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=patch_start[1:])
+        first = patch_start[:-1]
+
+        centroid = np.stack([np.bincount(patch_of, coordinates[:, axis]) for axis in range(3)], axis=1) \
+                   / counts[:, None]
+        radius = np.maximum.reduceat(np.linalg.norm(coordinates[order] - centroid[patch_of[order]], axis=1), first)
+        normal = np.stack([np.bincount(patch_of, normals[:, axis]) for axis in range(3)], axis=1)
+        normal /= np.maximum(np.linalg.norm(normal, axis=1), 1e-12)[:, None]
+        angles = np.arccos(np.clip(np.sum(normals[order] * normal[patch_of[order]], axis=1), -1, 1))
+        normal_spread = np.maximum.reduceat(angles, first)
+
+        # directed patch adjacency from the neighbor graph edges that cross patches
+        source = np.repeat(np.arange(n), np.diff(graph.indptr))
+        source_patch = patch_of[source].astype(np.int64)
+        target_patch = patch_of[np.asarray(graph.indices)].astype(np.int64)
+        crossing = source_patch != target_patch
+        edges = np.unique(source_patch[crossing] * len(counts) + target_patch[crossing])
+        adjacency_indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edges // len(counts), minlength=len(counts)), out=adjacency_indptr[1:])
+        adjacency_indices = (edges % len(counts)).astype(np.int32)
+
+        arrays = {"patch_of": patch_of, "order": order, "patch_start": patch_start,
+                  "centroid": centroid, "radius": radius, "normal": normal, "normal_spread": normal_spread,
+                  "adjacency_indptr": adjacency_indptr, "adjacency_indices": adjacency_indices}
+        return PatchGraph(arrays, voxel_size, graph.k)
+
+
+def load_patch_graph(data_file_name, pcd, graph, voxel_size=DEFAULT_VOXEL_SIZE):
+    '''
+    Load the patches of a point cloud file from its sidecar, building and saving them if they are missing or stale
+    :param data_file_name: path of the file pcd was read from
+    :param pcd: the pcd read from data_file_name
+    :param graph: NeighborGraph of pcd
+    :return: PatchGraph, memory-mapped when it came from the sidecar
+    '''
+    params = {"voxel_size": voxel_size, "k": graph.k}
+    with tracer.span("patches.load"):
+        arrays = load_arrays(data_file_name, "patches", params)
+    if arrays is not None and len(arrays["patch_of"]) == len(pcd.points):
+        return PatchGraph(arrays, voxel_size, graph.k)
+    with tracer.span("patches.build"):
+        patch_graph = PatchGraph.build(np.asarray(pcd.points), graph, voxel_size)
+    save_arrays(data_file_name, "patches", patch_graph.arrays(), params)
+    return patch_graph
@@ -0,0 +1,219 @@
+'''
+Zero-copy reader for binary PLY point clouds
+
+The vertex block of a binary PLY is a packed array of records, so it is memory-mapped as a numpy structured array and
+positions and colors are exposed as strided views into it. Nothing is parsed or copied up front, pages are read by the
+OS as they are touched, and elements after the vertices (e.g. faces) are never read.
+'''
+import os
+
+import numpy as np
+import open3d as o3d
+
+PLY_TYPES = {"char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+             "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+             "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+             "float": "f4", "float32": "f4", "double": "f8", "float64": "f8"}
+PLY_BYTE_ORDERS = {"binary_little_endian": "<", "binary_big_endian": ">"}
+PLY_TYPE_NAMES = {"i1": "char", "u1": "uchar", "i2": "short", "u2": "ushort", "i4": "int", "u4": "uint", "f4": "float",
+                  "f8": "double"}
+
+
+class PlyFormatError(Exception):
+    pass
+
+
+class PointCloudData:
+    '''
+    Point cloud backed by numpy arrays, usable wherever an Open3D pcd is only read through np.asarray(pcd.points)
+    and np.asarray(pcd.colors)
+    '''
+
+    def __init__(self, points, colors_u8=None, data_file_name=None):
+        self.points = points # (n, 3) float32 positions, may be a read only view into the file
+        self.colors_u8 = colors_u8 # (n, 3) uint8 colors, may be a read only view into the file, None if no colors
+        self.data_file_name = data_file_name
+        self.normals = None
+        self._colors = None
+
+    @property
+    def colors(self):
+        '''
+        (n, 3) float32 colors in [0, 1] like Open3D's, converted from colors_u8 on first use
+        '''
+        if self._colors is None:
+            if self.colors_u8 is None:
+                self._colors = np.zeros((0, 3), dtype=np.float32)
+            else:
+                self._colors = np.divide(self.colors_u8, 255, dtype=np.float32)
+        return self._colors
+
+    @colors.setter
+    def colors(self, colors):
+        self._colors = np.asarray(colors)
+
+    def is_empty(self):
+        return len(self.points) == 0
+
+    def has_colors(self):
+        return self.colors_u8 is not None or (self._colors is not None and len(self._colors) > 0)
+
+    def has_normals(self):
+        return self.normals is not None
+
+    def estimate_normals(self):
+        '''
+        Estimate normals the same way Open3D does, the positions are copied into an Open3D pcd for it
+        '''
+        pcd = self.to_open3d()
+        pcd.estimate_normals()
+        self.normals = np.asarray(pcd.normals)
+
+    def to_open3d(self):
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(np.asarray(self.points, dtype=np.float64))
+        if self.has_colors():
+            pcd.colors = o3d.utility.Vector3dVector(np.asarray(self.colors, dtype=np.float64))
+        return pcd
+
+
+def point_colors(pcd, ids=None):
+    '''
+    :param pcd: PointCloudData or Open3D pcd
+    :param ids: point ids, None for all points
+    :return: (len(ids), 3) colors in [0, 1] of the given points, only these points are converted when pcd has uint8
+             colors whose float copy was not made yet
+    '''
+    if ids is not None and isinstance(pcd, PointCloudData) and pcd.colors_u8 is not None and pcd._colors is None:
+        return np.divide(pcd.colors_u8[ids], 255, dtype=np.float32)
+    colors = np.asarray(pcd.colors)
+    return colors if ids is None else colors[ids]
+
+
+def read_ply_header(f):
+    '''
+    :param f: PLY file opened in binary mode
+    :return: (format, list of (element name, count, list of (property name, type or None for list properties)))
+    '''
+    if f.readline().strip() != b"ply":
+        raise PlyFormatError("ERR: not a PLY file")
+    ply_format = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise PlyFormatError("ERR: PLY header has no end_header")
+        words = line.decode("ascii", "replace").split()
+        if not words or words[0] in ("comment", "obj_info"):
+            continue
+        if words[0] == "end_header":
+            return ply_format, elements
+        if words[0] == "format":
+            ply_format = words[1]
+        elif words[0] == "element":
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == "property":
+            if not elements:
+                raise PlyFormatError("ERR: PLY property before any element")
+            if words[1] == "list":
+                elements[-1][2].append((words[-1], None))
+            elif words[1] in PLY_TYPES:
+                elements[-1][2].append((words[2], PLY_TYPES[words[1]]))
+            else:
+                raise PlyFormatError("ERR: unknown PLY property type {}".format(words[1]))
+
+
+def field_view(records, raw, names, dtype):
+    '''
+    View consecutive fields of the same type of a structured array as one (n, len(names)) array without copying,
+    falls back to a copy if they are not laid out that way
+    '''
+    fields = records.dtype.fields
+    offsets = [fields[name][1] for name in names]
+    same_type = all(fields[name][0] == np.dtype(dtype) for name in names)
+    consecutive = offsets == list(range(offsets[0], offsets[0] + len(names) * np.dtype(dtype).itemsize,
+                                        np.dtype(dtype).itemsize))
+    if same_type and consecutive:
+        return np.ndarray((len(records), len(names)), dtype=dtype, buffer=raw, offset=offsets[0],
+                          strides=(records.dtype.itemsize, np.dtype(dtype).itemsize))
+    return np.stack([records[name] for name in names], axis=1).astype(np.dtype(dtype).newbyteorder("="))
+
+
+def ply_header(count, dtype, comments=()):
+    '''
+    :param count: number of vertices
+    :param dtype: structured dtype of the vertex records, its byte order is the file's
+    :return: bytes of the header of a binary PLY with a single vertex element
+    '''
+    byte_order = "<"
+    lines = []
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        if field.str[0] in "<>":
+            byte_order = field.str[0]
+        lines.append("property {} {}".format(PLY_TYPE_NAMES[field.kind + str(field.itemsize)], name))
+    ply_format = [name for name, order in PLY_BYTE_ORDERS.items() if order == byte_order][0]
+    return "\n".join(["ply", "format {} 1.0".format(ply_format)] + ["comment " + c for c in comments]
+                     + ["element vertex {}".format(count)] + lines + ["end_header", ""]).encode("ascii")
+
+
+def map_ply_vertices(data_file_name):
+    '''
+    Memory-map the vertex records of a binary PLY
+    :return: (structured array of the records, flat uint8 view of their bytes, byte order "<" or ">"), both arrays
+             backed by the file
+    '''
+    with open(data_file_name, "rb") as f:
+        ply_format, elements = read_ply_header(f)
+        header_size = f.tell()
+    if ply_format not in PLY_BYTE_ORDERS:
+        raise PlyFormatError("ERR: {} PLY files are not memory-mappable".format(ply_format))
+    byte_order = PLY_BYTE_ORDERS[ply_format]
+
+    offset = header_size
+    for name, count, properties in elements:
+        if any(property_type is None for _, property_type in properties):
+            if name == "vertex":
+                raise PlyFormatError("ERR: PLY vertices with list properties are not supported")
+            raise PlyFormatError("ERR: PLY element {} before the vertices has variable size".format(name))
+        dtype = np.dtype([(property_name, byte_order + property_type) for property_name, property_type in properties])
+        if name == "vertex":
+            break
+        offset += count * dtype.itemsize
+    else:
+        raise PlyFormatError("ERR: PLY file has no vertex element")
+    if not {"x", "y", "z"}.issubset(dtype.names):
+        raise PlyFormatError("ERR: PLY vertices have no x, y, z")
+
+    if count == 0:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=np.uint8), byte_order
+    raw = np.memmap(data_file_name, dtype=np.uint8, mode="r", offset=offset, shape=(count * dtype.itemsize,))
+    return raw.view(dtype), raw, byte_order
+
+
+def read_ply(data_file_name):
+    '''
+    Memory-map the vertices of a binary PLY
+    :return: PointCloudData whose points and colors_u8 are views into the file
+    '''
+    records, raw, byte_order = map_ply_vertices(data_file_name)
+    if len(records) == 0:
+        return PointCloudData(np.zeros((0, 3), dtype=np.float32), None, data_file_name)
+    dtype = records.dtype
+    points = field_view(records, raw, ["x", "y", "z"], byte_order + "f4")
+    colors_u8 = None
+    if {"red", "green", "blue"}.issubset(dtype.names):
+        colors_u8 = field_view(records, raw, ["red", "green", "blue"], "u1")
+    return PointCloudData(points, colors_u8, data_file_name)
+
+
+def read_point_cloud(data_file_name):
+    '''
+    Drop-in replacement for o3d.io.read_point_cloud, binary PLYs are memory-mapped, everything else goes to Open3D
+    '''
+    if str(data_file_name).lower().endswith(".ply") and os.path.isfile(data_file_name):
+        try:
+            return read_ply(data_file_name)
+        except PlyFormatError:
+            pass
+    return o3d.io.read_point_cloud(data_file_name)
@@ -0,0 +1,133 @@
+'''
+Rectangle and lasso selection of the points of a cloud on screen
+
+Points are projected to canvas pixels through the scene's transform a chunk at a time, every chunk in one NumPy pass.
+The selection polygon is rasterized once into a pixel mask of its bounding box with the even-odd rule, so testing a
+point is a single lookup whatever the number of lasso vertices. With depth culling only the selected points nearest to
+the camera at their spot on screen are kept, points hidden behind a surface are left out.
+
+Sample usage:
+    transform = scene.marker.get_transform('visual', 'canvas')
+    polygon = rectangle_polygon(press_pos, release_pos)
+    indices = select_polygon(np.asarray(pcd.points), transform, polygon, depth_cull=True, pixel_size=3.5)
+'''
+import numpy as np
+
+from instrumentation import tracer
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+DEFAULT_DEPTH_TOLERANCE = 0.005
+
+
+def rectangle_polygon(corner, other_corner):
+    '''
+    :return: (4, 2) corners of the rectangle spanned by two opposite corners
+    '''
+    (x0, y0), (x1, y1) = corner[:2], other_corner[:2]
+    return np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], dtype=np.float64)
+
+
+def project_points(points, transform):
+    '''
+    :param points: (n, 3) positions
+    :param transform: vispy transform from cloud coordinates to canvas pixels
+    :return: ((n, 2) canvas positions, (n,) depths, (n,) mask of the points in front of the camera), a larger depth is
+             further away
+    '''
+    mapped = np.asarray(transform.map(points), dtype=np.float64).reshape(len(points), -1)
+    w = mapped[:, 3] if mapped.shape[1] == 4 else np.ones(len(mapped))
+    in_front = w > 0
+    w = np.where(in_front, w, 1)
+    return mapped[:, :2] / w[:, None], mapped[:, 2] / w, in_front
+
+
+def polygon_mask(polygon):
+    '''
+    Rasterize a polygon with the even-odd rule, a pixel is inside when its center is
+    :param polygon: (m, 2) vertices in canvas pixels, the last one is joined to the first
+    :return: (bool mask indexed by [row, column], (x, y) pixel of mask[0, 0])
+    '''
+    polygon = np.asarray(polygon, dtype=np.float64)
+    origin = np.floor(polygon.min(axis=0)).astype(np.int64)
+    width, height = np.floor(polygon.max(axis=0)).astype(np.int64) - origin + 1
+    start, end = polygon - origin, np.roll(polygon, -1, axis=0) - origin
+
+    # rows whose pixel center y = row + 0.5 an edge crosses, half open so a vertex is crossed once
+    low, high = np.minimum(start[:, 1], end[:, 1]), np.maximum(start[:, 1], end[:, 1])
+    first_row = np.ceil(low - 0.5).astype(np.int64)
+    counts = np.maximum(np.ceil(high - 0.5).astype(np.int64) - first_row, 0)
+    edges = np.repeat(np.arange(len(polygon)), counts)
+    rows = first_row[edges] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    dy = end[:, 1] - start[:, 1]
+    slopes = (end[:, 0] - start[:, 0]) / np.where(dy != 0, dy, 1)
+    xs = start[edges, 0] + (rows + 0.5 - start[edges, 1]) * slopes[edges]
+
+    # consecutive crossings of a row bound the spans inside, filled by a running sum along the row
+    order = np.lexsort((xs, rows))
+    rows, columns = rows[order], np.clip(np.ceil(xs[order] - 0.5).astype(np.int64), 0, width)
+    steps = np.zeros((height, width + 1), dtype=np.int32)
+    np.add.at(steps, (rows[0::2], columns[0::2]), 1)
+    np.add.at(steps, (rows[1::2], columns[1::2]), -1)
+    return np.cumsum(steps[:, :width], axis=1) > 0, origin
+
+
+def in_mask(xy, mask, origin):
+    '''
+    :return: bool array, True for the canvas positions whose pixel is set in the mask
+    '''
+    pixels = np.floor(xy).astype(np.int64) - origin
+    inside = np.all((pixels >= 0) & (pixels < [mask.shape[1], mask.shape[0]]), axis=1)
+    inside[inside] = mask[pixels[inside, 1], pixels[inside, 0]]
+    return inside
+
+
+def nearest_on_screen(xy, depth, pixel_size, depth_tolerance=DEFAULT_DEPTH_TOLERANCE):
+    '''
+    Depth test of points drawn as squares of pixel_size pixels
+    :param depth_tolerance: fraction of the depth range a point can be behind the nearest point of its square and still
+                            count as visible, points on the same surface never have exactly the same depth
+    :return: bool array, True for the points not hidden by a nearer one
+    '''
+    if len(xy) == 0:
+        return np.zeros(0, dtype=bool)
+    cells = np.floor(xy / max(pixel_size, 1.0)).astype(np.int64)
+    cells -= cells.min(axis=0)
+    keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+    nearest = np.minimum.reduceat(depth[order], starts)
+    nearest = np.repeat(nearest, np.diff(np.append(starts, len(order))))
+    visible = np.empty(len(xy), dtype=bool)
+    visible[order] = depth[order] <= nearest + depth_tolerance * (depth.max() - depth.min())
+    return visible
+
+
+def select_polygon(points, transform, polygon, depth_cull=False, pixel_size=1.0, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Find the points drawn inside a polygon on the canvas
+    :param points: (n, 3) positions of the whole cloud, not only the drawn points
+    :param transform: vispy transform from cloud coordinates to canvas pixels
+    :param polygon: (m, 2) vertices in canvas pixels, e.g. a lasso trail or rectangle_polygon
+    :param depth_cull: only keep the points that are not hidden behind other selected points
+    :param pixel_size: size in pixels points are drawn with, used by the depth test
+    :param chunk_size: number of points projected at once, bounds the memory used for huge clouds
+    :return: sorted point ids
+    '''
+    points = np.asarray(points)
+    if len(polygon) < 3 or len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+    with tracer.span("screen_selection.select_polygon"):
+        mask, origin = polygon_mask(polygon)
+        selected, positions, depths = [], [], []
+        for start in range(0, len(points), chunk_size):
+            xy, depth, in_front = project_points(points[start:start + chunk_size], transform)
+            inside = in_front & in_mask(xy, mask, origin)
+            selected.append(start + np.flatnonzero(inside))
+            positions.append(xy[inside])
+            depths.append(depth[inside])
+        tracer.count("screen_selection.points_projected", len(points))
+        selected = np.concatenate(selected)
+        if depth_cull:
+            selected = selected[nearest_on_screen(np.concatenate(positions), np.concatenate(depths), pixel_size)]
+        return selected
@@ -0,0 +1,359 @@
+'''
+Append-only on disk store for segments
+
+A store is a directory with two files:
+    index.jsonl -- one JSON record per line, either a segment's metadata (every Segment field but indices) together
+                   with where its indices live in indices.bin, or a deletion marker
+    indices.bin -- zlib compressed little endian uint32 index arrays, appended one after another
+
+Saving a segment appends its compressed indices and one index line, so it costs O(size of the segment) no matter how
+many segments are already stored. A later record for the same id replaces the earlier one.
+
+Opening a store only reads index.jsonl. Indices are read when asked for, and the most recently used ones are kept in
+memory up to cache_size segments.
+
+Several processes can share a store. Writes hold an exclusive lock on the store's lock file and first read the lines
+other processes appended to index.jsonl since, so ids are not handed out twice and metadata updates apply to the
+latest record. compact() rewrites both files with only the live segments, a process that had them open reloads the
+index the next time it touches the store. Without fcntl (Windows) nothing is locked.
+'''
+import json
+import os
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
+
+from models import Segment
+
+INDEX_FILE_NAME = "index.jsonl"
+INDICES_FILE_NAME = "indices.bin"
+LOCK_FILE_NAME = "lock"
+
+CODEC_ZLIB = "zlib"  # the uint32 ids as given
+CODEC_ZLIB_DELTA = "zlib-delta"  # sorted ids stored as differences to the previous id, which compress much better
+
+
+class SegmentStoreError(Exception):
+    pass
+
+
+def encode_indices(indices):
+    '''
+    :return: (codec, compressed bytes)
+    '''
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) and (indices.min() < 0 or indices.max() > np.iinfo(np.uint32).max):
+        raise SegmentStoreError("ERR: indices must fit in an uint32")
+    indices = indices.astype('<u4')
+    if np.all(indices[1:] >= indices[:-1]):
+        return CODEC_ZLIB_DELTA, zlib.compress(np.diff(indices, prepend=np.uint32(0)).astype('<u4').tobytes())
+    return CODEC_ZLIB, zlib.compress(indices.tobytes())
+
+
+def decode_indices(codec, data):
+    '''
+    :return: uint32 array of point ids
+    '''
+    indices = np.frombuffer(zlib.decompress(data), dtype='<u4')
+    if codec == CODEC_ZLIB_DELTA:
+        return np.cumsum(indices, dtype=np.uint32)
+    if codec == CODEC_ZLIB:
+        return indices
+    raise SegmentStoreError("ERR: unknown indices codec {}".format(codec))
+
+
+class SegmentStore:
+    '''
+    Sample usage:
+        store = SegmentStore("segments.store")
+        store.put(segment)
+        segment = store.get(segment.id)
+    '''
+
+    def __init__(self, path, cache_size=16):
+        '''
+        :param path: directory of the store, created on first save
+        :param cache_size: how many segments' indices are kept in memory at most
+        '''
+        self.path = path
+        self.cache_size = cache_size
+        self.indices_cache = OrderedDict()  # segment id -> indices, least recently used first
+        self.index_path = os.path.join(path, INDEX_FILE_NAME)
+        self.indices_path = os.path.join(path, INDICES_FILE_NAME)
+        self.lock_path = os.path.join(path, LOCK_FILE_NAME)
+        self.records = OrderedDict()  # segment id -> latest index record
+        self.index_read = 0  # bytes of index.jsonl applied to records
+        self.index_inode = None  # inode of the index.jsonl read, it changes when another process compacts the store
+        with self._locked(exclusive=False):
+            self.refresh()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, segment_id):
+        return segment_id in self.records
+
+    def _apply(self, record):
+        self.indices_cache.pop(record["id"] if record["op"] == "delete" else record["metadata"]["id"], None)
+        if record["op"] == "delete":
+            self.records.pop(record["id"], None)
+        else:
+            self.records[record["metadata"]["id"]] = record
+
+    @contextmanager
+    def _locked(self, exclusive=True):
+        '''
+        Hold the store's lock, exclusive for writing, shared for reading
+        '''
+        if fcntl is None or (not exclusive and not os.path.isdir(self.path)):
+            yield
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.lock_path, mode='a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh(self):
+        '''
+        Apply the records other processes appended since the last read, reloading everything if the store was compacted
+        '''
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self.index_inode or stat.st_size < self.index_read:
+            self.records.clear()
+            self.indices_cache.clear()
+            self.index_read = 0
+            self.index_inode = stat.st_ino
+        if stat.st_size == self.index_read:
+            return
+        with open(self.index_path, mode='rb') as f:
+            f.seek(self.index_read)
+            data = f.read()
+        complete = data.rfind(b"\n") + 1  # a line being written by another process is read next time
+        for line in data[:complete].decode("utf-8").splitlines():
+            if line.strip():
+                self._apply(json.loads(line))
+        self.index_read += complete
+
+    def _append_record(self, record):
+        '''
+        Append a record, the caller holds the exclusive lock and refreshed the store
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.index_path, mode='ab') as f:
+            f.write((json.dumps(record, default=str) + "\n").encode("utf-8"))
+        self.refresh()  # applies the appended line
+
+    def next_id(self):
+        '''
+        :return: the id after the largest stored one, another process can take it before this one saves, see put_new
+        '''
+        with self._locked(exclusive=False):
+            self.refresh()
+        return max(self.records.keys()) + 1 if self.records else 0
+
+    def entries(self):
+        '''
+        :return: metadata dicts of all stored segments in the order they were first saved, indices not included
+        '''
+        with self._locked(exclusive=False):
+            self.refresh()
+        return [record["metadata"] for record in self.records.values()]
+
+    def metadata(self, segment_id):
+        return self._record(segment_id)["metadata"]
+
+    def _record(self, segment_id):
+        try:
+            return self.records[segment_id]
+        except KeyError:
+            raise SegmentStoreError("ERR: segment {} is not in the store".format(segment_id))
+
+    def put_raw(self, metadata, indices):
+        '''
+        Append a segment given as a metadata dict (every Segment field but indices) and its indices
+        '''
+        codec, data = encode_indices(indices)
+        with self._locked():
+            self.refresh()
+            self._put_locked(metadata, codec, data, len(indices))
+
+    def put_new(self, metadata, indices):
+        '''
+        Append a segment under the next free id, whatever id metadata has
+        :return: the id the segment was stored under
+        '''
+        codec, data = encode_indices(indices)
+        with self._locked():
+            self.refresh()
+            segment_id = max(self.records.keys()) + 1 if self.records else 0
+            self._put_locked(dict(metadata, id=segment_id), codec, data, len(indices))
+        return segment_id
+
+    def _put_locked(self, metadata, codec, data, count):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.indices_path, mode='ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+        metadata = dict(metadata)
+        metadata.pop("indices", None)
+        self._append_record({"op": "put", "metadata": metadata, "codec": codec, "offset": offset,
+                             "nbytes": len(data), "count": count})
+
+    def put(self, segment):
+        '''
+        Append a Segment, replacing any stored segment with the same id
+        '''
+        self.put_raw(segment.dict(exclude={"indices"}), segment.indices)
+
+    def update_metadata(self, segment_id, **fields):
+        '''
+        Change metadata fields of a stored segment without rewriting its indices, the other fields keep their latest
+        stored values, also when another process changed them since this one read the store
+        '''
+        with self._locked():
+            self.refresh()
+            record = dict(self._record(segment_id))
+            record["metadata"] = dict(record["metadata"], **fields)
+            self._append_record(record)
+
+    def indices_version(self, segment_id):
+        '''
+        :return: a value that changes whenever the segment's indices are saved again, metadata updates keep it
+        '''
+        record = self._record(segment_id)
+        return record.get("version", record["offset"])
+
+    def delete(self, segment_id):
+        with self._locked():
+            self.refresh()
+            self._record(segment_id)
+            self._append_record({"op": "delete", "id": segment_id})
+
+    def compact(self):
+        '''
+        Rewrite the store with only the latest record and indices of every stored segment, dropping replaced indices,
+        metadata updates and deleted segments
+        :return: (bytes before, bytes after) of both files together
+        '''
+        with self._locked():
+            self.refresh()
+            if not os.path.isfile(self.index_path):
+                return 0, 0
+            before = os.path.getsize(self.index_path) + os.path.getsize(self.indices_path)
+            with open(self.indices_path, mode='rb') as source, \
+                    open(self.indices_path + ".tmp", mode='wb') as indices_file, \
+                    open(self.index_path + ".tmp", mode='wb') as index_file:
+                for record in self.records.values():
+                    source.seek(record["offset"])
+                    # the version stays, so compaction does not make fitted segments look changed
+                    record = dict(record, version=self.indices_version(record["metadata"]["id"]),
+                                  offset=indices_file.tell())
+                    indices_file.write(source.read(record["nbytes"]))
+                    index_file.write((json.dumps(record, default=str) + "\n").encode("utf-8"))
+            os.replace(self.indices_path + ".tmp", self.indices_path)
+            os.replace(self.index_path + ".tmp", self.index_path)
+            self.refresh()
+            return before, os.path.getsize(self.index_path) + os.path.getsize(self.indices_path)
+
+    def read_indices(self, segment_id):
+        '''
+        :return: uint32 array of the segment's point ids, read only as it may be shared with the cache
+        '''
+        if segment_id in self.indices_cache:
+            self.indices_cache.move_to_end(segment_id)
+            return self.indices_cache[segment_id]
+        indices = self._read_indices_uncached(segment_id)
+        indices.flags.writeable = False
+        self.indices_cache[segment_id] = indices
+        while len(self.indices_cache) > self.cache_size:
+            self.indices_cache.popitem(last=False)
+        return indices
+
+    def _read_indices_uncached(self, segment_id):
+        with self._locked(exclusive=False):
+            self.refresh()  # offsets are stale if another process compacted the store
+            record = self._record(segment_id)
+            with open(self.indices_path, mode='rb') as f:
+                f.seek(record["offset"])
+                data = f.read(record["nbytes"])
+        return decode_indices(record["codec"], data)
+
+    def get_dict(self, segment_id, use_cache=True):
+        '''
+        :return: the segment as a dict in the segments.json schema, fields in Segment's order
+        '''
+        metadata = self.metadata(segment_id)
+        indices = (self.read_indices(segment_id) if use_cache else self._read_indices_uncached(segment_id)).tolist()
+        return OrderedDict((name, indices if name == "indices" else metadata.get(name))
+                           for name in Segment.__fields__)
+
+    def get(self, segment_id):
+        return Segment(**self.get_dict(segment_id))
+
+    def import_json(self, json_file_name):
+        '''
+        Append every segment of a segments.json file, a list of Segment.json() strings
+        :return: number of segments imported
+        '''
+        with open(json_file_name) as f:
+            entries = json.load(f)
+        with self._locked():
+            self.refresh()
+            for entry in entries:
+                segment_dict = json.loads(entry) if isinstance(entry, str) else entry
+                codec, data = encode_indices(segment_dict["indices"])
+                self._put_locked(segment_dict, codec, data, len(segment_dict["indices"]))
+        return len(entries)
+
+    def export_json(self, json_file_name):
+        '''
+        Write every stored segment to a segments.json file, a list of Segment.json() strings
+        Segments are read one at a time, see write_segments_json
+        '''
+        write_segments_json(json_file_name, (self.get_dict(segment_id, use_cache=False) for segment_id in self.records))
+
+
+def write_segments_json(json_file_name, segment_dicts):
+    '''
+    Write segments to a segments.json file one at a time, the output is the same as json.dumps(entries, indent=2)
+    :param segment_dicts: iterable of segments as dicts in the segments.json schema
+    '''
+    with open(json_file_name, mode='w') as f:
+        f.write("[")
+        count = 0
+        for segment_dict in segment_dicts:
+            entry = json.dumps(segment_dict, default=str)
+            f.write("{}\n  {}".format("," if count else "", json.dumps(entry)))
+            count += 1
+        f.write("\n]" if count else "]")
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert between segments.json and a segment store")
+    parser.add_argument("command", choices=["import", "export", "compact"])
+    parser.add_argument("json_file_name", nargs="?")
+    parser.add_argument("--store", default="segments.store")
+    args = parser.parse_args()
+    if args.command != "compact" and args.json_file_name is None:
+        parser.error("{} needs a json_file_name".format(args.command))
+    segment_store = SegmentStore(args.store)
+    if args.command == "compact":
+        print("Compacted {} bytes into {}".format(*segment_store.compact()))
+    elif args.command == "import":
+        print("Imported {} segments".format(segment_store.import_json(args.json_file_name)))
+    else:
+        segment_store.export_json(args.json_file_name)
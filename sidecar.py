@@ -0,0 +1,108 @@
+'''
+Per point cloud cache directory that lives next to the data file, e.g. data/scene.ply -> data/scene.ply.atlas/
+
+Each cache entry is a sub directory of .npy files plus a meta.json that records the data file's mtime and size and
+the parameters the arrays were built with. Arrays are memory-mapped on load, so reopening a large cache is instant.
+'''
+import json
+import os
+import shutil
+
+import numpy as np
+
+SIDECAR_SUFFIX = ".atlas"
+META_FILE_NAME = "meta.json"
+
+
+def sidecar_dir(data_file_name):
+    return str(data_file_name) + SIDECAR_SUFFIX
+
+
+def file_signature(data_file_name):
+    '''
+    :return: the mtime and size of the file, used to detect that a cache entry went stale
+    '''
+    stat = os.stat(str(data_file_name))
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def load_arrays(data_file_name, entry_name, params=None, mmap_mode='r'):
+    '''
+    Load a cache entry
+    :param data_file_name: the point cloud file the entry belongs to
+    :param entry_name: name of the cache entry, e.g. "neighbors"
+    :param params: parameters the entry must have been built with
+    :param mmap_mode: passed to np.load, None to read the arrays into memory
+    :return: dict of name -> array, or None if the entry is missing or stale
+    '''
+    entry_dir = os.path.join(sidecar_dir(data_file_name), entry_name)
+    try:
+        with open(os.path.join(entry_dir, META_FILE_NAME)) as f:
+            meta = json.load(f)
+        if meta["signature"] != file_signature(data_file_name) or meta["params"] != (params or {}):
+            return None
+        return {name: np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode=mmap_mode)
+                for name in meta["arrays"]}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def start_entry(data_file_name, entry_name):
+    '''
+    Empty the directory of a cache entry, for arrays written into it in place with new_array before finish_entry
+    :return: the entry directory, None if the cache could not be written (e.g. read only data directory or missing
+             data file, which gets no stray sidecar)
+    '''
+    if not os.path.isfile(str(data_file_name)):
+        return None
+    entry_dir = os.path.join(sidecar_dir(data_file_name), entry_name)
+    try:
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.makedirs(entry_dir)
+        return entry_dir
+    except OSError:
+        return None
+
+
+def new_array(entry_dir, name, shape, dtype):
+    '''
+    :return: writable array memory-mapped to the .npy file of name in a started entry, for arrays too large to build
+             in memory
+    '''
+    return np.lib.format.open_memmap(os.path.join(entry_dir, name + ".npy"), mode='w+', dtype=dtype, shape=shape)
+
+
+def finish_entry(data_file_name, entry_name, arrays, params=None):
+    '''
+    Complete a started cache entry: arrays made with new_array are flushed, the others saved, and meta.json is written
+    last so a half written entry is never picked up
+    :param arrays: dict of name -> array
+    :return: True if saved, False if the cache could not be written
+    '''
+    entry_dir = os.path.join(sidecar_dir(data_file_name), entry_name)
+    try:
+        for name, array in arrays.items():
+            file_name = os.path.join(entry_dir, name + ".npy")
+            if isinstance(array, np.memmap) and array.filename == os.path.abspath(file_name):
+                array.flush()
+            else:
+                np.save(file_name, array)
+        meta = {"signature": file_signature(data_file_name),
+                "params": params or {},
+                "arrays": list(arrays.keys())}
+        with open(os.path.join(entry_dir, META_FILE_NAME), mode='w') as f:
+            f.write(json.dumps(meta, indent=2))
+        return True
+    except OSError:
+        return False
+
+
+def save_arrays(data_file_name, entry_name, arrays, params=None):
+    '''
+    Save a cache entry, meta.json is written last so a half written entry is never picked up
+    :param arrays: dict of name -> array
+    :return: True if saved, False if the cache could not be written (e.g. read only data directory)
+    '''
+    return start_entry(data_file_name, entry_name) is not None and finish_entry(data_file_name, entry_name, arrays,
+                                                                                 params)
@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+pytest.importorskip("open3d")
+pytest.importorskip("vispy")
+pytest.importorskip("PyQt5")
+pytest.importorskip("scipy")
+
+from batch_segment import run_manifest
+from sidecar import save_arrays, sidecar_dir
+
+
+def test_missing_input_fails_without_sidecar(tmp_path):
+    data_file_name = str(tmp_path / "missing.ply")
+    results = list(run_manifest([{"data_file_name": data_file_name, "picked_points_id": [0, 1, 2]}], workers=1))
+    assert len(results) == 1
+    job_number, segment, error = results[0]
+    assert job_number == 0 and segment is None and "no such file" in error
+    assert not save_arrays(data_file_name, "neighbors", {})
+    assert not os.path.exists(sidecar_dir(data_file_name))
@@ -0,0 +1,138 @@
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+pytest.importorskip("open3d")
+pytest.importorskip("vispy")
+pytest.importorskip("PyQt5")
+pytest.importorskip("scipy")
+
+from custom_util import BoundingLine, FloodfillState, check_neighbor_condition, floodfill
+from neighbor_graph import NeighborGraph
+from patches import PatchGraph
+
+Cloud = namedtuple("Cloud", ["points"])
+BATCH_SIZE = 10
+
+
+@pytest.fixture(scope="module")
+def scene():
+    '''
+    Two floors side by side whose normals tilt by 0.5 radians at x = 1 and x = 2, so the angle tolerance decides how
+    far the floodfill gets and patches on either side of a step are accepted or rejected whole
+    '''
+    random_state = np.random.RandomState(0)
+    x, y = np.meshgrid(np.arange(0, 3, 0.04), np.arange(0, 2, 0.04), indexing="ij")
+    x, y = x.ravel(), y.ravel()
+    floor = np.stack([x, y, np.zeros(len(x))], axis=1)
+    coordinates = np.concatenate([floor, floor + [0, 3, 0]])
+    tilt = 0.5 * np.floor(coordinates[:, 0] + 0.005)
+    normals = np.stack([np.sin(tilt), np.zeros(len(coordinates)), np.cos(tilt)], axis=1)
+    normals += random_state.normal(0, 0.02, normals.shape)
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+    graph = NeighborGraph.build(coordinates, normals, BATCH_SIZE)
+    patches = PatchGraph.build(coordinates, graph, voxel_size=0.125)  # voxel edges on the steps
+
+    def nearest(position):
+        return int(np.argmin(np.linalg.norm(coordinates - position, axis=1)))
+
+    # the bounding line runs across both floors at x = 1.6, the seeds are near x = 0
+    picked = [nearest([1.6, 0, 0]), nearest([1.6, 5, 0]), nearest([0.1, 1, 0])]
+    return Cloud(coordinates), graph, patches, picked, nearest([0.1, 4, 0])
+
+
+def original_floodfill(scene, seed_ids, angle_error_tolerance):
+    '''
+    The floodfill before vectorization, one point at a time, over the same neighbors and from several seeds
+    '''
+    pcd, graph, _, picked, _ = scene
+    coordinates = np.asarray(pcd.points)
+    bounding_line = BoundingLine(coordinates[picked[0]], coordinates[picked[1]])
+    surface = set()
+    for seed_id in seed_ids:
+        points_to_check = {seed_id}
+        while points_to_check:
+            current_point_id = points_to_check.pop()
+            for neighbor in set(graph.neighbors([current_point_id], BATCH_SIZE - 1).tolist()) - surface:
+                if check_neighbor_condition(graph.normals, coordinates, picked[2], neighbor, bounding_line,
+                                            angle_error_tolerance):
+                    points_to_check.add(neighbor)
+                    surface.add(neighbor)
+    return sorted(surface)
+
+
+def new_state(scene, angle_error_tolerance, use_patches=False):
+    pcd, graph, patches, picked, _ = scene
+    return FloodfillState(pcd, graph, picked, BATCH_SIZE, angle_error_tolerance,
+                          patches=patches if use_patches else None)
+
+
+@pytest.mark.parametrize("angle_error_tolerance", [0.2, 0.4, 0.6])
+def test_floodfill_matches_original(scene, angle_error_tolerance):
+    pcd, graph, _, picked, _ = scene
+    expected = original_floodfill(scene, [picked[2]], angle_error_tolerance)
+    assert 0 < len(expected) < len(pcd.points) // 2
+    assert floodfill(picked, pcd, BATCH_SIZE, angle_error_tolerance, graph=graph) == expected
+    state = new_state(scene, angle_error_tolerance)
+    list(state.start())
+    assert state.points() == expected
+
+
+def test_tolerance_changes_match_original(scene):
+    picked = scene[3]
+    state = new_state(scene, 0.4)
+    list(state.start())
+    list(state.set_angle_error_tolerance(0.6))
+    assert state.points() == original_floodfill(scene, [picked[2]], 0.6)
+    list(state.set_angle_error_tolerance(0.3))
+    assert state.points() == original_floodfill(scene, [picked[2]], 0.3)
+
+
+def test_seeds_match_original(scene):
+    picked, other_seed = scene[3], scene[4]
+    state = new_state(scene, 0.4)
+    list(state.start())
+    list(state.add_seed(other_seed))
+    assert state.points() == original_floodfill(scene, [picked[2], other_seed], 0.4)
+    list(state.set_angle_error_tolerance(0.5))
+    assert state.points() == original_floodfill(scene, [picked[2], other_seed], 0.5)
+    list(state.remove_seed(picked[2]))
+    assert state.seeds() == [other_seed]
+    assert state.points() == original_floodfill(scene, [other_seed], 0.5)
+
+
+def test_relax_after_patch_floodfill_matches_fresh_floodfill(scene):
+    state = new_state(scene, 0.4, use_patches=True)
+    list(state.start())
+    before = len(state.points())
+    list(state.set_angle_error_tolerance(0.6))
+    fresh = new_state(scene, 0.6, use_patches=True)
+    list(fresh.start())
+    assert len(fresh.points()) > before
+    assert state.points() == fresh.points()
+
+
+def test_remove_first_seed_of_patch_floodfill(scene):
+    pcd, picked, other_seed = scene[0], scene[3], scene[4]
+    state = new_state(scene, 0.4, use_patches=True)
+    list(state.start())
+    list(state.add_seed(other_seed))
+    list(state.remove_seed(picked[2]))
+    # the same as growing over patches from the remaining seed alone
+    fresh = new_state(scene, 0.4, use_patches=True)
+    list(fresh.add_seed(other_seed))
+    assert state.points() == fresh.points()
+    assert len(state.points()) > 0
+    assert np.all(np.asarray(pcd.points)[state.points(), 1] > 2.5)  # nothing of the removed seed's floor
+
+
+def test_replay_rolls_back_before_it_is_iterated(scene):
+    picked, other_seed = scene[3], scene[4]
+    state = new_state(scene, 0.4)
+    list(state.start())
+    list(state.add_seed(other_seed))
+    replay = state.remove_seed(picked[2])
+    assert state.points() == []
+    list(replay)
+    assert state.points() == original_floodfill(scene, [other_seed], 0.4)
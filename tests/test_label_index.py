@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from label_index import LabelIndex
+
+POINT_COUNT = 200
+
+
+def brute_force(segments):
+    '''
+    :param segments: dict of segment id -> set of point ids
+    :return: list of the sorted segment ids containing every point
+    '''
+    containing = [[] for _ in range(POINT_COUNT)]
+    for segment_id in sorted(segments):
+        for point_id in segments[segment_id]:
+            containing[point_id].append(segment_id)
+    return containing
+
+
+def check(index, segments):
+    containing = brute_force(segments)
+    for point_id in range(POINT_COUNT):
+        assert sorted(index.segments_at(point_id)) == containing[point_id]
+    np.testing.assert_array_equal(index.unlabeled_mask(), [not ids for ids in containing])
+    for segment_id, points in segments.items():
+        expected = {other: len(points & other_points) for other, other_points in segments.items()
+                    if other != segment_id and points & other_points}
+        assert dict(index.overlaps(segment_id)) == expected
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_add_remove_matches_brute_force(seed):
+    random_state = np.random.RandomState(seed)
+    index = LabelIndex(POINT_COUNT)
+    segments = {}
+    next_id = 0
+    for _ in range(30):
+        if segments and random_state.rand() < 0.4:
+            segment_id = random_state.choice(sorted(segments))
+            points = segments.pop(segment_id)
+            index.remove(segment_id, np.array(sorted(points), dtype=np.int64))
+        else:
+            # clustered segments so they overlap often, sometimes with repeated ids
+            start = random_state.randint(0, POINT_COUNT)
+            points = (start + random_state.randint(0, 40, random_state.randint(0, 60))) % POINT_COUNT
+            segments[next_id] = set(points.tolist())
+            index.add(next_id, points)
+            next_id += 1
+        check(index, segments)
+
+
+def test_remove_everything_leaves_no_overlaps():
+    index = LabelIndex(10)
+    index.add(0, [0, 1, 2, 3])
+    index.add(1, [2, 3, 4])
+    index.add(2, [3, 4, 5])
+    for segment_id, indices in [(1, [2, 3, 4]), (0, [0, 1, 2, 3]), (2, [3, 4, 5])]:
+        index.remove(segment_id, indices)
+    assert index.unlabeled_mask().all()
+    assert len(index.overlap_points) == 0
+    assert len(index.overlap_bits) == 0
@@ -0,0 +1,123 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from models import Segment
+from segment_store import SegmentStore
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    data_file_name = tmp_path / "scene.ply"
+    data_file_name.write_text("ply\n")
+    return str(data_file_name)
+
+
+def metadata(segment_name, data_file_name=None, type_class=None):
+    '''
+    :return: every Segment field but indices, as the annotation tool saves them
+    '''
+    segment = Segment(id=-1, data_file_name=data_file_name, segment_name=segment_name, indices=[],
+                      type_class=type_class)
+    return segment.dict(exclude={"indices"})
+
+
+def legacy_json(segments):
+    '''
+    segments.json as the annotation tool wrote it before the segment store: a list of Segment.json() strings
+    '''
+    return json.dumps([segment.json() for segment in segments], indent=2)
+
+
+def test_round_trip(tmp_path, data_file):
+    store = SegmentStore(str(tmp_path / "segments.store"))
+    wall = Segment(id=store.next_id(), data_file_name=data_file, segment_name="wall", indices=[5, 1, 3],
+                   type_class=("Wall", 1))
+    store.put(wall)
+    floor_id = store.put_new(metadata("floor", data_file, ("Floor", 1)), np.arange(1000, 3000, 2))
+    door_id = store.put_new(metadata("door", data_file), [7])
+    assert (wall.id, floor_id, door_id) == (0, 1, 2)
+
+    version = store.indices_version(floor_id)
+    store.update_metadata(floor_id, intersection=1, plane_equation=([0.0, 0.0, 1.0], 0.5))
+    store.update_metadata(floor_id, vertices=[[0.0, 0.0, 0.5], [1.0, 0.0, 0.5], [1.0, 1.0, 0.5]])
+    assert store.indices_version(floor_id) == version
+    store.delete(door_id)
+
+    reopened = SegmentStore(store.path)
+    assert [stored["id"] for stored in reopened.entries()] == [wall.id, floor_id]
+    assert door_id not in reopened
+    np.testing.assert_array_equal(reopened.read_indices(wall.id), [5, 1, 3])
+    np.testing.assert_array_equal(reopened.read_indices(floor_id), np.arange(1000, 3000, 2))
+    floor = reopened.get(floor_id)
+    assert floor.intersection == 1
+    assert floor.plane_equation == ([0.0, 0.0, 1.0], 0.5)
+    assert floor.vertices == [[0.0, 0.0, 0.5], [1.0, 0.0, 0.5], [1.0, 1.0, 0.5]]
+    assert floor.type_class == ("Floor", 1)
+
+    json_file_name = str(tmp_path / "segments.json")
+    reopened.export_json(json_file_name)
+    with open(json_file_name) as f:
+        assert f.read() == legacy_json([reopened.get(wall.id), floor])
+
+
+def test_import_json_reads_the_legacy_format(tmp_path, data_file):
+    segments = [Segment(id=3, data_file_name=data_file, segment_name="wall", indices=[0, 2, 4]),
+                Segment(id=8, data_file_name=None, segment_name="floor", indices=[1], type_class=("Floor", 1))]
+    json_file_name = tmp_path / "segments.json"
+    json_file_name.write_text(legacy_json(segments))
+
+    store = SegmentStore(str(tmp_path / "segments.store"))
+    assert store.import_json(str(json_file_name)) == 2
+    assert [store.get(segment.id) for segment in segments] == segments
+    assert store.next_id() == 9
+
+
+def test_other_instances_see_writes(tmp_path):
+    path = str(tmp_path / "segments.store")
+    first, second = SegmentStore(path), SegmentStore(path)
+    first_id = first.put_new(metadata("a"), [1, 2])
+    second_id = second.put_new(metadata("b"), [3])
+    assert first_id != second_id
+    second.update_metadata(first_id, intersection=2)
+    first.update_metadata(first_id, segment_name="a2")
+    stored = SegmentStore(path).metadata(first_id)
+    assert (stored["segment_name"], stored["intersection"]) == ("a2", 2)
+
+
+def test_compact_keeps_live_segments(tmp_path):
+    store = SegmentStore(str(tmp_path / "segments.store"))
+    for segment_id in range(5):
+        store.put_new(metadata(str(segment_id)), np.arange(segment_id * 100))
+    for segment_id in (0, 2):
+        store.delete(segment_id)
+    store.update_metadata(3, intersection=4)
+    before, after = store.compact()
+    assert after < before
+
+    reopened = SegmentStore(store.path)
+    assert [stored["id"] for stored in reopened.entries()] == [1, 3, 4]
+    for segment_id in (1, 3, 4):
+        np.testing.assert_array_equal(reopened.read_indices(segment_id), np.arange(segment_id * 100))
+    assert reopened.metadata(3)["intersection"] == 4
+    assert reopened.next_id() == 5
+
+
+def test_opening_reads_only_metadata(tmp_path):
+    path = str(tmp_path / "segments.store")
+    store = SegmentStore(path)
+    for segment_id in range(3):
+        store.put_new(metadata(str(segment_id)), np.arange(segment_id + 1))
+
+    # the indices file is not read until indices are asked for
+    os.rename(store.indices_path, store.indices_path + ".away")
+    reopened = SegmentStore(path, cache_size=2)
+    assert [stored["segment_name"] for stored in reopened.entries()] == ["0", "1", "2"]
+    assert all("indices" not in stored for stored in reopened.entries())
+    os.rename(store.indices_path + ".away", store.indices_path)
+
+    for segment_id in range(3):
+        np.testing.assert_array_equal(reopened.read_indices(segment_id), np.arange(segment_id + 1))
+    assert list(reopened.indices_cache) == [1, 2]
@@ -0,0 +1,208 @@
+import os
+import time
+
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from cloud_cache import cloud_cache
+from compute_server import ComputeServerError, RemoteFloodfillState
+from custom_util import FloodfillError, FloodfillState, crop_reserve
+from instrumentation import tracer
+from lod import prepare_display
+from neighbor_graph import load_neighbor_graph
+from patches import load_patch_graph
+from ply_reader import PointCloudData, point_colors
+
+
+class FloodfillWorker(QThread):
+    '''
+    Runs floodfill, or a refinement of an earlier floodfill, and the crop of its result off the GUI thread
+
+    Signals are delivered to the GUI thread by Qt's queued connections, so slots connected to them can touch widgets.
+    '''
+    graph_loaded = pyqtSignal(str, object)  # data file name, NeighborGraph
+    patches_loaded = pyqtSignal(str, object)  # data file name, PatchGraph
+    progress = pyqtSignal(str)
+    partial_result = pyqtSignal(object, object)  # point ids found so far, cropped pcd
+    result = pyqtSignal(object, object, object)  # point ids, cropped pcd, FloodfillState to refine the result with
+    error = pyqtSignal(str)
+
+    def __init__(self, picked_points_id, pcd, data_file_name, graph=None, patches=None, use_patches=False,
+                 state=None, operation=None, update_interval=0.5, client=None, parent=None, **floodfill_kwargs):
+        '''
+        :param picked_points_id: the 3 points the user picked, ignored when refining a state
+        :param pcd: the pcd to floodfill, must not be modified while the worker runs
+        :param data_file_name: file pcd was read from, used to load its neighbor graph when graph is None
+        :param graph: NeighborGraph of pcd if it is already loaded
+        :param patches: PatchGraph of pcd if it is already loaded
+        :param use_patches: grow the region over patches, loading them first if patches is None
+        :param state: FloodfillState of an earlier result to refine instead of starting a new floodfill
+        :param operation: (name, args) of the FloodfillState method to refine state with, e.g. ("add_seed", (id,))
+        :param update_interval: minimum number of seconds between two progress/partial result updates
+        :param client: ComputeClient to floodfill on the compute server with, graph and patches are then not used and
+                       state must be a RemoteFloodfillState
+        :param floodfill_kwargs: batch_size, angle_error_tolerance, boundary_thickness
+        '''
+        super(FloodfillWorker, self).__init__(parent)
+        self.picked_points_id = list(picked_points_id)
+        self.pcd = pcd
+        self.data_file_name = data_file_name
+        self.graph = graph
+        self.patches = patches
+        self.use_patches = use_patches
+        self.state = state
+        self.operation = operation
+        self.update_interval = update_interval
+        self.client = client
+        if client is not None and state is None:
+            self.state = RemoteFloodfillState(client)
+            self.operation = None
+        self.floodfill_kwargs = floodfill_kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        '''
+        Ask the worker to stop, it stops at the next frontier expansion and does not emit any result
+        A cancelled refinement leaves its state half refined, it should be dropped
+        '''
+        self.cancelled = True
+        if self.client is not None:
+            try:
+                self.state.cancel()
+            except ComputeServerError:
+                pass  # its result is ignored anyway
+
+    def run(self):
+        try:
+            if self.client is not None:
+                self.run_remote()
+                return
+            if self.state is None:
+                if len(self.picked_points_id) != 3:
+                    raise FloodfillError("ERROR: {} points is chosen, only 3 point floodfill is implemented".format(
+                        len(self.picked_points_id)))
+                if self.graph is None:
+                    self.progress.emit("Building neighbor graph")
+                    self.graph = load_neighbor_graph(self.data_file_name, self.pcd)
+                    self.graph_loaded.emit(self.data_file_name, self.graph)
+                if self.use_patches and self.patches is None:
+                    self.progress.emit("Building planar patches")
+                    self.patches = load_patch_graph(self.data_file_name, self.pcd, self.graph)
+                    self.patches_loaded.emit(self.data_file_name, self.patches)
+                self.state = FloodfillState(self.pcd, self.graph, self.picked_points_id,
+                                            patches=self.patches if self.use_patches else None,
+                                            **self.floodfill_kwargs)
+                steps = self.state.start()
+            else:
+                name, args = self.operation
+                steps = getattr(self.state, name)(*args)
+            last_update = time.time()
+            with tracer.span("floodfill"):
+                for step, _ in enumerate(steps):
+                    if self.cancelled:
+                        return
+                    if time.time() - last_update >= self.update_interval:
+                        partial = self.state.points()
+                        self.progress.emit("Floodfill: {} points after {} expansions".format(len(partial), step + 1))
+                        self.partial_result.emit(partial, crop_reserve(self.pcd, partial))
+                        last_update = time.time()
+            if self.cancelled:
+                return
+            surface = self.state.points()
+            self.result.emit(surface, crop_reserve(self.pcd, surface), self.state)
+        except Exception as e:
+            self.error.emit(str(e))
+
+    def run_remote(self):
+        '''
+        Floodfill on the compute server, there are no partial results
+        '''
+        self.progress.emit("Floodfill: running on the compute server")
+        with tracer.span("floodfill"):
+            if self.operation is None:
+                self.state.start(self.data_file_name, self.picked_points_id, self.use_patches, **self.floodfill_kwargs)
+            else:
+                self.state.refine(*self.operation)
+        if self.cancelled:
+            return
+        surface = self.state.points()
+        self.result.emit(surface, crop_reserve(self.pcd, surface), self.state)
+
+
+class LoadWorker(QThread):
+    '''
+    Reads a point cloud file off the GUI thread, reporting random subsets of growing size as previews before the full
+    resolution cloud and what it needs to be drawn are ready. Clouds are read through the cloud cache, a cloud that is
+    still cached is ready right away.
+    '''
+    progress = pyqtSignal(str)
+    preview = pyqtSignal(object)  # PointCloudData of a random subset of the points
+    result = pyqtSignal(object)  # CloudEntry, its "display" and "bounds" are set, see prepare
+    error = pyqtSignal(str)
+
+    def __init__(self, data_file_name, lod_threshold, point_budget, preview_sizes=(100000, 1000000), parent=None):
+        '''
+        :param data_file_name: file to read
+        :param lod_threshold: clouds with more points than this are drawn through an octree
+        :param point_budget: maximum number of points drawn at once
+        :param preview_sizes: number of points of every preview, previews as large as the cloud are skipped
+        '''
+        super(LoadWorker, self).__init__(parent)
+        self.data_file_name = data_file_name
+        self.lod_threshold = lod_threshold
+        self.point_budget = point_budget
+        self.preview_sizes = preview_sizes
+        self.cancelled = False
+
+    def cancel(self):
+        '''
+        Ask the worker to stop, it stops after the step it is in and does not emit any result
+        '''
+        self.cancelled = True
+
+    def run(self):
+        try:
+            with tracer.span("load"):
+                if not os.path.isfile(self.data_file_name):
+                    raise IOError("ERR: Data file at {} cannot be found".format(self.data_file_name))
+                entry = cloud_cache.get(self.data_file_name)
+                if entry.pcd.is_empty():
+                    raise IOError("ERR: Data file at {} is empty".format(self.data_file_name))
+                if entry.derived.get("display_settings") != (self.lod_threshold, self.point_budget):
+                    self.prepare(entry)
+            if self.cancelled:
+                return
+            self.result.emit(entry)
+        except Exception as e:
+            self.error.emit(str(e))
+
+    def prepare(self, entry):
+        '''
+        Emit the previews, then store what the full cloud needs to be drawn in the cache entry: "display" as returned
+        by lod.prepare_display and the "bounds" (min, max) of the points
+        '''
+        pcd = entry.pcd
+        points = np.asarray(pcd.points)
+        count = len(points)
+        random_state = np.random.RandomState(0)
+        for size in self.preview_sizes:
+            if size >= min(count, self.point_budget) or self.cancelled:
+                break
+            with tracer.span("load.preview"):
+                # drawing with replacement and dropping repeats may come out a little short of size, choice without
+                # replacement permutes all of the points
+                ids = np.unique(random_state.randint(0, count, size))
+                colors = pcd.colors_u8[ids] if isinstance(pcd, PointCloudData) and pcd.colors_u8 is not None else None
+                preview = PointCloudData(np.asarray(points[ids], dtype=np.float32), colors)
+                if colors is None and pcd.has_colors():
+                    preview.colors = point_colors(pcd, ids)
+            self.preview.emit(preview)
+            self.progress.emit("Loading: showing {} of {} points".format(len(ids), count))
+        if self.cancelled:
+            return
+        self.progress.emit("Loading: preparing {} points for display".format(count))
+        with tracer.span("prepare_display"):
+            display = prepare_display(self.data_file_name, pcd, self.lod_threshold, self.point_budget)
+            bounds = points.min(axis=0), points.max(axis=0)
+        entry.derived.update(display=display, bounds=bounds, display_settings=(self.lod_threshold, self.point_budget))
+        cloud_cache.resize(entry)